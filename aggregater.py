@@ -6,6 +6,7 @@ import requests
 from datetime import datetime
 import json
 from tqdm import tqdm
+import migrations
 
 # connection = sqlite3.connect("atp_sandbox.db")
 connection = sqlite3.connect("atp.db")
@@ -21,7 +22,17 @@ CREATE TABLE IF NOT EXISTS users
    created_at DATETIME
    )
 """)
+cur.execute("""
+CREATE TABLE IF NOT EXISTS plc_sync_state
+  (id INTEGER PRIMARY KEY CHECK (id = 1),
+   after TEXT,
+   batch_id INTEGER NOT NULL,
+   updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+   )
+""")
 connection.commit()
+# ボットと同じ索引(まだなければここで作る)
+migrations.migrate(connection, "atp.db", background=True)
 
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path)
@@ -39,31 +50,36 @@ def get_did_list(after=None):
   return response.text
 
 
-def insert_did_many(connection, did_list):
-  cur = connection.cursor()
-  cur.executemany("""
-  INSERT OR IGNORE INTO users 
-    (did, handle, endpoint, created_at)
-    VALUES (?, ?, ?, ?)
-  """, did_list)
-  connection.commit()
+def insert_did_many(connection, did_list, after, batch_id):
+  # users と取り込み位置を同じトランザクションでコミットする
+  with connection:
+    connection.executemany("""
+    INSERT OR IGNORE INTO users
+      (did, handle, endpoint, created_at)
+      VALUES (?, ?, ?, ?)
+    """, did_list)
+    connection.execute("""
+    INSERT INTO plc_sync_state (id, after, batch_id)
+      VALUES (1, :after, :batch_id)
+      ON CONFLICT(id) DO UPDATE SET
+        after = :after,
+        batch_id = :batch_id,
+        updated_at = CURRENT_TIMESTAMP
+    """, {"after": after, "batch_id": batch_id})
 
 
 def get_last_created_at(connection):
   cur = connection.cursor()
-  sql = """
-    SELECT *
-    FROM users
-    ORDER BY created_at DESC
-    LIMIT 1
-  """
-  cur = connection.cursor()
-  cur.execute(sql)
+  cur.execute("SELECT after, batch_id FROM plc_sync_state WHERE id = 1")
+  row = cur.fetchone()
+  if row:
+    return row[0], row[1]
+  cur.execute("SELECT MAX(created_at) FROM users")
   row = cur.fetchone()
-  return row[4]
+  return row[0], 0
 
 
-last_created_at = get_last_created_at(connection)
+last_created_at, batch_id = get_last_created_at(connection)
 
 while True:
   did_list_text = get_did_list(last_created_at)
@@ -94,5 +110,6 @@ while True:
     break
   print(last_created_at)
 
-  insert_did_many(connection, did_list)
+  batch_id += 1
+  insert_did_many(connection, did_list, last_created_at, batch_id)
   time.sleep(0.05)
@@ -0,0 +1,61 @@
+import os
+import time
+
+# お絵描きの画像を保存するディレクトリ(docker-compose.yml でマウントしている)
+IMAGE_DIR = "images"
+# 1なら描いた絵(PNGと元のSVG)を IMAGE_DIR に保存する。返信には使わない
+IMAGE_ARCHIVE = os.getenv("IMAGE_ARCHIVE", "0") == "1"
+# 保存しておく合計サイズ(バイト)と日数。超えた分は古いものから消す
+IMAGE_ARCHIVE_MAX_BYTES = int(os.getenv("IMAGE_ARCHIVE_MAX_BYTES", 500 * 1024 * 1024))
+IMAGE_ARCHIVE_MAX_AGE = int(os.getenv("IMAGE_ARCHIVE_MAX_AGE_DAYS", 30)) * 24 * 60 * 60
+ARCHIVE_SUFFIXES = (".png", ".svg")
+
+
+def save_drawing(name, png, svg, directory=IMAGE_DIR):
+    """IMAGE_ARCHIVE が有効なら name.png と name.svg を保存してPNGのパスを返す"""
+    if not IMAGE_ARCHIVE:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, name)
+    with open(base + ".png", "wb") as f:
+        f.write(png)
+    # ベンチマーク(benchmarks/svg_render.py)で使えるよう元のSVGも残す
+    with open(base + ".svg", "w") as f:
+        f.write(svg)
+    return base + ".png"
+
+
+def prune_images(
+    directory=IMAGE_DIR,
+    max_bytes=IMAGE_ARCHIVE_MAX_BYTES,
+    max_age=IMAGE_ARCHIVE_MAX_AGE,
+    now=None,
+):
+    """
+    max_age 秒より古いファイルを消し、残りが max_bytes を超えていれば古いものから消す
+    消したファイル数と残ったバイト数を返す
+    """
+    if now is None:
+        now = time.time()
+    files = []
+    if not os.path.isdir(directory):
+        return 0, 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(ARCHIVE_SUFFIXES):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        if now - mtime <= max_age and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed, total
@@ -0,0 +1,168 @@
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+import xrpc
+
+ATP_HOST = os.getenv("ATP_HOST", "https://bsky.social")
+# 再起動しても使い回せるようにトークンを保存しておくファイル
+SESSION_PATH = "session.json"
+LOGIN_LOG_PATH = "login.txt"
+# パスワードでのログインはこの間隔より詰めない
+LOGIN_THROTTLE = timedelta(minutes=5)
+# 期限のこれだけ前にアクセストークンを更新する
+REFRESH_MARGIN = 5 * 60
+
+
+def jwt_expires_at(token):
+    """JWT の exp(UNIX時刻)。署名は検証しない。読めなければ 0"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("exp", 0)
+    except (IndexError, ValueError):
+        return 0
+
+
+def read_last_line(path):
+    """追記していくファイルの最後の行だけを末尾から読む"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(max(end - 4096, 0))
+        lines = f.read().splitlines()
+    return lines[-1].decode().strip() if lines else None
+
+
+class SessionManager:
+    """
+    ログイン状態をスレッド間で共有する。ATP_HOST / ATP_AUTH_TOKEN / DID を
+    属性として読め、期限が近ければ refreshJwt で更新してから返す
+    トークンは session.json に保存し、再起動時はパスワードでのログインを省く
+    """
+
+    def __init__(
+        self, username, password, host=ATP_HOST, path=SESSION_PATH, throttle=True
+    ):
+        self.username = username
+        self.password = password
+        self.throttle = throttle
+        self.ATP_HOST = host
+        self.path = path
+        self.lock = threading.Lock()
+        # (accessJwt, refreshJwt, did) を丸ごと差し替えて読み書きを不可分にする
+        self.tokens = None
+
+    @property
+    def ATP_AUTH_TOKEN(self):
+        return self.current()[0]
+
+    @property
+    def DID(self):
+        return self.current()[2]
+
+    def current(self):
+        tokens = self.tokens
+        if tokens is None or self.needs_refresh(tokens[0]):
+            tokens = self.ensure_fresh()
+        return tokens
+
+    def needs_refresh(self, access_jwt):
+        return jwt_expires_at(access_jwt) - REFRESH_MARGIN <= time.time()
+
+    def ensure_fresh(self):
+        """必要なら保存したトークンの読み込み・更新・ログインを行い、トークンを返す"""
+        while True:
+            with self.lock:
+                if self.tokens is None:
+                    self.tokens = self.load()
+                if self.tokens is not None and not self.needs_refresh(self.tokens[0]):
+                    return self.tokens
+                refreshable = (
+                    self.tokens is not None
+                    and jwt_expires_at(self.tokens[1]) > time.time()
+                )
+                if refreshable:
+                    try:
+                        self.tokens = self.refresh(self.tokens[1])
+                        self.save()
+                        return self.tokens
+                    except Exception as e:
+                        print(f"[session] refresh failed: {e}")
+                wait_time = self.login_wait()
+                if wait_time <= 0:
+                    self.tokens = self.login()
+                    self.save()
+                    return self.tokens
+            # 待つ間はロックを放して、他のスレッドが持っているトークンを読めるようにする
+            # 起きたら、その間に他のスレッドがログインしていないか確かめ直す
+            print(f"login wait:{wait_time}")
+            time.sleep(wait_time)
+
+    def refresh(self, refresh_jwt):
+        response = xrpc.client.post(
+            self.ATP_HOST + "/xrpc/com.atproto.server.refreshSession",
+            headers={"Authorization": "Bearer " + refresh_jwt},
+        )
+        response.raise_for_status()
+        data = response.json()
+        print(f"[session] refreshed at:{datetime.now(pytz.utc)}")
+        return (data["accessJwt"], data["refreshJwt"], data["did"])
+
+    def login_wait(self):
+        """直前にパスワードでログインしていれば、次にログインできるまでの秒数"""
+        if not self.throttle or not os.path.exists(LOGIN_LOG_PATH):
+            return 0
+        last_line = read_last_line(LOGIN_LOG_PATH)
+        if not last_line:
+            return 0
+        delta = datetime.now(pytz.utc) - datetime.fromisoformat(last_line)
+        return max((LOGIN_THROTTLE - delta).total_seconds(), 0)
+
+    def login(self):
+        """パスワードでログインする。間隔は login_wait で空けておく"""
+        now = datetime.now(pytz.utc)
+        response = xrpc.client.post(
+            self.ATP_HOST + "/xrpc/com.atproto.server.createSession",
+            json={"identifier": self.username, "password": self.password},
+        )
+        data = response.json()
+        if data.get("accessJwt") is None:
+            raise ValueError(f"login failed: {response.status_code} {data}")
+        with open(LOGIN_LOG_PATH, mode="a") as f:
+            f.write(f"{now}\n")
+        print(f"login at:{now}")
+        return (data["accessJwt"], data["refreshJwt"], data["did"])
+
+    def load(self):
+        """保存したトークンがこのアカウント・ホストのものなら返す"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("host") != self.ATP_HOST or data.get("handle") != self.username:
+            return None
+        print("[session] loaded saved session")
+        return (data["accessJwt"], data["refreshJwt"], data["did"])
+
+    def save(self):
+        access_jwt, refresh_jwt, did = self.tokens
+        data = {
+            "host": self.ATP_HOST,
+            "handle": self.username,
+            "did": did,
+            "accessJwt": access_jwt,
+            "refreshJwt": refresh_jwt,
+        }
+        # 書きかけのファイルを読まないよう、別名で書いてから置き換える
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,923 @@
+"""
+bot.py の主な処理をまとめて計測するベンチマーク
+
+    python benchmarks/e2e.py [--scenario NAME ...] [--users 1000000] ...
+    python benchmarks/e2e.py --compare benchmarks/results/old.json new.json
+
+通知・タイムライン・PLC export・atp.db の行は生成し、HTTP(xrpc.client)と
+GPT(gpt.get_answer など)はすぐに返すものに差し替える。一時ディレクトリで
+動かすので、リポジトリの DB には触れない。
+シナリオごとのスループットとレイテンシのパーセンタイルを表示し、
+benchmarks/results/<日時>_<commit>.json に保存する。--compare で2つの結果を比べる。
+
+シナリオ
+    user_info      atp.db に --users 行を入れ、update_user_ranks と get_user_info
+    dialogs        dialogs に行を入れ、get_recent_dialogs
+    notifications  process_notifications(ポーリング1回の時間と、返信までの時間)
+    backlog        MAX_NOTIFICATION_PAGES を超える通知の取り残しを、取り直しで
+                   すべて処理できるか(ページ数は小さくして試す)
+    resume         applyWrites の応答が届かずに落ちた返信を、起動し直して投稿し直す
+                   (投稿前に台帳が保存されているか、二重に投稿・問い合わせしないか)
+    timeline       process_timeline(同上)
+    aggregate      PLC export のページを util.aggregate_users で取り込む
+    render         SVG→PNG の変換と、お絵描きの返信までの時間(libcairo が必要)
+
+結果に failed がある(期待した動きにならなかった)シナリオがあれば終了コードは1
+"""
+
+import argparse
+import bisect
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "benchmarks")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SVG_DIR = os.path.join(BENCH_DIR, "fixtures", "svg")
+SCENARIOS = [
+    "user_info",
+    "dialogs",
+    "notifications",
+    "backlog",
+    "resume",
+    "timeline",
+    "aggregate",
+    "render",
+]
+
+BOT_HANDLE = "bot.bench"
+BOT_DID = "did:plc:benchbot"
+# 通知・タイムラインの投稿者(atp.db の先頭の行と同じDID)
+AUTHORS = 200
+ANSWER = "ごきげんよう。ベンチマークのお返事ですわ。" * 4
+USER_CREATED_AT = datetime(2023, 2, 1)
+MENTION_FACET = {
+    "index": {"byteStart": 0, "byteEnd": len(BOT_HANDLE) + 1},
+    "features": [{"$type": "app.bsky.richtext.facet#mention", "did": BOT_DID}],
+}
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        "p50_ms": pick(0.50),
+        "p90_ms": pick(0.90),
+        "p99_ms": pick(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def summarize(count, seconds, latencies, unit, **extra):
+    result = {
+        "unit": unit,
+        "count": count,
+        "seconds": round(seconds, 4),
+        "per_sec": round(count / seconds, 1) if seconds > 0 else None,
+    }
+    result.update(percentiles(latencies))
+    result.update(extra)
+    return result
+
+
+def author_did(i):
+    return f"did:plc:bench{i:019d}"
+
+
+def iso(dt):
+    return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.headers = {}
+
+    @property
+    def text(self):
+        return json.dumps(self.data)
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def close(self):
+        pass
+
+
+class FakeNetwork:
+    """xrpc.client の get/post の代わり。返信が投稿された時刻を元の投稿のURIごとに残す"""
+
+    def __init__(self):
+        import xrpc
+
+        self.endpoint_of = xrpc.endpoint_of
+        self.notifications = []
+        self.feed = []
+        self.replied = {}
+        self.counts = {}
+        # 呼んだスレッドが bluesky_bot.db のトランザクションの中にいるか(Harness が差し替える)
+        self.in_transaction = lambda: False
+        # トランザクションの中から呼ばれたエンドポイント
+        self.locked_calls = []
+        # applyWrites で書いたレコードキー(同じキーは受け付けない)
+        self.rkeys = set()
+        # True なら applyWrites を書き込んだ後で接続が切れたことにする
+        self.drop_after_write = False
+        # applyWrites を受けたときに、返信先のURIを渡して呼ぶ
+        self.on_write = None
+
+    def count(self, endpoint):
+        self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        if self.in_transaction():
+            self.locked_calls.append(endpoint)
+
+    def get(self, url, params=None, **kwargs):
+        endpoint = self.endpoint_of(url)
+        self.count(endpoint)
+        # bot.py はクエリを URL に直接書くことがある
+        query = {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+        params = {**query, **(params or {})}
+        if endpoint == "app.bsky.notification.listNotifications":
+            start = int(params.get("cursor") or 0)
+            limit = int(params.get("limit", 50))
+            page = self.notifications[start : start + limit]
+            data = {"notifications": page}
+            if start + limit < len(self.notifications):
+                data["cursor"] = str(start + limit)
+            return FakeResponse(data)
+        if endpoint == "app.bsky.feed.getTimeline":
+            return FakeResponse({"feed": self.feed})
+        if endpoint == "com.atproto.repo.getRecord":
+            if params.get("rkey") in self.rkeys:
+                return FakeResponse({"uri": "at://bench/post/1", "cid": "bafybench"})
+            return FakeResponse({"error": "RecordNotFound"}, 400)
+        if endpoint == "app.bsky.actor.getProfile":
+            return FakeResponse({"handle": params.get("actor"), "postsCount": 1234})
+        return FakeResponse({"error": "NotFound"}, 404)
+
+    def post(self, url, json=None, data=None, **kwargs):
+        endpoint = self.endpoint_of(url)
+        self.count(endpoint)
+        if endpoint == "com.atproto.repo.applyWrites":
+            rkeys = [write.get("rkey") for write in json["writes"]]
+            if self.rkeys.intersection(rkeys):
+                return FakeResponse({"error": "InvalidRequest"}, 400)
+            self.rkeys.update(rkeys)
+            first = json["writes"][0]["value"]
+            reply = first.get("reply")
+            if reply:
+                self.replied[reply["parent"]["uri"]] = time.perf_counter()
+                if self.on_write is not None:
+                    self.on_write(reply["parent"]["uri"])
+            if self.drop_after_write:
+                import requests
+
+                raise requests.exceptions.ConnectionError("connection dropped")
+            return FakeResponse({"results": []})
+        if endpoint == "com.atproto.repo.createRecord":
+            return FakeResponse({"uri": "at://bench/post/1", "cid": "bafybench"})
+        if endpoint == "com.atproto.repo.uploadBlob":
+            import dagcbor
+
+            # 投稿のCIDを手元で計算するときに読むので、読めるCIDを返す
+            blob = {
+                "$type": "blob",
+                "ref": {"$link": dagcbor.cid_for({"blob": len(data or b"")})},
+                "mimeType": "image/png",
+                "size": len(data or b""),
+            }
+            return FakeResponse({"blob": blob})
+        return FakeResponse({})
+
+
+class Session:
+    ATP_HOST = "http://bench.invalid"
+    ATP_AUTH_TOKEN = "bench"
+
+    def __init__(self, did=BOT_DID):
+        self.DID = did
+
+
+class Harness:
+    def __init__(self, args, handle=BOT_HANDLE, did=BOT_DID):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+        os.chdir(self.workdir)
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+        os.environ["BOT_HANDLE"] = handle
+        os.environ["METRICS_PORT"] = "0"
+        os.environ["IMAGE_ARCHIVE"] = "0"
+        os.environ["JOURNAL_DIR"] = ""
+        sys.path.insert(0, ROOT)
+        sys.path.insert(0, BENCH_DIR)
+        import bot
+        import db
+        import gpt
+        import migrations
+        import util
+        import xrpc
+
+        # 本番では Runtime.migrate が起動後に作る索引も、計る前に作っておく
+        for name in ("atp.db", "bluesky_bot.db", "logs.db"):
+            migrations.migrate(db.connect(name), name, background=True)
+        self.bot = bot
+        self.util = util
+        self.net = FakeNetwork()
+        self.net.in_transaction = lambda: bot.connection.connection.in_transaction
+        xrpc.client.get = self.net.get
+        xrpc.client.post = self.net.post
+        self.svgs = load_svgs()
+        gpt.get_answer = self.fake_answer
+        gpt.get_answer5 = self.fake_answer5
+        gpt.get_answer5_nano = self.fake_answer5
+        self.session = Session(did)
+        # GPTに問い合わせた回数
+        self.answers = 0
+        self.started = {}
+        # ハンドラ1回ごとの bluesky_bot.db のコミット数
+        self.handler_commits = []
+        self.users_ready = 0
+        self.rnd = random.Random(0)
+        # bot.py のランダムな返信も実行ごとに同じにする
+        random.seed(0)
+        # 初回の呼び出しで通知のカーソルが現在時刻になるので、それより後の時刻で作る
+        bot.get_last_processed_notification_time()
+        self.clock = datetime.now(timezone.utc) + timedelta(seconds=1)
+
+    def fake_answer(self, prompt, text, massages=None, deadline=None):
+        self.answers += 1
+        return ANSWER
+
+    def fake_answer5(self, prompt, text, deadline=None):
+        if "svg" in text and self.svgs:
+            return f"{self.rnd.choice(self.svgs)}\nわたくしの自信作ですわ。"
+        return ANSWER
+
+    def dispatch(self, key, handler, *args):
+        """dispatch_inline と同じだが、投稿ごとに渡した時刻を残す"""
+        for arg in args:
+            if isinstance(arg, self.bot.events.Event):
+                self.started[arg.post.uri] = time.perf_counter()
+        connection = self.bot.connection.connection
+        commits = []
+
+        def trace(sql):
+            if sql.lstrip().upper().startswith("COMMIT"):
+                commits.append(sql)
+
+        connection.set_trace_callback(trace)
+        try:
+            self.bot.run_handler(handler, *args)
+        finally:
+            connection.set_trace_callback(None)
+        self.handler_commits.append(len(commits))
+
+    def wait_idle(self, timeout=300):
+        """GPTの応答待ち・変換待ちがなくなるまで待つ"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.bot.pending_replies and self.bot.answer_queue.backlog() == 0:
+                return True
+            time.sleep(0.005)
+        return False
+
+    def reply_latencies(self, uris):
+        return [
+            self.net.replied[uri] - self.started[uri]
+            for uri in uris
+            if uri in self.net.replied and uri in self.started
+        ]
+
+    def next_time(self):
+        self.clock += timedelta(milliseconds=10)
+        return self.clock
+
+    def ensure_users(self, count):
+        """atp.db の users に count 行(先頭 AUTHORS 行は投稿者)を入れる"""
+        if self.users_ready >= count:
+            return None
+        connection = self.bot.connection_atp
+        chunk = 100000
+        start = time.perf_counter()
+        for offset in range(self.users_ready, count, chunk):
+            rows = []
+            for i in range(offset, min(offset + chunk, count)):
+                created_at = USER_CREATED_AT + timedelta(seconds=i * 0.01)
+                rows.append(
+                    (
+                        author_did(i).replace("did:plc:", ""),
+                        f"user{i}.bsky.social",
+                        "https://bsky.social",
+                        created_at.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                    )
+                )
+            with connection:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO users (did, handle, endpoint, created_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+        elapsed = time.perf_counter() - start
+        added = count - self.users_ready
+        self.users_ready = count
+        return summarize(added, elapsed, [], "rows")
+
+    def ensure_settings(self, dids, mode=1, points=10):
+        for did in dids:
+            settings = self.util.get_user_settings(self.bot.connection, did)
+            settings["mode"] = mode
+            settings["points"] = points
+            self.util.update_user_settings(self.bot.connection, did, settings)
+        self.util.flush_user_settings(self.bot.connection)
+
+    def author(self, i):
+        did = author_did(i)
+        return {
+            "did": did,
+            "handle": f"user{i}.bsky.social",
+            "displayName": f"ユーザー{i}",
+            "viewer": {
+                "muted": False,
+                "blockedBy": False,
+                "followedBy": f"at://{did}/app.bsky.graph.follow/3kbench",
+            },
+        }
+
+    # --- シナリオ
+
+    def run_user_info(self):
+        results = {}
+        populate = self.ensure_users(self.args.users)
+        if populate:
+            results["atp_db.populate"] = populate
+        connection = self.bot.connection_atp
+        start = time.perf_counter()
+        self.util.update_user_ranks(connection)
+        results["update_user_ranks"] = summarize(
+            self.args.users, time.perf_counter() - start, [], "rows"
+        )
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(self.args.queries):
+            did = author_did(self.rnd.randrange(self.args.users))
+            t = time.perf_counter()
+            self.util.get_user_info(connection, did.replace("did:plc:", ""))
+            latencies.append(time.perf_counter() - t)
+        results["get_user_info"] = summarize(
+            self.args.queries, time.perf_counter() - start, latencies, "queries"
+        )
+        return results
+
+    def run_dialogs(self):
+        connection = self.bot.connection
+        users = self.args.dialog_users
+        per_user = self.args.dialogs_per_user
+        start = time.perf_counter()
+        rows = (
+            (
+                author_did(i % users).replace("did:plc:", ""),
+                "user" if n % 2 == 0 else "assistant",
+                f"メッセージ{n}です。" * 3,
+            )
+            for n in range(per_user)
+            for i in range(users)
+        )
+        with connection:
+            connection.executemany(
+                "INSERT INTO dialogs (did, role, message) VALUES (?, ?, ?)", rows
+            )
+        populate = summarize(users * per_user, time.perf_counter() - start, [], "rows")
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(self.args.queries):
+            did = author_did(self.rnd.randrange(users)).replace("did:plc:", "")
+            t = time.perf_counter()
+            self.util.get_recent_dialogs(connection, did, 30)
+            latencies.append(time.perf_counter() - t)
+        return {
+            "dialogs.populate": populate,
+            "get_recent_dialogs": summarize(
+                self.args.queries, time.perf_counter() - start, latencies, "queries"
+            ),
+        }
+
+    def make_notification(self, i, text):
+        author = self.author(i % AUTHORS)
+        uri = f"at://{author['did']}/app.bsky.feed.post/n{i}"
+        return {
+            "uri": uri,
+            "cid": f"bafybench{i}",
+            "author": author,
+            "reason": "mention",
+            "isRead": False,
+            "indexedAt": iso(self.next_time()),
+            "record": {
+                "$type": "app.bsky.feed.post",
+                "text": f"@{BOT_HANDLE} {text}",
+                "createdAt": iso(self.clock),
+                "facets": [MENTION_FACET],
+            },
+        }
+
+    def run_notifications(self, texts=None, name="notifications"):
+        self.ensure_users(max(AUTHORS, self.users_ready))
+        self.ensure_settings(
+            [author_did(i).replace("did:plc:", "") for i in range(AUTHORS)]
+        )
+        texts = texts or ["こんにちは", "占って", "status", "今日はいい天気ですわね"]
+        total = self.args.notifications
+        batch = self.args.notification_batch
+        uris = []
+        poll_latencies = []
+        self.handler_commits = []
+        start = time.perf_counter()
+        for offset in range(0, total, batch):
+            page = [
+                self.make_notification(i, texts[i % len(texts)])
+                for i in range(offset, min(offset + batch, total))
+            ]
+            uris.extend(n["uri"] for n in page)
+            # listNotifications は新しい順
+            self.net.notifications = list(reversed(page))
+            t = time.perf_counter()
+            self.bot.process_notifications(self.session, BOT_DID, self.dispatch)
+            poll_latencies.append(time.perf_counter() - t)
+        poll_seconds = sum(poll_latencies)
+        idle = self.wait_idle()
+        elapsed = time.perf_counter() - start
+        replies = self.reply_latencies(uris)
+        poll = summarize(
+            total,
+            poll_seconds,
+            poll_latencies,
+            "notifications",
+            max_commits_per_handler=max(self.handler_commits, default=0),
+        )
+        locked = self.net.locked_calls
+        self.net.locked_calls = []
+        if locked:
+            # ネットワークを待つ間は bluesky_bot.db の書き込みのロックを持たないはず
+            poll["failed"] = (
+                f"{len(locked)} requests sent inside a transaction"
+                f" ({', '.join(sorted(set(locked)))})"
+            )
+        elif poll["max_commits_per_handler"] > 2:
+            # 書き込みは投稿の前と後の2回のコミットにまとまるはず
+            poll["failed"] = (
+                f"{poll['max_commits_per_handler']} commits in one handler"
+            )
+        return {
+            f"{name}.poll": poll,
+            f"{name}.reply": summarize(
+                len(replies), elapsed, replies, "replies", drained=idle
+            ),
+        }
+
+    def run_backlog(self, pages=2, arrivals=20):
+        """
+        pages ページを超えて溜まった通知を、新しい通知が届き続ける中で取り直す
+        dispatch に渡らなかった通知があれば failed
+        """
+        self.ensure_users(max(AUTHORS, self.users_ready))
+        self.ensure_settings(
+            [author_did(i).replace("did:plc:", "") for i in range(AUTHORS)]
+        )
+        max_pages = self.bot.MAX_NOTIFICATION_PAGES
+        self.bot.MAX_NOTIFICATION_PAGES = pages
+        total = pages * self.bot.NOTIFICATION_PAGE_SIZE * 2 + 50
+        first = 10**6
+        try:
+            page = [
+                self.make_notification(i, "こんにちは")
+                for i in range(first, first + total)
+            ]
+            uris = [n["uri"] for n in page]
+            self.net.notifications = list(reversed(page))
+            latencies = []
+            polls = 0
+            start = time.perf_counter()
+            backlog = True
+            while backlog and polls < 100:
+                # 取り直す間にも新しい通知が届く
+                if polls:
+                    arrived = [
+                        self.make_notification(i, "こんにちは")
+                        for i in range(first + total, first + total + arrivals)
+                    ]
+                    total += arrivals
+                    uris.extend(n["uri"] for n in arrived)
+                    self.net.notifications[:0] = list(reversed(arrived))
+                t = time.perf_counter()
+                _, backlog = self.bot.process_notifications(
+                    self.session, BOT_DID, self.dispatch
+                )
+                latencies.append(time.perf_counter() - t)
+                polls += 1
+            elapsed = time.perf_counter() - start
+        finally:
+            self.bot.MAX_NOTIFICATION_PAGES = max_pages
+        self.wait_idle()
+        missed = [uri for uri in uris if uri not in self.started]
+        result = summarize(
+            total, elapsed, latencies, "notifications", polls=polls, missed=len(missed)
+        )
+        if backlog or missed:
+            result["failed"] = (
+                f"{len(missed)} of {total} notifications skipped"
+                f" (backlog left: {backlog})"
+            )
+        return {"notifications.backlog": result}
+
+    def run_resume(self, total=50):
+        """
+        applyWrites は届いたが応答の前に落ちた返信を、起動し直して投稿し直す
+        投稿する時点で台帳の generated がコミットされていなければ、落ちた後に
+        ハンドラからやり直して問い合わせ・投稿が二重になるので failed
+        """
+        import sqlite3
+
+        self.ensure_users(max(AUTHORS, self.users_ready))
+        self.ensure_settings(
+            [author_did(i).replace("did:plc:", "") for i in range(AUTHORS)]
+        )
+        first = 2 * 10**6
+        page = [
+            self.make_notification(i, "今日はいい天気ですわね")
+            for i in range(first, first + total)
+        ]
+        uris = [n["uri"] for n in page]
+        durable = {}
+
+        def on_write(uri):
+            # 別の接続から見た(落ちても残る)台帳の状態
+            with contextlib.closing(sqlite3.connect("bluesky_bot.db")) as reader:
+                row = reader.execute(
+                    "SELECT state FROM reply_ledger WHERE uri = ?", (uri,)
+                ).fetchone()
+            durable[uri] = row[0] if row else None
+
+        self.net.on_write = on_write
+        self.net.drop_after_write = True
+        self.net.notifications = list(reversed(page))
+        try:
+            # 切れた接続のトレースバックは出さない
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+                self.bot.process_notifications(self.session, BOT_DID, self.dispatch)
+                self.wait_idle()
+        finally:
+            self.net.drop_after_write = False
+            self.net.on_write = None
+        posted = self.net.counts.get("com.atproto.repo.applyWrites", 0)
+        answers = self.answers
+
+        # 起動し直したことにする
+        run_id = self.bot.RUN_ID
+        self.bot.RUN_ID = f"{run_id}-restarted"
+        start = time.perf_counter()
+        try:
+            self.bot.resume_replies(self.session, self.dispatch)
+            self.wait_idle()
+        finally:
+            self.bot.RUN_ID = run_id
+        elapsed = time.perf_counter() - start
+        with contextlib.closing(sqlite3.connect("bluesky_bot.db")) as reader:
+            states = dict(
+                reader.execute(
+                    "SELECT uri, state FROM reply_ledger WHERE uri IN (%s)"
+                    % ",".join("?" * len(uris)),
+                    uris,
+                ).fetchall()
+            )
+        reposted = self.net.counts.get("com.atproto.repo.applyWrites", 0) - posted
+        result = summarize(
+            total,
+            elapsed,
+            [],
+            "replies",
+            written=len(durable),
+            reposted=reposted,
+            answers=self.answers - answers,
+        )
+        problems = []
+        not_durable = [uri for uri, state in durable.items() if state != "generated"]
+        if len(durable) != total or not_durable:
+            problems.append(f"{len(not_durable)} replies posted before commit")
+        if reposted or self.answers != answers:
+            problems.append(
+                f"{reposted} posts and {self.answers - answers} answers repeated"
+            )
+        unfinished = [uri for uri in uris if states.get(uri) != "posted"]
+        if unfinished:
+            problems.append(f"{len(unfinished)} not marked posted")
+        if problems:
+            result["failed"] = ", ".join(problems)
+        return {"resume": result}
+
+    def make_feed_item(self, i):
+        author = self.author(i % AUTHORS)
+        return {
+            "post": {
+                "uri": f"at://{author['did']}/app.bsky.feed.post/t{i}",
+                "cid": f"bafybench{i}",
+                "author": author,
+                "record": {
+                    "$type": "app.bsky.feed.post",
+                    "text": "今日のお昼ごはんはカレーでしたわ",
+                    "createdAt": iso(self.clock),
+                },
+                "indexedAt": iso(self.next_time()),
+            }
+        }
+
+    def run_timeline(self):
+        self.ensure_settings(
+            [author_did(i).replace("did:plc:", "") for i in range(AUTHORS)]
+        )
+        total = self.args.timeline_posts
+        uris = []
+        latencies = []
+        start = time.perf_counter()
+        now = self.clock
+        for offset in range(0, total, 50):
+            feed = [
+                self.make_feed_item(i) for i in range(offset, min(offset + 50, total))
+            ]
+            uris.extend(item["post"]["uri"] for item in feed)
+            t = time.perf_counter()
+            now = self.bot.process_timeline(
+                self.session, BOT_DID, now, feed, self.dispatch
+            )
+            latencies.append(time.perf_counter() - t)
+        poll_seconds = sum(latencies)
+        idle = self.wait_idle()
+        elapsed = time.perf_counter() - start
+        replies = self.reply_latencies(uris)
+        return {
+            "timeline.poll": summarize(total, poll_seconds, latencies, "posts"),
+            "timeline.reply": summarize(
+                len(replies), elapsed, replies, "replies", drained=idle
+            ),
+        }
+
+    def run_aggregate(self):
+        import make_plc_fixture
+        import plc_ingest
+
+        rnd = random.Random(1)
+        base = datetime(2024, 1, 1)
+        lines = []
+        created_ats = []
+        for i in range(self.args.plc_lines):
+            created_at = base + timedelta(seconds=i)
+            lines.append(make_plc_fixture.make_line(i, created_at, rnd).encode())
+            created_ats.append(created_at.isoformat(timespec="milliseconds") + "Z")
+        page_size = self.args.plc_page_size
+        page_latencies = []
+        last = [None]
+
+        def iter_did_lines(after=None):
+            # 前のページを返してから次を求められるまでが1ページの処理時間
+            now = time.perf_counter()
+            if last[0] is not None:
+                page_latencies.append(now - last[0])
+            last[0] = now
+            start = bisect.bisect_right(created_ats, after or "")
+            yield from lines[start : start + page_size]
+
+        connection = self.bot.db.connect("plc_bench.db")
+        connection.executescript(plc_ingest.ATP_SCHEMA)
+        self.util.iter_did_lines = iter_did_lines
+        start = time.perf_counter()
+        self.util.aggregate_users(connection, plc_ingest.START_CURSOR)
+        elapsed = time.perf_counter() - start
+        inserted = connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return {
+            "aggregate_users": summarize(
+                len(lines), elapsed, page_latencies, "lines", inserted=inserted
+            )
+        }
+
+    def run_render(self):
+        import render
+
+        pool = render.RenderPool(cache_size=0)
+        try:
+            return self.render_with(pool)
+        finally:
+            # 終わるときに os._exit するので、変換プロセスが残って出力を塞がないよう止める
+            pool.shutdown()
+            render.render_pool.shutdown()
+
+    def render_with(self, pool):
+        import render
+
+        worker = pool.call(worker_state)
+        results = {"render.worker": {"modules": worker["modules"]}}
+        if worker["modules"] or worker["databases"]:
+            # 変換プロセスは render だけを読み込み、ボットの DB を開かないはず
+            results["render.worker"]["failed"] = (
+                f"loaded {worker['modules']} and opened {worker['databases']}"
+            )
+        if not self.svgs:
+            results["render"] = {"skipped": f"no svg files in {SVG_DIR}"}
+            return results
+        # find_spec では入っているかしか分からない。libcairo がないと import で失敗する
+        try:
+            import cairosvg
+        except (ImportError, OSError) as e:
+            reason = str(e).splitlines()[0]
+            results["render"] = {"skipped": f"cairosvg unavailable: {reason}"}
+            return results
+        latencies = []
+        failures = 0
+        start = time.perf_counter()
+        for _ in range(self.args.render_rounds):
+            for svg in self.svgs:
+                t = time.perf_counter()
+                try:
+                    pool.svg_to_png(svg)
+                except render.RenderError:
+                    failures += 1
+                latencies.append(time.perf_counter() - t)
+        results["render"] = summarize(
+            len(latencies),
+            time.perf_counter() - start,
+            latencies,
+            "svgs",
+            failures=failures,
+            cairosvg=cairosvg.__version__,
+        )
+        draws = self.run_notifications(texts=["猫を描いて"], name="draw")
+        results.update(draws)
+        return results
+
+
+def worker_state():
+    """変換プロセスで実行する。読み込んだボットのモジュールと、開いている .db ファイル"""
+    databases = []
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            path = os.readlink(os.path.join("/proc/self/fd", fd))
+        except OSError:
+            continue
+        if path.endswith(".db"):
+            databases.append(os.path.basename(path))
+    modules = [name for name in ("bot", "util", "db") if name in sys.modules]
+    return {"modules": modules, "databases": sorted(databases)}
+
+
+def load_svgs():
+    svgs = []
+    if os.path.isdir(SVG_DIR):
+        for name in sorted(os.listdir(SVG_DIR)):
+            if name.endswith(".svg"):
+                with open(os.path.join(SVG_DIR, name), encoding="utf-8") as f:
+                    svgs.append(f.read())
+    return svgs
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+        dirty = bool(
+            subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=ROOT,
+                text=True,
+            ).strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+
+def print_results(results):
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:<28} skipped: {result['skipped']}")
+            continue
+        if "count" not in result:
+            # 計測ではなく確認だけの結果
+            status = f"FAILED: {result['failed']}" if "failed" in result else "ok"
+            print(f"{name:<28} {status}")
+            continue
+        line = (
+            f"{name:<28} {result['count']:>9} {result['unit']:<13} "
+            f"{result['seconds']:>9.3f}s {result['per_sec'] or 0:>12.1f}/s"
+        )
+        if "p50_ms" in result:
+            line += (
+                f"  p50 {result['p50_ms']:.3f}ms p90 {result['p90_ms']:.3f}ms "
+                f"p99 {result['p99_ms']:.3f}ms max {result['max_ms']:.3f}ms"
+            )
+        print(line)
+        if "failed" in result:
+            print(f"{'':<28} FAILED: {result['failed']}")
+
+
+def save_results(results, args, commit, dirty, prefix=""):
+    """結果を args.output(省略時は benchmarks/results/ の下)に保存する"""
+    meta = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": vars(args),
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        suffix = "-dirty" if dirty else ""
+        output = os.path.join(RESULTS_DIR, f"{prefix}{stamp}_{commit}{suffix}.json")
+    with open(output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2, ensure_ascii=False)
+    print(f"saved {output}")
+    return output
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"old: {old['meta']['commit']}  new: {new['meta']['commit']}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name)
+        if before is None or "skipped" in result or "skipped" in before:
+            continue
+        parts = []
+        for key in ("per_sec", "p50_ms", "p99_ms"):
+            if result.get(key) is None or not before.get(key):
+                continue
+            change = (result[key] - before[key]) / before[key] * 100
+            parts.append(f"{key} {before[key]} -> {result[key]} ({change:+.1f}%)")
+        print(f"{name:<28} " + "  ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--dialog-users", type=int, default=10000)
+    parser.add_argument("--dialogs-per-user", type=int, default=50)
+    parser.add_argument("--notifications", type=int, default=2000)
+    parser.add_argument("--notification-batch", type=int, default=200)
+    parser.add_argument("--timeline-posts", type=int, default=2000)
+    parser.add_argument("--plc-lines", type=int, default=100000)
+    parser.add_argument("--plc-page-size", type=int, default=1000)
+    parser.add_argument("--render-rounds", type=int, default=3)
+    parser.add_argument("--output", help="結果のJSONの保存先")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    scenarios = args.scenario or SCENARIOS
+    if args.output:
+        # Harness が一時ディレクトリに移る前に決めておく
+        args.output = os.path.abspath(args.output)
+    commit, dirty = git_commit()
+    harness = Harness(args)
+    results = {}
+    for scenario in scenarios:
+        print(f"--- {scenario}", flush=True)
+        # bot.py の print は計測の邪魔なので捨てる
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            scenario_results = getattr(harness, f"run_{scenario}")()
+        print_results(scenario_results)
+        results.update(scenario_results)
+
+    save_results(results, args, commit, dirty)
+    failed = [name for name, result in results.items() if "failed" in result]
+    # GPTのキューなどのスレッドを待たずに終わる
+    os._exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+plc.directory/export と同じ形式のJSONLを生成する
+
+    python benchmarks/make_plc_fixture.py benchmarks/fixtures/plc_export.jsonl.gz 5000
+
+実データで計測したい場合は export を保存したファイルをそのまま
+plc_ingest.py に渡せばよい
+    curl "https://plc.directory/export?count=1000" > export.jsonl
+"""
+
+import base64
+import gzip
+import hashlib
+import json
+import random
+import sys
+from datetime import datetime, timedelta
+
+ENDPOINTS = [
+    "https://bsky.social",
+    "https://bsky.social",
+    "https://bsky.social",
+    "https://morel.us-east.host.bsky.network",
+    "https://pds.example.com",
+    "https://localhost:2583",
+    "https://stems.social",
+    "https://self-hosted.example.net",
+]
+
+
+def _b32(seed, length):
+    digest = hashlib.sha256(seed.encode()).digest()
+    return base64.b32encode(digest).decode().lower().rstrip("=")[:length]
+
+
+def make_line(index, created_at, rnd):
+    did = "did:plc:" + _b32(f"did{index}", 24)
+    cid = "bafyrei" + _b32(f"cid{index}", 52)
+    key = "did:key:zQ3sh" + _b32(f"key{index}", 44)
+    handle = f"user{index}.bsky.social"
+    endpoint = rnd.choice(ENDPOINTS)
+    kind = rnd.random()
+    if kind < 0.05:
+        # 初期の create 形式
+        operation = {
+            "sig": _b32(f"sig{index}", 86),
+            "prev": None,
+            "type": "create",
+            "handle": handle,
+            "service": endpoint,
+            "signingKey": key,
+            "recoveryKey": key,
+        }
+    elif kind < 0.55:
+        operation = {
+            "sig": _b32(f"sig{index}", 86),
+            "prev": None,
+            "type": "plc_operation",
+            "services": {
+                "atproto_pds": {
+                    "type": "AtprotoPersonalDataServer",
+                    "endpoint": endpoint,
+                }
+            },
+            "alsoKnownAs": [f"at://{handle}"],
+            "rotationKeys": [key, key],
+            "verificationMethods": {"atproto": key},
+        }
+    elif kind < 0.95:
+        # ハンドル変更やPDS移行などの更新操作
+        operation = {
+            "sig": _b32(f"sig{index}", 86),
+            "prev": "bafyrei" + _b32(f"prev{index}", 52),
+            "type": "plc_operation",
+            "services": {
+                "atproto_pds": {
+                    "type": "AtprotoPersonalDataServer",
+                    "endpoint": endpoint,
+                }
+            },
+            "alsoKnownAs": [f"at://renamed{index}.bsky.social"],
+            "rotationKeys": [key],
+            "verificationMethods": {"atproto": key},
+        }
+    else:
+        operation = {
+            "sig": _b32(f"sig{index}", 86),
+            "prev": "bafyrei" + _b32(f"prev{index}", 52),
+            "type": "plc_tombstone",
+        }
+    line = {
+        "did": did,
+        "operation": operation,
+        "cid": cid,
+        "nullified": False,
+        "createdAt": created_at.isoformat(timespec="milliseconds") + "Z",
+    }
+    return json.dumps(line, separators=(",", ":"))
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "benchmarks/fixtures/plc_export.jsonl.gz"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    rnd = random.Random(0)
+    created_at = datetime(2024, 2, 6, 0, 0, 0)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt") as f:
+        for index in range(count):
+            created_at += timedelta(milliseconds=rnd.randint(1, 400))
+            f.write(make_line(index, created_at, rnd) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+PLC export 取り込み(util.aggregate_users)のベンチマーク
+
+    python benchmarks/plc_ingest.py [fixture] [--repeat N] [--mode streaming|legacy]
+
+fixture の行を1000行ずつのページとして plc.directory/export の代わりに返し、
+lines/sec とピークRSSを表示する。--mode を省略すると両方をそれぞれ
+別プロセスで実行して比較する。
+"""
+
+import argparse
+import bisect
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FIXTURE = os.path.join(ROOT, "benchmarks", "fixtures", "plc_export.jsonl.gz")
+PAGE_SIZE = 1000
+START_CURSOR = "2000-01-01T00:00:00.000Z"
+
+ATP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users
+  (id INTEGER PRIMARY KEY AUTOINCREMENT,
+   did TEXT UNIQUE,
+   handle TEXT,
+   endpoint TEXT,
+   created_at DATETIME
+   );
+CREATE TABLE IF NOT EXISTS user_ranks
+  (created_at DATETIME PRIMARY KEY,
+   rank INTEGER NOT NULL
+   ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_rank_state
+  (id INTEGER PRIMARY KEY CHECK (id = 1),
+   last_user_id INTEGER NOT NULL
+   );
+CREATE TABLE IF NOT EXISTS plc_sync_state
+  (id INTEGER PRIMARY KEY CHECK (id = 1),
+   after TEXT,
+   batch_id INTEGER NOT NULL,
+   updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+   );
+"""
+
+
+def load_lines(path, repeat):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        base = [line.rstrip(b"\n") for line in f if line.strip()]
+    lines = []
+    for n in range(repeat):
+        # 繰り返し分はDIDと時刻をずらして別ユーザーとして扱わせる
+        year = str(2024 + n).encode()
+        for line in base:
+            line = line.replace(b'"did:plc:', b'"did:plc:r%d' % n)
+            line = line.replace(b'"createdAt":"2024', b'"createdAt":"' + year)
+            lines.append(line)
+    created_ats = [json.loads(line)["createdAt"] for line in lines]
+    return lines, created_ats
+
+
+def run(mode, fixture, repeat):
+    lines, created_ats = load_lines(fixture, repeat)
+    workdir = tempfile.mkdtemp(prefix="bench_plc_")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import sqlite3
+    import util
+
+    def page_for(after):
+        start = bisect.bisect_right(created_ats, after or "")
+        return lines[start : start + PAGE_SIZE]
+
+    def iter_did_lines(after=None):
+        yield from page_for(after)
+
+    def get_did_list(after=None):
+        return "\n".join(line.decode() for line in page_for(after))
+
+    connection = sqlite3.connect("atp.db")
+    connection.executescript(ATP_SCHEMA)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if mode == "streaming":
+        util.iter_did_lines = iter_did_lines
+        util.aggregate_users(connection, START_CURSOR)
+    else:
+        legacy_aggregate_users(util, connection, get_did_list, START_CURSOR)
+    elapsed = time.perf_counter() - start
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    inserted = connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    return {
+        "mode": mode,
+        "lines": len(lines),
+        "inserted": inserted,
+        "seconds": round(elapsed, 4),
+        "lines_per_sec": round(len(lines) / elapsed),
+        "peak_rss_kb": rss_after,
+        "peak_rss_growth_kb": rss_after - rss_before,
+    }
+
+
+def legacy_aggregate_users(util, connection, get_did_list, last_created_at):
+    """変更前の aggregate_users と同じ処理(比較用)"""
+    did_list = []
+    while True:
+        did_list_text = get_did_list(last_created_at)
+        did_json_list = did_list_text.split("\n")
+        last_created_at_prev = last_created_at
+        if len(did_list_text) > 0:
+            for did_json in did_json_list:
+                did_dict = json.loads(did_json)
+                createdAt = did_dict["createdAt"].replace("T", " ").replace("Z", "")
+                operation = did_dict["operation"]
+                if operation["type"] == "create":
+                    did_list.append(
+                        (
+                            did_dict["did"].replace("did:plc:", ""),
+                            operation["handle"],
+                            operation["service"],
+                            createdAt,
+                        )
+                    )
+                elif operation["type"] == "plc_operation":
+                    if (
+                        operation["prev"] is None
+                        and "atproto_pds" in operation["services"]
+                        and len(operation["alsoKnownAs"]) > 0
+                    ):
+                        did_list.append(
+                            (
+                                did_dict["did"].replace("did:plc:", ""),
+                                operation["alsoKnownAs"][0].replace("at://", ""),
+                                operation["services"]["atproto_pds"]["endpoint"],
+                                createdAt,
+                            )
+                        )
+            last_created_at = did_dict["createdAt"]
+            if len(did_list) > 10000:
+                util.insert_did_many(connection, did_list)
+                did_list = []
+            if last_created_at == last_created_at_prev:
+                break
+        else:
+            break
+    if len(did_list) > 0:
+        util.insert_did_many(connection, did_list)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fixture", nargs="?", default=DEFAULT_FIXTURE)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--mode", choices=["streaming", "legacy"])
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.mode, os.path.abspath(args.fixture), args.repeat)))
+        return
+
+    for mode in ("legacy", "streaming"):
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                __file__,
+                os.path.abspath(args.fixture),
+                "--repeat",
+                str(args.repeat),
+                "--mode",
+                mode,
+            ]
+        )
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print(
+            f"{result['mode']:>10}: {result['lines']} lines "
+            f"{result['seconds']}s {result['lines_per_sec']} lines/sec "
+            f"inserted={result['inserted']} "
+            f"peak_rss={result['peak_rss_kb']}KB (+{result['peak_rss_growth_kb']}KB)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+ジャーナル(JOURNAL_DIR に記録したもの)を bot.py に流し直すベンチマーク
+
+    python benchmarks/replay.py journal/ [--speed 10] [--gpt-latency]
+
+記録した通知の取得ごとに process_notifications を、タイムラインごとに
+process_timeline を呼ぶ。HTTP は benchmarks/e2e.py と同じく差し替え、
+GPT は記録した答えを返す(--gpt-latency なら記録した時間だけ待つ)。
+--speed 0(既定)は待たずに流す。1 なら記録した間隔どおり、10 なら10倍速。
+結果は e2e.py と同じ形式で benchmarks/results/ に保存するので、
+e2e.py --compare で変更の前後を比べられる。
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+from collections import defaultdict, deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# 流し直している間に、また記録しないようにする
+os.environ["JOURNAL_DIR"] = ""
+
+import e2e  # noqa: E402
+import journal  # noqa: E402
+
+
+def load(path):
+    """(開始の記録, 流す順の [(時刻, 種類, 中身)], GPTの答え, 記録した返信の数)"""
+    start = None
+    events = []
+    answers = defaultdict(deque)
+    recorded_replies = 0
+    for t, kind, data in journal.read(path):
+        if kind == "start":
+            start = start or data
+        elif kind in ("notifications", "timeline"):
+            events.append((t, kind, data))
+        elif kind == "gpt":
+            answers[(data["func"], data["text"])].append(
+                (data["answer"], data["seconds"])
+            )
+        elif kind == "post":
+            # 返信は1回の applyWrites(か createRecord)で1件と数える
+            writes = data.get("writes") or [{}]
+            first = data.get("record") or writes[0].get("value") or {}
+            if first.get("reply"):
+                recorded_replies += 1
+    return start, events, answers, recorded_replies
+
+
+class Replay:
+    def __init__(self, harness, answers, args):
+        self.harness = harness
+        self.answers = answers
+        self.args = args
+        self.gpt_misses = 0
+        import gpt
+
+        gpt.get_answer = self.answer_for("get_answer")
+        gpt.get_answer5 = self.answer_for("get_answer5")
+        gpt.get_answer5_nano = self.answer_for("get_answer5_nano")
+
+    def answer_for(self, func):
+        """記録した答えを順に返す。同じ本文の記録がなければ e2e と同じ文面"""
+
+        def answer(prompt, text, massages=None, deadline=None):
+            recorded = self.answers.get((func, text))
+            if not recorded:
+                self.gpt_misses += 1
+                return e2e.ANSWER
+            answer, seconds = recorded.popleft()
+            if self.args.gpt_latency and self.args.speed > 0:
+                time.sleep(seconds / self.args.speed)
+            return answer
+
+        return answer
+
+    def seed_users(self, events):
+        """
+        status は atp.db の users を読むので、記録に出てくる投稿者を入れておく
+        (登録日時は分からないので e2e と同じ日付)
+        """
+        dids = set()
+        for _, kind, data in events:
+            if kind == "notifications":
+                dids.update(n["author"]["did"] for n in data["notifications"])
+        created_at = e2e.USER_CREATED_AT.strftime("%Y-%m-%d %H:%M:%S.%f")
+        connection = self.harness.bot.connection_atp
+        with connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO users (did, handle, endpoint, created_at)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (did.replace("did:plc:", ""), "", "https://bsky.social", created_at)
+                    for did in dids
+                ],
+            )
+        self.harness.util.update_user_ranks(connection)
+
+    def run(self, events):
+        from dateutil.parser import parse
+
+        bot = self.harness.bot
+        net = self.harness.net
+        session = self.harness.session
+        poll_latencies = []
+        timeline_latencies = []
+        notification_count = timeline_count = 0
+        uris = []
+        seeded = False
+        self.seed_users(events)
+        started = time.perf_counter()
+        first = events[0][0] if events else 0
+        for t, kind, data in events:
+            if self.args.speed > 0:
+                delay = (t - first) / self.args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            if kind == "notifications":
+                if not seeded:
+                    # 記録を始めたときのカーソルから処理する
+                    bot.update_last_processed_notification_time(
+                        parse(data["last_processed_at"])
+                    )
+                    seeded = True
+                net.notifications = data["notifications"]
+                uris.extend(n["uri"] for n in data["notifications"])
+                notification_count += len(data["notifications"])
+                begin = time.perf_counter()
+                bot.process_notifications(session, session.DID, self.harness.dispatch)
+                poll_latencies.append(time.perf_counter() - begin)
+            else:
+                feed = data["feed"]
+                uris.extend(item["post"]["uri"] for item in feed)
+                timeline_count += len(feed)
+                begin = time.perf_counter()
+                now = parse(data["now"])
+                bot.process_timeline(
+                    session, session.DID, now, feed, self.harness.dispatch
+                )
+                timeline_latencies.append(time.perf_counter() - begin)
+        drained = self.harness.wait_idle()
+        elapsed = time.perf_counter() - started
+        replies = self.harness.reply_latencies(uris)
+        return {
+            "replay.notifications": e2e.summarize(
+                notification_count,
+                sum(poll_latencies),
+                poll_latencies,
+                "notifications",
+            ),
+            "replay.timeline": e2e.summarize(
+                timeline_count, sum(timeline_latencies), timeline_latencies, "posts"
+            ),
+            "replay.reply": e2e.summarize(
+                len(replies),
+                elapsed,
+                replies,
+                "replies",
+                drained=drained,
+                gpt_misses=self.gpt_misses,
+            ),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("journal", help="JOURNAL_DIR か、その中の1ファイル")
+    parser.add_argument("--speed", type=float, default=0, help="0 なら待たずに流す")
+    parser.add_argument(
+        "--gpt-latency", action="store_true", help="GPTの応答時間も再現する"
+    )
+    parser.add_argument("--bot-did", help="記録に開始の記録がない場合のボットのDID")
+    parser.add_argument("--bot-handle", help="同じくハンドル")
+    parser.add_argument("--output", help="結果のJSONの保存先")
+    args = parser.parse_args()
+    if args.output:
+        # Harness が一時ディレクトリに移る前に決めておく
+        args.output = os.path.abspath(args.output)
+
+    start, events, answers, recorded_replies = load(args.journal)
+    start = start or {}
+    did = args.bot_did or start.get("did") or e2e.BOT_DID
+    handle = args.bot_handle or start.get("handle") or e2e.BOT_HANDLE
+    print(f"events:{len(events)} bot:{handle} ({did})")
+
+    commit, dirty = e2e.git_commit()
+    harness = e2e.Harness(args, handle, did)
+    replay = Replay(harness, answers, args)
+    # bot.py の print は計測の邪魔なので捨てる
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = replay.run(events)
+    results["replay.reply"]["recorded_replies"] = recorded_replies
+    e2e.print_results(results)
+    print(f"replies: replayed {results['replay.reply']['count']}")
+    print(f"recorded {recorded_replies}, gpt misses {replay.gpt_misses}")
+    e2e.save_results(results, args, commit, dirty, prefix="replay_")
+    # GPTのキューなどのスレッドを待たずに終わる
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
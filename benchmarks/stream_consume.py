@@ -0,0 +1,101 @@
+"""
+イベントストリーム購読(stream.StreamConsumer)のベンチマーク
+
+stand_in/jetstream.py で生成したイベントをローカルの websocket から
+待たずに再生し、絞り込みとバッチ化のスループットを表示する。
+
+    python benchmarks/stream_consume.py --count 200000 --drop-after 50000
+
+--drop-after を付けるとその件数ごとにサーバーが切断し、
+カーソルからの再開と重複除去も合わせて確認できる。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "stand_in"))
+
+import jetstream  # noqa: E402
+import stream  # noqa: E402
+
+
+async def run(args):
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_stream_"), "events.jsonl")
+    jetstream.generate(path, args.count, args.authors, 1700000000000000, 300)
+    events = jetstream.load_events(path)
+    last_time_us = events[-1][0]
+    ready = asyncio.Event()
+    server = asyncio.create_task(
+        jetstream.serve(path, "localhost", args.port, 0, args.drop_after, ready)
+    )
+    await ready.wait()
+
+    # 著者の一部をフォロワーとして扱う
+    followers = {f"did:plc:gen{i:020d}" for i in range(0, args.authors, 10)}
+    batches = []
+    delivered = set()
+    reconnects = []
+
+    def wanted(event):
+        return stream.is_wanted(event, followers, "did:plc:bot", ["Blueskyちゃん"])
+
+    expected = set()
+    for _, _, message in events:
+        event = json.loads(message)
+        if wanted(event):
+            expected.add(stream.post_uri(event))
+
+    def on_batch(batch):
+        batches.append(len(batch))
+        delivered.update(stream.post_uri(event) for event in batch)
+
+    consumer = stream.StreamConsumer(
+        wanted,
+        on_batch,
+        url=f"ws://localhost:{args.port}/subscribe",
+    )
+    original_subscribe_url = consumer.subscribe_url
+
+    def subscribe_url():
+        reconnects.append(consumer.cursor)
+        return original_subscribe_url()
+
+    consumer.subscribe_url = subscribe_url
+    stream.BATCH_WAIT = 0.05
+    stream.RECONNECT_DELAY = 0.1
+
+    started = time.perf_counter()
+    task = asyncio.create_task(consumer.run())
+    while consumer.cursor != last_time_us or consumer.batch:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    task.cancel()
+    server.cancel()
+
+    print(f"events received : {consumer.event_count} (source {len(events)})")
+    print(f"wanted posts    : {len(expected)}")
+    print(f"delivered       : {sum(batches)} in {len(batches)} batches")
+    print(f"missing         : {len(expected - delivered)}")
+    print(f"connections     : {len(reconnects)}")
+    print(f"elapsed         : {elapsed:.2f}s")
+    print(f"throughput      : {consumer.event_count / elapsed:.0f} events/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--authors", type=int, default=5000)
+    parser.add_argument("--port", type=int, default=6018)
+    parser.add_argument("--drop-after", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
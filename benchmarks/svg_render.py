@@ -0,0 +1,98 @@
+"""
+お絵描きのSVG→PNG変換(render.RenderPool)のベンチマーク
+
+    python benchmarks/svg_render.py [dir ...] [--workers N] [--rounds N]
+
+dir の *.svg(省略時は benchmarks/fixtures/svg と images/)を変換して、
+ファイルごとの時間・PNGのサイズ・失敗の理由を表示する。2周目以降は
+キャッシュから返るので、キャッシュの効き目も分かる。
+同時に、変換中もメインのスレッドが止まらないことを確かめるため、
+10ms ごとに起きるスレッドの最大の遅れを表示する。
+
+cairosvg(libcairo)が必要。
+"""
+
+import argparse
+import glob
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import render  # noqa: E402
+
+DEFAULT_DIRS = [
+    os.path.join(ROOT, "benchmarks", "fixtures", "svg"),
+    os.path.join(ROOT, "images"),
+]
+
+
+def load_corpus(dirs):
+    corpus = []
+    for path in dirs:
+        for file in sorted(glob.glob(os.path.join(path, "*.svg"))):
+            with open(file, encoding="utf-8", errors="replace") as f:
+                corpus.append((os.path.relpath(file, ROOT), f.read()))
+    return corpus
+
+
+class LagMonitor(threading.Thread):
+    """interval ごとに起きて、予定より遅れた最大の時間を記録する"""
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.max_lag = 0.0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            time.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dirs", nargs="*", default=DEFAULT_DIRS)
+    parser.add_argument("--workers", type=int, default=render.RENDER_CONCURRENCY)
+    parser.add_argument("--rounds", type=int, default=2)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.dirs)
+    if not corpus:
+        print("no svg files found")
+        return
+    pool = render.RenderPool(workers=args.workers)
+    monitor = LagMonitor()
+    monitor.start()
+
+    total_start = time.perf_counter()
+    for n in range(args.rounds):
+        print(f"--- round {n + 1}")
+        round_start = time.perf_counter()
+        for name, svg in corpus:
+            start = time.perf_counter()
+            try:
+                png = pool.svg_to_png(svg)
+                result = f"{len(png)} bytes"
+            except render.RenderError as e:
+                result = f"error: {e}"
+            elapsed = time.perf_counter() - start
+            print(f"{elapsed * 1000:9.1f} ms  {name}  {result}")
+        print(f"round total: {time.perf_counter() - round_start:.2f}s")
+
+    monitor.running = False
+    print("---")
+    print(f"files: {len(corpus)}  rounds: {args.rounds}  workers: {args.workers}")
+    print(f"total: {time.perf_counter() - total_start:.2f}s")
+    print(f"counts: {pool.counts}")
+    print(f"max main process lag: {monitor.max_lag * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
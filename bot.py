@@ -1,25 +1,62 @@
 import os
 from dotenv import load_dotenv
 import time
-import sqlite3
-from atprototools import Session
-from easydict import EasyDict
 import gpt
 from datetime import datetime, timedelta, timezone
 import pytz
-from dateutil.parser import parse
 import random
 import util
+import db
+import stream
+import context
+import xrpc
+import auth
 import json
 import requests
 import re
-import cairosvg
+import render
+import archive
+import dagcbor
+import metrics
+import journal
+import events
+import scheduler
+import migrations
 from pathlib import Path
 import traceback
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
 
 FORTUNE_CYCLE = 8
 
-connection_atp = sqlite3.connect("atp.db")
+# 処理ごとの時間(stage は関数名)と、取得・反応した投稿の数
+STAGE_SECONDS = metrics.histogram(
+    "bot_stage_seconds", "Time spent in polling, replying and rendering", ("stage",)
+)
+EVENTS = metrics.counter(
+    "bot_events_total",
+    "Notifications and timeline posts by result",
+    ("source", "result"),
+)
+FRIEND_REPLIES = metrics.counter(
+    "bot_friend_replies_total", "Random friend-mode reply draws", ("source", "result")
+)
+REPLIES = metrics.counter("bot_replies_total", "Replies posted", ("kind",))
+RENDERS = metrics.counter("bot_renders_total", "SVG renders by result", ("result",))
+DRAWS_IN_FLIGHT = metrics.gauge("bot_draws_in_flight", "Drawings waiting to render")
+WORK_QUEUE_DEPTH = metrics.gauge(
+    "bot_work_queue_depth", "Handlers queued or running in the runtime"
+)
+ANSWER_QUEUE_DEPTH = metrics.gauge(
+    "bot_answer_queue_depth", "GPT jobs queued or running"
+)
+PENDING_REPLIES = metrics.gauge(
+    "bot_pending_replies", "Posts waiting for a GPT answer or a render"
+)
+
+connection_atp = db.connect("atp.db")
 cur = connection_atp.cursor()
 
 cur.execute(
@@ -33,7 +70,40 @@ CREATE TABLE IF NOT EXISTS users
    )
 """
 )
+
+# created_at ごとの累積ユーザー数(statusコマンドの「何番目のアカウント」用)
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS user_ranks
+  (created_at DATETIME PRIMARY KEY,
+   rank INTEGER NOT NULL
+   ) WITHOUT ROWID
+"""
+)
+
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS user_rank_state
+  (id INTEGER PRIMARY KEY CHECK (id = 1),
+   last_user_id INTEGER NOT NULL
+   )
+"""
+)
+
+# plc.directory/export の取り込み位置(バッチと同じトランザクションで更新)
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS plc_sync_state
+  (id INTEGER PRIMARY KEY CHECK (id = 1),
+   after TEXT,
+   batch_id INTEGER NOT NULL,
+   updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+   )
+"""
+)
 connection_atp.commit()
+# 索引づくりなど時間のかかる変更は Runtime.migrate で起動後に当てる
+migrations.migrate(connection_atp, "atp.db")
 
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path)
@@ -43,8 +113,7 @@ debug = os.getenv("DEBUG", False) == "true"
 username = os.environ.get("BOT_HANDLE")
 password = os.environ.get("BOT_PASSWORD")
 
-connection = sqlite3.connect("bluesky_bot.db")
-connection.row_factory = sqlite3.Row
+connection = db.connect("bluesky_bot.db")
 cur = connection.cursor()
 
 cur.execute(
@@ -130,29 +199,107 @@ END;
 """
 )
 
+# イベントストリーム(TIMELINE_SOURCE=stream)の再開位置
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS stream_cursor
+  (id INTEGER PRIMARY KEY CHECK (id = 1),
+   cursor INTEGER NOT NULL,
+   updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+   )
+"""
+)
+
+# 反応した投稿の台帳。通知とタイムラインのどちらから来ても1回だけ反応する
+# state: claimed(処理中) -> generated(返信文ができた) -> posted / skipped
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS reply_ledger
+  (uri TEXT PRIMARY KEY,
+   did TEXT NOT NULL,
+   source TEXT NOT NULL,
+   state TEXT NOT NULL,
+   owner TEXT NOT NULL,
+   line TEXT NOT NULL,
+   answer TEXT,
+   image_path TEXT,
+   created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+   )
+"""
+)
+
+cur.execute(
+    """
+CREATE INDEX IF NOT EXISTS reply_ledger_state
+  ON reply_ledger (state, updated_at)
+"""
+)
+# 返信を投稿するときのレコードキー(TID の JSON 配列)。返信文と一緒に保存しておき、
+# 投稿の途中で落ちても同じキーで投稿し直して二重に投稿しない
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS reply_rkeys
+  (uri TEXT PRIMARY KEY,
+   rkeys TEXT NOT NULL
+   ) WITHOUT ROWID
+"""
+)
+
+# お絵描きの返信はSVGとコメントを保存しておき、落ちても描き直してから投稿する
+# (返信文だけを投稿し直すと、絵もポイントの消費もない返信になる)
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS reply_drawings
+  (uri TEXT PRIMARY KEY,
+   svg TEXT NOT NULL,
+   answer TEXT NOT NULL
+   ) WITHOUT ROWID
+"""
+)
+
+# フォロー(follow)・フォロワー(follower)の一覧。通知で追加し、定期的に全件と突き合わせる
+cur.execute(
+    """
+CREATE TABLE IF NOT EXISTS follow_graph
+  (did TEXT NOT NULL,
+   relation TEXT NOT NULL,
+   handle TEXT,
+   updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   PRIMARY KEY (did, relation)
+   ) WITHOUT ROWID
+"""
+)
+connection.commit()
+migrations.migrate(connection, "bluesky_bot.db")
+
 
 def login(username, password):
-    now = datetime.now(pytz.utc)
-    if not debug:
-        if os.path.exists("login.txt"):
-            with open("login.txt", mode="r") as f:
-                last_line = (f.readlines()[-1]).strip()
-            dt = datetime.fromisoformat(last_line)
-            delta = now - dt
-            if delta < timedelta(minutes=5):
-                wait_time = (timedelta(minutes=5) - delta).total_seconds()
-                print(f"login wait:{wait_time}")
-                time.sleep(wait_time)
-
-    session = Session(username, password)
-    with open("login.txt", mode="a") as f:
-        f.write(f"{now}\n")
-    print(f"login at:{now}", session)
+    """
+    保存したトークンがあれば使い回し、期限切れなら更新、それもできなければパスワードでログインする
+    返すセッションは全スレッドで共有し、トークンは期限の前に自動で更新される
+    """
+    session = auth.SessionManager(username, password, throttle=not debug)
+    session.ensure_fresh()
+    print(f"session did:{session.DID}")
     return session
 
 
+def release_db():
+    """
+    ネットワークを待つ前に bluesky_bot.db の書き込みをコミットする
+    ハンドラの unit_of_work の中でも、書き込みのロックを持ったまま応答を待たない
+    """
+    db.commit_pending(connection)
+
+
 def get_did(session, username):
-    response = session.resolveHandle(username)
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    response = xrpc.client.get(
+        session.ATP_HOST + "/xrpc/com.atproto.identity.resolveHandle",
+        params={"handle": username},
+        headers=headers,
+    )
     return json.loads(response.text)["did"]
 
 
@@ -165,7 +312,7 @@ def get_last_processed_notification_time():
         )
         row = cur.fetchone()
         if row:
-            return parse(row["last_processed_at"])
+            return events.parse_time(row["last_processed_at"])
         else:
             # 初回起動時：現在時刻をDBに記録して返す
             current_time = datetime.now(pytz.utc)
@@ -180,8 +327,37 @@ def get_last_processed_notification_time():
         return datetime.now(pytz.utc)
 
 
-def update_last_processed_notification_time(processed_at):
-    """最後に処理したNotificationの時刻を更新"""
+def get_notification_backlog():
+    """
+    遡りきれなかったNotificationの続きのカーソルと、それまでに処理した最も新しい時刻
+    遡りきっていれば (None, None)
+    """
+    cur = connection.cursor()
+    cur.execute("SELECT cursor FROM notification_cursor ORDER BY id DESC LIMIT 1")
+    row = cur.fetchone()
+    if not row or not row["cursor"]:
+        return None, None
+    try:
+        backlog = json.loads(row["cursor"])
+        return backlog["cursor"], events.parse_time(backlog["newest_at"])
+    except (ValueError, TypeError, KeyError):
+        # 以前は続きを読まずにカーソルだけを書いていた。その時刻はもう分からない
+        return row["cursor"], None
+
+
+def update_last_processed_notification_time(processed_at, cursor=None, newest_at=None):
+    """
+    最後に処理したNotificationの時刻(これより前はすべて処理済み)を更新
+    cursor には取得を打ち切ったページのカーソル(遡りきった場合はNone)と、
+    それまでに処理した最も新しい時刻 newest_at を JSON で記録する
+    """
+    if cursor is not None:
+        cursor = json.dumps(
+            {
+                "cursor": cursor,
+                "newest_at": (newest_at or processed_at).isoformat(),
+            }
+        )
     try:
         cur = connection.cursor()
         # 既存レコードがあるかチェック
@@ -191,20 +367,40 @@ def update_last_processed_notification_time(processed_at):
         if row:
             # 更新
             cur.execute(
-                "UPDATE notification_cursor SET last_processed_at = ? WHERE id = ?",
-                (processed_at.isoformat(), row["id"]),
+                "UPDATE notification_cursor SET last_processed_at = ?, cursor = ? WHERE id = ?",
+                (processed_at.isoformat(), cursor, row["id"]),
             )
         else:
             # 新規作成
             cur.execute(
-                "INSERT INTO notification_cursor (last_processed_at) VALUES (?)",
-                (processed_at.isoformat(),),
+                "INSERT INTO notification_cursor (last_processed_at, cursor) VALUES (?, ?)",
+                (processed_at.isoformat(), cursor),
             )
         connection.commit()
     except Exception as e:
         print(f"Error updating last processed notification time: {e}")
 
 
+def get_stream_cursor():
+    """イベントストリームを最後に処理した位置(time_us)を取得"""
+    cur = connection.cursor()
+    cur.execute("SELECT cursor FROM stream_cursor WHERE id = 1")
+    row = cur.fetchone()
+    return row["cursor"] if row else None
+
+
+def update_stream_cursor(cursor):
+    cur = connection.cursor()
+    cur.execute(
+        """
+    INSERT INTO stream_cursor (id, cursor) VALUES (1, :cursor)
+      ON CONFLICT(id) DO UPDATE SET cursor = :cursor, updated_at = CURRENT_TIMESTAMP
+    """,
+        {"cursor": cursor},
+    )
+    connection.commit()
+
+
 def get_notifications(session, limit=50, cursor=None):
     """Bluesky Notificationを取得する"""
     try:
@@ -217,7 +413,7 @@ def get_notifications(session, limit=50, cursor=None):
         if cursor:
             url += f"&cursor={cursor}"
 
-        response = requests.get(url, headers=headers)
+        response = xrpc.client.get(url, headers=headers)
 
         if response.status_code == 200:
             data = json.loads(response.text)
@@ -236,16 +432,72 @@ def get_notifications(session, limit=50, cursor=None):
         return None
 
 
+NOTIFICATION_PAGE_SIZE = 100
+# 1回の取得で遡る最大ページ数
+MAX_NOTIFICATION_PAGES = int(os.getenv("MAX_NOTIFICATION_PAGES", 20))
+
+
+def drain_notifications(session, last_processed_at, cursor=None):
+    """
+    last_processed_at より新しいNotificationをカーソルで遡って全ページ取得する
+    cursor を渡すとそのページから遡る
+    (新しい順のリスト, 打ち切った場合の次のカーソル) を返す。取得に失敗したらNone
+    """
+    notifications = []
+    for _ in range(MAX_NOTIFICATION_PAGES):
+        notifications_data = get_notifications(
+            session, limit=NOTIFICATION_PAGE_SIZE, cursor=cursor
+        )
+        if not notifications_data:
+            print("[ERROR] notifications_data is None or empty")
+            return None
+        if "notifications" not in notifications_data:
+            print(
+                f"[ERROR] 'notifications' key not found in data. Keys: {list(notifications_data.keys())}"
+            )
+            return None
+
+        page = notifications_data["notifications"]
+        notifications.extend(page)
+        cursor = notifications_data.get("cursor")
+        if not page or cursor is None:
+            return notifications, None
+        # ページの最後(最も古いもの)が処理済みなら、それより前は不要
+        if events.parse_time(page[-1]["indexedAt"]) <= last_processed_at:
+            return notifications, None
+
+    print(
+        f"[WARN] notification backlog exceeds {MAX_NOTIFICATION_PAGES} pages, older ones are fetched next time"
+    )
+    return notifications, cursor
+
+
+def update_seen(session, seen_at):
+    """ここまでのNotificationを既読にする(取得ごとに1回だけ呼ぶ)"""
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    response = xrpc.client.post(
+        session.ATP_HOST + "/xrpc/app.bsky.notification.updateSeen",
+        json={"seenAt": seen_at},
+        headers=headers,
+    )
+    if response.status_code != 200:
+        print(f"[ERROR] Failed to update seen: {response.status_code}, {response.text}")
+
+
 def post(session, text):
     print(text)
-    session.postBloot(text)
-    pass
+    post_image(session, text, None)
 
 
-def reply_to(session, text, eline, image_path=None):
+@metrics.timed(STAGE_SECONDS)
+def reply_to(session, text, eline, image_path=None, image=None, rkeys=None):
+    """
+    image_path のファイルか、image(PNGのバイト列)を添付して返信する
+    rkeys は投稿し直すときに前回と同じレコードキーを使うためのもの
+    """
     root_cid = None
     root_uri = None
-    if "reply" in eline:
+    if eline.reply is not None:
         root_cid = eline.reply.root.cid
         root_uri = eline.reply.root.uri
 
@@ -257,54 +509,121 @@ def reply_to(session, text, eline, image_path=None):
     reply = {"cid": eline.post.cid, "uri": eline.post.uri}
     reply_ref = {"root": root, "parent": reply}
     chunk_size = 280
-    for i in range(0, len(text), chunk_size):
-        chunk = text[i : i + chunk_size]
-        if i == 0 and image_path:
-            response = post_image(session, chunk, image_path, reply_to=reply_ref)
-        else:
-            print(chunk)
-            response = session.postBloot(chunk, reply_to=reply_ref)
-        reply = json.loads(response.text)
-        reply_ref["parent"] = reply
+    chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+    if rkeys is None or len(rkeys) != len(chunks):
+        rkeys = [dagcbor.make_tid() for _ in chunks]
+    # 落ちても同じ返信文・同じレコードキーで投稿し直せるよう、投稿前に台帳へ保存して
+    # ハンドラの途中でもコミットしておく
+    util.mark_reply_generated(connection, eline.post.uri, text, image_path, rkeys)
+    release_db()
+    if image_path and image is None:
+        with open(image_path, "rb") as f:
+            image = f.read()
+    embed = image_embed(session, image) if image is not None else None
+    # 分割した返信はCIDを手元で計算してつなげ、1回の applyWrites でまとめて投稿する
+    writes = []
+    for i, (chunk, rkey) in enumerate(zip(chunks, rkeys)):
+        print(chunk)
+        record = build_post(chunk, reply_ref, embed if i == 0 else None)
+        writes.append(
+            {
+                "$type": "com.atproto.repo.applyWrites#create",
+                "collection": "app.bsky.feed.post",
+                "rkey": rkey,
+                "value": record,
+            }
+        )
+        parent = {
+            "uri": f"at://{session.DID}/app.bsky.feed.post/{rkey}",
+            "cid": dagcbor.cid_for(record),
+        }
+        reply_ref = {"root": root, "parent": parent}
+    post_thread(session, writes)
+    REPLIES.inc("image" if embed else "text")
+    util.mark_reply_posted(connection, eline.post.uri)
     did = eline.post.author.did.replace("did:plc:", "")
-    util.insert_user_dialog(connection, did, eline.post.record.text)
-    bot_text = text if image_path is None else text + " (添付画像あり)"
-    util.insert_bot_dialog(connection, did, bot_text)
+    user_text = eline.post.record.text
+    user_id = util.insert_user_dialog(connection, did, user_text)
+    has_image = image_path is not None or image is not None
+    bot_text = text if not has_image else text + " (添付画像あり)"
+    bot_id = util.insert_bot_dialog(connection, did, bot_text)
 
+    # 取り消された会話がキャッシュに残らないよう、コミットできてから追加する
+    def append_dialogs():
+        context.append_dialog(did, "user", user_text, user_id)
+        context.append_dialog(did, "assistant", bot_text, bot_id)
 
-def post_image(
-    session, postcontent, image_path, reply_to=None, content_type="image/png"
-):
-    """Post a bloot."""
+    db.after_commit(connection, append_dialogs)
+
+
+def build_post(postcontent, reply_to=None, embed=None):
+    """app.bsky.feed.post のレコードを作る"""
     timestamp = datetime.now(timezone.utc)
     print("timestamp:", timestamp.isoformat())
     timestamp = timestamp.isoformat().replace("+00:00", "Z")
     print("timestamp:", timestamp)
+    record = {
+        "$type": "app.bsky.feed.post",
+        "createdAt": timestamp,
+        "text": postcontent,
+    }
+    if embed:
+        record["embed"] = embed
+    if reply_to:
+        record["reply"] = reply_to
+    return record
 
+
+def image_embed(session, image, content_type="image/png"):
+    """画像をアップロードして、投稿に添付する embed を返す"""
+    image_resp = upload_blob(session, image, content_type)
+    print(image_resp.json())
+    return {
+        "$type": "app.bsky.embed.images",
+        "images": [{"alt": "", "image": image_resp.json().get("blob")}],
+    }
+
+
+def post_thread(session, writes):
+    """
+    build_post で作ったレコードを applyWrites で1回のリクエストで投稿する
+    PDSが返したCIDが手元で計算したものと違えば、つながりが切れるので知らせる
+    """
+    response = apply_writes(session, writes)
+    for write, result in zip(writes, response.get("results", [])):
+        cid = dagcbor.cid_for(write["value"])
+        if result.get("cid") and result["cid"] != cid:
+            print(
+                f"[post] cid mismatch for {result.get('uri')}: "
+                f"{result['cid']} != {cid}"
+            )
+    return response
+
+
+def post_image(
+    session,
+    postcontent,
+    image_path,
+    reply_to=None,
+    content_type="image/png",
+    image=None,
+):
+    """Post a bloot. 画像は image_path のファイルか image のバイト列"""
     headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
 
+    if image_path and image is None:
+        with open(image_path, "rb") as f:
+            image = f.read()
+    embed = image_embed(session, image, content_type) if image is not None else None
     data = {
         "collection": "app.bsky.feed.post",
         "$type": "app.bsky.feed.post",
         "repo": "{}".format(session.DID),
-        "record": {
-            "$type": "app.bsky.feed.post",
-            "createdAt": timestamp,
-            "text": postcontent,
-        },
+        "record": build_post(postcontent, reply_to, embed),
     }
-
-    if image_path:
-        data["record"]["embed"] = {}
-        image_resp = session.uploadBlob(image_path, content_type)
-        data["record"]["embed"]["$type"] = "app.bsky.embed.images"
-        data["record"]["embed"]["images"] = [
-            {"alt": "", "image": image_resp.json().get("blob")}
-        ]
-        print(image_resp.json())
-    if reply_to:
-        data["record"]["reply"] = reply_to
-    resp = requests.post(
+    journal.record("post", {"endpoint": "createRecord", "record": data["record"]})
+    release_db()
+    resp = xrpc.client.post(
         session.ATP_HOST + "/xrpc/com.atproto.repo.createRecord",
         json=data,
         headers=headers,
@@ -313,11 +632,97 @@ def post_image(
     return resp
 
 
+def upload_blob(session, blob, content_type):
+    """blob(バイト列)をそのままアップロードする"""
+    release_db()
+    headers = {
+        "Authorization": "Bearer " + session.ATP_AUTH_TOKEN,
+        "Content-Type": content_type,
+    }
+    journal.record("post", {"endpoint": "uploadBlob", "size": len(blob)})
+    return xrpc.client.post(
+        session.ATP_HOST + "/xrpc/com.atproto.repo.uploadBlob",
+        data=blob,
+        headers=headers,
+    )
+
+
 def get_profile(session, handle):
-    response = session.get_profile(handle)
+    release_db()
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    response = xrpc.client.get(
+        session.ATP_HOST + "/xrpc/app.bsky.actor.getProfile",
+        params={"actor": handle},
+        headers=headers,
+    )
     return json.loads(response.text)
 
 
+def record_exists(session, collection, rkey):
+    """自分のリポジトリに collection/rkey のレコードがあるか"""
+    release_db()
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    response = xrpc.client.get(
+        session.ATP_HOST + "/xrpc/com.atproto.repo.getRecord",
+        params={"repo": session.DID, "collection": collection, "rkey": rkey},
+        headers=headers,
+    )
+    if response.status_code == 200:
+        return True
+    if response.status_code in (400, 404):
+        return False
+    response.raise_for_status()
+    return False
+
+
+def get_posts(session, uris):
+    """app.bsky.feed.getPosts で投稿をまとめて取得する(最大25件)"""
+    release_db()
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    response = xrpc.client.get(
+        session.ATP_HOST + "/xrpc/app.bsky.feed.getPosts",
+        params=[("uris", uri) for uri in uris],
+        headers=headers,
+    )
+    response.raise_for_status()
+    return json.loads(response.text)["posts"]
+
+
+def build_stream_feed(session, events):
+    """
+    ストリームのイベントから getTimeline と同じ形式のフィードを作る
+    リプライの場合は親の投稿も取得して reply.parent に入れる
+    """
+    uris = [stream.post_uri(event) for event in events]
+    parent_uris = []
+    for event in events:
+        reply = event["commit"].get("record", {}).get("reply")
+        if reply and reply["parent"]["uri"] not in uris + parent_uris:
+            parent_uris.append(reply["parent"]["uri"])
+
+    posts = {}
+    all_uris = uris + parent_uris
+    for i in range(0, len(all_uris), stream.BATCH_SIZE):
+        for post_view in get_posts(session, all_uris[i : i + stream.BATCH_SIZE]):
+            posts[post_view["uri"]] = post_view
+
+    feed = []
+    for uri in uris:
+        post_view = posts.get(uri)
+        if post_view is None:
+            # 削除済みなど
+            continue
+        item = {"post": post_view}
+        reply = post_view["record"].get("reply")
+        if reply:
+            parent = posts.get(reply["parent"]["uri"])
+            if parent is None:
+                continue
+            item["reply"] = {"root": reply["root"], "parent": parent}
+        feed.append(item)
+    return sorted(feed, key=lambda x: events.parse_time(x["post"]["indexedAt"]))
+
+
 def _get_follows(session, handle, limit=100, cursor=None):
     headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
 
@@ -328,7 +733,7 @@ def _get_follows(session, handle, limit=100, cursor=None):
     if cursor:
         url += f"&cursor={cursor}"
 
-    response = requests.get(url, headers=headers)
+    response = xrpc.client.get(url, headers=headers)
 
     return json.loads(response.text)
 
@@ -343,7 +748,7 @@ def _get_followers(session, handle, limit=100, cursor=None):
     if cursor:
         url += f"&cursor={cursor}"
 
-    response = requests.get(url, headers=headers)
+    response = xrpc.client.get(url, headers=headers)
 
     return json.loads(response.text)
 
@@ -401,20 +806,82 @@ def is_follower(session, bot_handle, did, followers):
     return folowed
 
 
+# フォロワーをフォローし返すか
+FOLLOW_BACK = os.getenv("FOLLOW_BACK", "0") == "1"
+# applyWrites 1回でまとめて書くフォローの数
+FOLLOW_BATCH_SIZE = 100
+# 直近にフォローした分は getFollows への反映を待つ
+FOLLOW_SYNC_GRACE = timedelta(minutes=10)
+
+
+def apply_writes(session, writes):
+    """com.atproto.repo.applyWrites で自分のリポジトリに複数のレコードをまとめて書く"""
+    release_db()
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    journal.record("post", {"endpoint": "applyWrites", "writes": writes})
+    response = xrpc.client.post(
+        session.ATP_HOST + "/xrpc/com.atproto.repo.applyWrites",
+        json={"repo": session.DID, "writes": writes},
+        headers=headers,
+        timeout=(15, 60),
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def follow_back(session, dids):
+    """dids をフォローし、フォロー一覧に記録する"""
+    for i in range(0, len(dids), FOLLOW_BATCH_SIZE):
+        batch = dids[i : i + FOLLOW_BATCH_SIZE]
+        created_at = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        writes = [
+            {
+                "$type": "com.atproto.repo.applyWrites#create",
+                "collection": "app.bsky.graph.follow",
+                "value": {
+                    "$type": "app.bsky.graph.follow",
+                    "subject": did,
+                    "createdAt": created_at,
+                },
+            }
+            for did in batch
+        ]
+        apply_writes(session, writes)
+        util.add_follow_graph(connection, "follow", [(did, None) for did in batch])
+        print(f"follow back:{len(batch)}")
+
+
 def update_follow(session, bot_handle):
+    """
+    フォロー・フォロワーの全件をDBの一覧と突き合わせ、差分だけを書く
+    FOLLOW_BACK が有効なら、フォローしていないフォロワーをまとめてフォローする
+    一覧を取得できなければ False
+    """
+    keep_after = (datetime.utcnow() - FOLLOW_SYNC_GRACE).strftime("%Y-%m-%d %H:%M:%S")
     bot_follows = get_follows(session, bot_handle)
     bot_followers = get_followers(session, bot_handle)
-    if bot_follows and bot_followers:
-        # unfollows = [item for item in bot_follows if item not in bot_followers]
-        followbacks = [item for item in bot_followers if item[1] not in bot_follows]
-        print(f"bot_follows:{len(bot_follows)} bot_followers:{len(bot_followers)}")
-        for handle in followbacks:
-            print(f"follow back:{handle}")
-            response = session.follow(
-                username=None, did_of_person_you_wanna_follow=handle[1]
-            )
-            print(f"follow back:{handle}:{response}")
-            time.sleep(0.05)
+    if bot_follows is None or bot_followers is None:
+        return False
+    print(f"bot_follows:{len(bot_follows)} bot_followers:{len(bot_followers)}")
+    added, removed = util.sync_follow_graph(
+        connection, "follow", [(did, None) for did in bot_follows], keep_after
+    )
+    print(f"follows +{added} -{removed}")
+    added, removed = util.sync_follow_graph(
+        connection, "follower", [(did, handle) for handle, did in bot_followers]
+    )
+    print(f"followers +{added} -{removed}")
+    if FOLLOW_BACK:
+        follow_back(session, util.get_follow_backs(connection))
+    return True
+
+
+def add_followers(session, followers):
+    """follow の通知で来たフォロワーを一覧に追加し、必要ならフォローし返す"""
+    util.add_follow_graph(connection, "follower", followers)
+    if FOLLOW_BACK:
+        follows = util.get_follow_graph(connection, "follow")
+        follow_back(session, [did for did, _ in followers if did not in follows])
 
 
 def get_fortune_text(name, user_text):
@@ -437,15 +904,28 @@ def get_fortune_text(name, user_text):
     return text
 
 
+# 応答を待っている占い。占いは返信できてから記録するので、待つ間に同じ人から
+# 来た占いはここで止める
+fortunes_in_flight = set()
+fortunes_in_flight_lock = threading.Lock()
+
+
 def fortune(connection, session, prompt, name, settings, eline):
     row = util.get_latest_record_by_did(connection, eline.post.author.did)
     did = eline.post.author.did.replace("did:plc:", "")
+    with fortunes_in_flight_lock:
+        in_flight = did in fortunes_in_flight
+    if in_flight:
+        util.put_command_log(did, "fortune", "in_flight")
+        answer = f"{name}様の占いはただいま準備しておりますわ。少々お待ち遊ばせ。"
+        reply_to(session, answer, eline)
+        return
     fortuneOk = False
     use_point = False
     user_text = eline.post.record.text
     if row:
         now = datetime.now(pytz.utc)
-        created_at = parse(row["created_at"])
+        created_at = events.parse_time(row["created_at"])
         if (now - created_at) >= timedelta(hours=FORTUNE_CYCLE):
             fortuneOk = True
         else:
@@ -485,30 +965,57 @@ def fortune(connection, session, prompt, name, settings, eline):
         )
         text = get_fortune_text(name, user_text)
         print("fortune")
-        answer = gpt.get_answer(prompt, text)
-        util.record_reaction(connection, eline)
-        update_point = False
-        if use_point:
-            settings["points"] -= 1
-            answer += f'\n\n{name}様の残りBluesky Pointは{settings["points"]}になりましたわね。'
-            update_point = True
-        else:
-            # ランダムでBlueskuy Pointを付与
-            percent = random.uniform(0, 100)
-            if percent < 20:
-                point = random.randint(1, 10)
-                settings["points"] += point
-                settings["all_points"] += point
-                answer += (
-                    f"\nあら素敵、Bluesky Pointが{point}ポイント降ってきましたわ🎀"
-                )
-                answer += f'\n{name}様の残りBluesky Pointは{settings["points"]}になりましたわ🎀'
+        with fortunes_in_flight_lock:
+            fortunes_in_flight.add(did)
+
+        def on_answer(answer):
+            try:
+                reply_fortune(answer)
+            finally:
+                with fortunes_in_flight_lock:
+                    fortunes_in_flight.discard(did)
+
+        def reply_fortune(answer):
+            if answer is None:
+                # 占えなかったときは記録せず、すぐにまた占えるようにする
+                print("fortune: no answer")
+                answer = f"{name}様、今は占いの結果が見えませんでしたわ。ポイントは消費していないので、少し間を空けてからまたお声がけくださいまし。"
+                reply_to(session, answer, eline)
+                return
+            # 応答を待つ間にポイントが変わっているかもしれないので読み直す
+            settings = util.get_user_settings(connection, did)
+            update_point = False
+            if use_point:
+                settings["points"] -= 1
+                answer += f'\n\n{name}様の残りBluesky Pointは{settings["points"]}になりましたわね。'
                 update_point = True
+            else:
+                # ランダムでBlueskuy Pointを付与
+                percent = random.uniform(0, 100)
+                if percent < 20:
+                    point = random.randint(1, 10)
+                    settings["points"] += point
+                    settings["all_points"] += point
+                    answer += (
+                        f"\nあら素敵、Bluesky Pointが{point}ポイント降ってきましたわ🎀"
+                    )
+                    answer += f'\n{name}様の残りBluesky Pointは{settings["points"]}になりましたわ🎀'
+                    update_point = True
 
-        print(answer)
-        reply_to(session, answer, eline)
-        if update_point:
-            util.update_user_settings(connection, did, settings)
+            print(answer)
+            reply_to(session, answer, eline)
+            # 返信できた占いだけを記録する(次に占えるまでの間隔はここから数える)
+            util.record_reaction(connection, eline)
+            if update_point:
+                util.update_user_settings(connection, did, settings)
+
+        ask(
+            eline.post.author.did,
+            gpt.get_answer,
+            (prompt, text),
+            on_answer,
+            uri=eline.post.uri,
+        )
 
 
 def status(connection_atp, connection, session, name, settings, eline):
@@ -605,8 +1112,134 @@ def silent(connection, did, name):
     return text
 
 
-def draw(connection, prompt, name, did, settings, eline):
-    if settings["points"] < 5:
+# お絵描きで消費するポイント
+DRAW_POINTS = 5
+# 描いている途中のお絵描きが押さえているポイント(DIDごと)
+# ポイントは返信できてから消費するので、描いている間に来たお絵描きは
+# 押さえてある分を除いた残りで受け付ける
+draw_points_reserved = {}
+draw_points_lock = threading.Lock()
+
+
+def reserve_draw_points(did, settings):
+    """お絵描き1回分のポイントを押さえる。足りなければ False"""
+    with draw_points_lock:
+        reserved = draw_points_reserved.get(did, 0)
+        if settings["points"] - reserved < DRAW_POINTS:
+            return False
+        draw_points_reserved[did] = reserved + DRAW_POINTS
+        return True
+
+
+def release_draw_points(did):
+    """押さえていたポイントを戻す。消費した場合も、消費した後で呼ぶ"""
+    with draw_points_lock:
+        reserved = draw_points_reserved.get(did, 0) - DRAW_POINTS
+        if reserved > 0:
+            draw_points_reserved[did] = reserved
+        else:
+            draw_points_reserved.pop(did, None)
+
+
+# 描いた絵の変換と投稿は専用のスレッドで待ち、GPTの応答やハンドラの枠を塞がない
+draw_executor = ThreadPoolExecutor(
+    render.RENDER_CONCURRENCY * 2, thread_name_prefix="draw"
+)
+
+
+def render_and_reply(connection, session, name, did, eline, svg, answer, rkeys=None):
+    """SVGを別プロセスでPNGにして、ポイントを消費して返信する"""
+    # 変換には数秒かかるので、その間も書き込みのロックを持たない
+    release_db()
+    try:
+        with STAGE_SECONDS.time("render"):
+            png = render.svg_to_png(svg)
+        RENDERS.inc("ok")
+    except render.RenderError as e:
+        RENDERS.inc("error")
+        print(f"draw: {e}")
+        # 描き直しても同じなので、落ちても描き直さずこの返信を投稿し直す
+        util.delete_reply_drawing(connection, eline.post.uri)
+        answer = "残念ながら、うまく描けませんでしたわ。ポイントは消費していないのでご安心くださいまし。少し間を空けてからまたお声がけくださいまし。"
+        reply_to(session, answer, eline)
+        return
+    points = util.get_user_settings(connection, did)["points"] - DRAW_POINTS
+    answer += f"\n\n{name}様の残りBluesky pointは{points}になりましたわ。\n\n#blueskychandraw"
+    # ファイルには書かず、メモリ上のPNGをそのままアップロードする
+    reply_to(session, answer, eline, image=png, rkeys=rkeys)
+    # ポイントは返信できてから消費する
+    # 応答を待つ間にポイントが変わっているかもしれないので読み直す
+    settings = util.get_user_settings(connection, did)
+    settings["points"] -= DRAW_POINTS
+    util.update_user_settings(connection, did, settings)
+    # 保存する場合も返信の後で行う
+    now = datetime.utcnow()
+    archive.save_drawing(f"{now}_{eline.post.author.did}", png, svg)
+
+
+def submit_draw(connection, session, name, did, eline, svg, answer, rkeys=None):
+    """ポイントを押さえてから呼ぶ。描けたかどうかにかかわらず、終わったら戻す"""
+    uri = eline.post.uri
+    # 描いている途中で落ちても、GPTに聞き直さずにこのSVGから描き直す
+    util.mark_reply_drawing(connection, uri, svg, answer)
+    hold_reply(uri)
+    DRAWS_IN_FLIGHT.inc()
+
+    def run():
+        try:
+            run_handler(
+                render_and_reply,
+                connection,
+                session,
+                name,
+                did,
+                eline,
+                svg,
+                answer,
+                rkeys,
+            )
+        finally:
+            # 描けなかったときは消費せずに戻し、描けたときは消費してから戻す
+            release_draw_points(did)
+            DRAWS_IN_FLIGHT.dec()
+            release_reply(uri)
+
+    draw_executor.submit(run)
+
+
+def resume_draw(session, eline, drawing, rkeys=None):
+    """落ちる前に返信できていなかったお絵描きを、保存しておいたSVGから描き直す"""
+    did = eline.post.author.did.replace("did:plc:", "")
+    name = (
+        eline.post.author.display_name
+        if eline.post.author.display_name is not None
+        else eline.post.author.handle.split(".", 1)[0]
+    )
+    settings = util.get_user_settings(connection, did)
+    if not reserve_draw_points(did, settings):
+        # 落ちている間にポイントを使っていた
+        util.delete_reply_drawing(connection, eline.post.uri)
+        answer = f"お絵描きはBluesky Pointが{DRAW_POINTS}ポイント必要なのですわ。\n{name}様のBluesky Pointは{settings['points']}なので残念ながら足りないのですわ。"
+        reply_to(session, answer, eline)
+        return
+    submit_draw(
+        connection,
+        session,
+        name,
+        did,
+        eline,
+        drawing["svg"],
+        drawing["answer"],
+        rkeys,
+    )
+
+
+def draw(connection, session, prompt, name, did, settings, eline):
+    """
+    お絵描きを受け付ける。すぐに返信する文面があれば (answer, image_path) で返す
+    描いた絵は応答が来てから返信する
+    """
+    if settings["points"] < DRAW_POINTS:
         return (
             f"お絵描きはBluesky Pointが5ポイント必要なのですわ。\n{name}様のBluesky Pointは{settings['points']}なので残念ながら足りないのですわ。\nfriendモードでもっとわたくしとお話しましょう🎀",
             "",
@@ -623,39 +1256,61 @@ def draw(connection, prompt, name, did, settings, eline):
     if len(matches) > 0:
         target = matches[0]
         print(target)
+        # 描いている途中のお絵描きと合わせてポイントが足りるかを見て、押さえる
+        if not reserve_draw_points(did, settings):
+            util.put_command_log(did, "draw", "in_flight")
+            return (
+                f"{name}様のお絵描きをただいま描いておりますわ。描き上がるまで少々お待ち遊ばせ。",
+                "",
+            )
         prompt = f"あなたはsvgで絵を描く才能があります。数々のsvgのコードを書いた経験がある猛者です。どんなものであろうとsvgで表現しようと試みます。{personality}"
         text = f"svgを使って'{target}'を描くコードをください。{target}に含まれる特徴をパーツに分解し、パーツ毎にパーツに合う適切な色をカラフルに塗ってパーツを組み合わせて絵を構成してください。パーツ毎にどこの部分なのかをコメントを入れてください。コメントはSVGの中に入れないでください。返信のコードはsvgタグだけにしてください。この作品のBluesky(あなた)らしさがどこに現れているか、どこに苦労したかをsvgタグの後にお嬢様言葉で自信満々に書いてください。コメントの長さは300文字以内に収まるようにしてください。textのfontはNoto Sans JPを使用してください。"
         util.put_command_log(
             eline.post.author.did.replace("did:plc:", ""), "draw", "exec"
         )
-        answer = gpt.get_answer5_nano(prompt, text)
-        pattern = r".*(<svg.*</svg>)(.*)"
-        matches = re.findall(pattern, answer, flags=re.DOTALL)
-        if len(matches) > 0:
-            svg = matches[0][0]
-            print(svg)
-            answer = matches[0][1]
-            answer = (
-                answer.replace("```", "")
-                .replace("</body>", "")
-                .replace("</html>", "")
-                .strip()
-            )
-            print(answer)
-            now = datetime.utcnow()
-            image_path = f"images/{now}_{eline.post.author.did}.png"
-            # SVGからPNGに変換
-            cairosvg.svg2png(bytestring=svg, write_to=image_path)
-            settings["points"] -= 5
-            util.update_user_settings(connection, did, settings)
-            answer += f'\n\n{name}様の残りBluesky pointは{settings["points"]}になりましたわ。\n\n#blueskychandraw'
-        else:
+
+        def on_answer(answer):
+            submitted = False
+            try:
+                submitted = reply_draw(answer)
+            finally:
+                # 描画に回さなかったときは押さえたポイントをここで戻す
+                if not submitted:
+                    release_draw_points(did)
+
+        def reply_draw(answer):
+            """描画に回したら True"""
+            matches = []
+            if answer is not None:
+                pattern = r".*(<svg.*</svg>)(.*)"
+                matches = re.findall(pattern, answer, flags=re.DOTALL)
+            if len(matches) > 0:
+                svg = matches[0][0]
+                print(svg)
+                answer = matches[0][1]
+                answer = (
+                    answer.replace("```", "")
+                    .replace("</body>", "")
+                    .replace("</html>", "")
+                    .strip()
+                )
+                print(answer)
+                # SVGからPNGへの変換はCPUを使うので別プロセスで行う
+                submit_draw(connection, session, name, did, eline, svg, answer)
+                return True
             answer = "残念ながら、うまく描けませんでしたわ。ポイントは消費していないのでご安心くださいまし。少し間を空けてからまたお声がけくださいまし。"
-            image_path = None
-    else:
-        answer = ""
+            reply_to(session, answer, eline)
+            return False
+
+        ask(
+            eline.post.author.did,
+            gpt.get_answer5_nano,
+            (prompt, text),
+            on_answer,
+            uri=eline.post.uri,
+        )
 
-    return answer, image_path
+    return "", image_path
 
 
 personality = """
@@ -764,38 +1419,295 @@ def is_self_mention_or_reply(notification, bot_did):
     return False
 
 
-def process_notifications(session, bot_did, now, answered, previous_reply_did):
-    """Notificationを処理して反応する"""
-    # DBから最後に処理した時刻を取得
-    last_processed_at = get_last_processed_notification_time()
+class ReplyState:
+    """ランダム返信の最終時刻など、並行して動くハンドラ間で共有する状態"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.answered = None
+        self.previous_reply_did = None
+
+    def is_idle(self, at):
+        """最後のランダム返信から60分以上空いているか"""
+        with self.lock:
+            return self.answered is None or (at - self.answered) >= timedelta(
+                minutes=60
+            )
+
+    def mark_answered(self, at, did):
+        with self.lock:
+            self.answered = at
+            self.previous_reply_did = did
+
+
+reply_state = ReplyState()
+
+
+def get_past_text(counts, settings):
+    max_count = max(counts, settings["all_points"])
+    past = "初めての会話相手です。"
+    if max_count == 0:
+        past = "まだ会話して間もない相手です。"
+    elif max_count >= 5:
+        past = "何度も会話して慣れてきている相手です。"
+    elif max_count >= 10:
+        past = "何度も会話してかなり慣れてきている相手です。"
+    elif max_count >= 30:
+        past = "親密な友達です。"
+    elif max_count >= 100:
+        past = "長い付き合いのある親友なので、かしこまらずに素の自分を出せます。"
+    return past
+
+
+def run_handler(handler, *args):
+    """ハンドラを1件実行する。DBへの書き込みは1回のコミットにまとめる"""
+    try:
+        with db.unit_of_work(connection):
+            handler(*args)
+    except Exception as e:
+        print(f"Error in {handler.__name__}: {e}")
+        traceback.print_exc()
+        util.put_error_log(handler.__name__, repr(e), traceback.format_exc())
+
+
+def dispatch_inline(key, handler, *args):
+    """その場でハンドラを実行する(Runtime を使わない場合)"""
+    run_handler(handler, *args)
+
+
+# GPTの応答待ちでハンドラの枠を塞がないよう、問い合わせはキューに積む
+answer_queue = gpt.AnswerQueue()
+# 応答待ち・変換待ちの投稿のURIと数。なくなるまで台帳の claimed を閉じない
+pending_replies = Counter()
+pending_replies_lock = threading.Lock()
+ANSWER_QUEUE_DEPTH.set_function(answer_queue.backlog)
+PENDING_REPLIES.set_function(lambda: len(pending_replies))
+
+
+def hold_reply(uri):
+    with pending_replies_lock:
+        pending_replies[uri] += 1
+
+
+def release_reply(uri):
+    with pending_replies_lock:
+        pending_replies[uri] -= 1
+        if pending_replies[uri] <= 0:
+            del pending_replies[uri]
+    finish_reply(uri)
+
+
+def ask(key, func, args, callback, deadline=None, uri=None):
+    """
+    func(*args) の問い合わせを key(ユーザーのDIDなど)ごとの順番で実行し、
+    応答が来たら callback(answer) を呼ぶ
+    uri を渡すと、callback で返信しなかった場合に台帳を skipped にする
+    """
+    if uri is not None:
+        hold_reply(uri)
+
+    def on_answer(answer):
+        run_handler(callback, answer)
+        if uri is not None:
+            release_reply(uri)
 
-    notifications_data = get_notifications(session, limit=50)
+    answer_queue.submit(key, func, args, on_answer, deadline)
 
-    if not notifications_data:
-        print("[ERROR] notifications_data is None or empty")
-        return now, answered, previous_reply_did
 
-    if "notifications" not in notifications_data:
-        print(
-            f"[ERROR] 'notifications' key not found in data. Keys: {list(notifications_data.keys())}"
+# 起動ごとに変わる値。台帳でこのプロセスが処理中のものを見分ける
+RUN_ID = f"{os.getpid()}-{int(time.time())}"
+# 起動時に、落ちる前に処理しかけていた反応をどこまで遡ってやり直すか
+REPLY_RESUME_WINDOW = timedelta(hours=1)
+REPLY_LEDGER_RETENTION = timedelta(days=30)
+
+
+def finish_reply(uri):
+    """返信せずに終わった投稿を台帳で閉じる(応答待ちのものは除く)"""
+    with pending_replies_lock:
+        if uri in pending_replies:
+            return
+    util.mark_reply_skipped(connection, uri)
+
+
+def dispatch_reply(dispatch, source, handler, session, eline, at):
+    """
+    台帳に登録できた投稿だけ handler(session, eline, at) として dispatch に渡す
+    返信文まで出来ていたものは投稿だけやり直す。登録できなければ False
+    """
+    state = util.claim_reply(
+        connection,
+        eline.post.uri,
+        eline.post.author.did,
+        source,
+        json.dumps(eline.raw, ensure_ascii=False),
+        RUN_ID,
+    )
+    if state is None:
+        EVENTS.inc(source, "duplicate")
+        print(f"→ SKIPPED: already handled {eline.post.uri}")
+        return False
+    if state == "generated":
+        EVENTS.inc(source, "resumed")
+        dispatch(eline.post.author.did, resume_reply, session, eline.post.uri)
+    else:
+        EVENTS.inc(source, "dispatched")
+        dispatch(eline.post.author.did, handle_reply, handler, session, eline, at)
+    return True
+
+
+def handle_reply(handler, session, eline, at):
+    try:
+        handler(session, eline, at)
+    finally:
+        finish_reply(eline.post.uri)
+
+
+def resume_reply(session, uri):
+    """返信文まで出来ていて投稿できていなかった反応を投稿する"""
+    row = util.get_reply(connection, uri)
+    image_path = row["image_path"]
+    if image_path and not os.path.exists(image_path):
+        image_path = None
+    rkeys = util.get_reply_rkeys(connection, uri)
+    if rkeys and record_exists(session, "app.bsky.feed.post", rkeys[0]):
+        # applyWrites はまとめて書くので、先頭があれば全部投稿できている
+        print(f"Already posted reply to {uri}")
+        util.mark_reply_posted(connection, uri)
+        return
+    print(f"Resuming reply to {uri}")
+    eline = events.Event(json.loads(row["line"]))
+    drawing = util.get_reply_drawing(connection, uri)
+    if drawing is not None:
+        resume_draw(session, eline, drawing, rkeys)
+        return
+    reply_to(session, row["answer"], eline, image_path, rkeys=rkeys)
+
+
+def resume_replies(session, dispatch=dispatch_inline):
+    """前回の起動で処理しかけていた反応をやり直す"""
+    since = (datetime.utcnow() - REPLY_RESUME_WINDOW).strftime("%Y-%m-%d %H:%M:%S")
+    handlers = {"notification": handle_notification, "timeline": handle_timeline_post}
+    for row in util.get_unfinished_replies(connection, RUN_ID, since):
+        eline = events.Event(json.loads(util.get_reply(connection, row["uri"])["line"]))
+        dispatch_reply(
+            dispatch,
+            row["source"],
+            handlers[row["source"]],
+            session,
+            eline,
+            eline.at,
         )
-        return now, answered, previous_reply_did
 
-    notifications = notifications_data["notifications"]
+
+def handle_notification(session, eline, notif_datetime):
+    """メンション・リプライ1件に反応する"""
+    did = eline.post.author.did.replace("did:plc:", "")
+    text = eline.post.record.text
+    name = (
+        eline.post.author.display_name
+        if eline.post.author.display_name is not None
+        else eline.post.author.handle.split(".", 1)[0]
+    )
+    settings = util.get_user_settings(connection, did)
+
+    # Notificationでは既に自分への言及確認済みなので、util.has_mentionは不要
+    if "占って" in text or "占い" in text or "fortune" in text:
+        fortune(connection, session, prompt, name, settings, eline)
+    elif "描いて" in text or "draw" in text:
+        answer, image_path = draw(
+            connection, session, prompt, name, did, settings, eline
+        )
+        if len(answer) > 0:
+            reply_to(session, answer, eline, image_path=image_path)
+    elif "status" in text:
+        print(eline)
+        answer = status(connection_atp, connection, session, name, settings, eline)
+        print(answer)
+        reply_to(session, answer, eline)
+    elif "friend" in text:
+        answer = friend(connection, did, name)
+        reply_to(session, answer, eline)
+    elif "silent" in text:
+        answer = silent(connection, did, name)
+        reply_to(session, answer, eline)
+    else:
+        print(eline)
+        bonus = 0
+        friend_talk = False
+        # Notificationでは既に自分への言及確認済み
+        if settings["mode"] > 0:
+            if settings["points"] > 0:
+                bonus = 100
+                friend_talk = True
+        else:
+            bonus = 5
+        if settings["mode"] > 0:
+            if reply_state.is_idle(notif_datetime):
+                bonus = 100
+            percent = random.uniform(0, 100)
+            print(percent, bonus)
+            if percent <= (1 + bonus):
+                FRIEND_REPLIES.inc("notification", "hit")
+                print("atari")
+                counts = util.get_fortune_counts(connection, eline.post.author.did)
+                past = get_past_text(counts, settings)
+
+                chat_prompt = prompt + f"\n相手の名前は{name}様で、{past}"
+                messages = context.build_dialogs(connection, did, chat_prompt, text)
+                print(f"messages:{len(messages)}")
+                # 応答待ちの間に次のランダム返信が重ならないよう先に記録する
+                reply_state.mark_answered(notif_datetime, eline.post.author.did)
+
+                def on_answer(answer):
+                    print(answer)
+                    if answer is None:
+                        return
+                    settings = util.get_user_settings(connection, did)
+                    if friend_talk:
+                        pass
+                    else:
+                        settings["points"] += 1
+                        settings["all_points"] += 1
+                        answer = f"{answer}\n\nBP:{settings['points']}(+1)"
+                    reply_to(session, answer, eline)
+                    util.update_user_settings(connection, did, settings)
+
+                ask(
+                    eline.post.author.did,
+                    gpt.get_answer,
+                    (chat_prompt, text, messages),
+                    on_answer,
+                    uri=eline.post.uri,
+                )
+            else:
+                FRIEND_REPLIES.inc("notification", "miss")
+                print("hazure")
+
+
+def handle_notifications(session, bot_did, notifications, after, dispatch, skip_read):
+    """
+    after より新しいNotificationを古い順に処理して、dispatch に渡した件数を返す
+    skip_read=False は遡って取った分で、既読にした後なので既読でも処理する
+    """
     processed_count = 0
-    latest_processed_time = last_processed_at
+    new_followers = []
 
-    for notification in notifications:
+    # 古い順に処理する
+    for notification in reversed(notifications):
         try:
             author = notification.get("author", {})
-            notif_datetime = parse(notification.get("indexedAt"))
-
             # 既読のNotificationはスキップ
-            if notification.get("isRead", False):
+            if skip_read and notification.get("isRead", False):
                 continue
 
+            notif_datetime = events.parse_time(notification.get("indexedAt"))
+
             # 最後に処理した時刻より新しいNotificationのみ処理
-            if last_processed_at >= notif_datetime:
+            if after >= notif_datetime:
+                continue
+
+            if notification.get("reason") == "follow":
+                new_followers.append((author.get("did"), author.get("handle")))
                 continue
 
             # 自分自身の投稿には反応しない
@@ -806,301 +1718,282 @@ def process_notifications(session, bot_did, now, answered, previous_reply_did):
             if not is_self_mention_or_reply(notification, bot_did):
                 continue
 
-            # フォロワーでない場合はスキップ
-            author_viewer = notification.get("author", {}).get("viewer", {})
-
-            if author_viewer.get("muted"):
-                continue
-            if author_viewer.get("blockedBy"):
-                continue
-            if "followedBy" not in author_viewer:
-                continue
-
-            author_did = notification.get("author", {}).get("did")
-            followed_by = author_viewer.get("followedBy", [])
-
-            if author_did not in followed_by:
+            # ミュート・ブロックされている場合と、フォロワーでない場合はスキップ
+            if not events.can_reply(author):
                 continue
 
             print(
                 f"Processing notification: {notification.get('reason')} from {author.get('handle')}"
             )
 
-            # EasyDictでラップして既存の処理関数を再利用
-            # 既存のprocess_timeline関数の処理と同様の形式に変換
-            fake_line = {
-                "post": {
-                    "author": notification["author"],
-                    "record": notification["record"],
-                    "cid": notification.get("cid"),
-                    "uri": notification.get("uri"),
-                    "indexedAt": notification.get("indexedAt"),
-                }
-            }
+            # タイムラインの投稿と同じ形にしてハンドラに渡す
+            # 遡って取った分を2回処理しても、台帳で1回だけ反応する
+            eline = events.Event.from_notification(notification, notif_datetime)
+            if not dispatch_reply(
+                dispatch,
+                "notification",
+                handle_notification,
+                session,
+                eline,
+                notif_datetime,
+            ):
+                continue
 
-            # リプライの場合はreply情報を追加
-            if "reply" in notification.get("record", {}):
-                fake_line["reply"] = notification["record"]["reply"]
+            processed_count += 1
 
-            eline = EasyDict(fake_line)
+        except Exception as e:
+            print(f"Error processing notification: {e}")
+            traceback.print_exc()
 
-            # 既存の処理ロジックを使用
-            did = eline.post.author.did.replace("did:plc:", "")
-            text = eline.post.record.text
-            name = (
-                eline.post.author.displayName
-                if "displayName" in eline.post.author
-                else eline.post.author.handle.split(".", 1)[0]
+    if new_followers:
+        try:
+            add_followers(session, new_followers)
+        except Exception as e:
+            print(f"Error adding followers: {e}")
+            traceback.print_exc()
+
+    return processed_count
+
+
+@metrics.timed(STAGE_SECONDS)
+def process_notifications(session, bot_did, dispatch=dispatch_inline):
+    """
+    Notificationを取得して、反応するものを dispatch に渡す
+    (渡した件数, 取り残したページがあるか) を返す
+
+    1回で遡れるのは MAX_NOTIFICATION_PAGES ページまで。遡りきれなかったときは
+    last_processed_at をそのままにして続きのカーソルを保存し、次の取得で
+    新しい分を処理したあと、保存したカーソルから last_processed_at まで遡る
+    """
+    # DBから最後に処理した時刻(これより前はすべて処理済み)を取得
+    last_processed_at = get_last_processed_notification_time()
+    saved_cursor, newest_at = get_notification_backlog()
+    backlog_cursor = saved_cursor
+    # 遡りきれていない間は、前回までに処理した最も新しいものより新しい分だけ取る
+    newest_at = newest_at or last_processed_at
+    saved_newest_at = newest_at
+
+    drained = drain_notifications(session, newest_at)
+    if drained is None:
+        return 0, False
+    notifications, rest_cursor = drained
+    EVENTS.inc("notification", "fetched", amount=len(notifications))
+    processed_count = handle_notifications(
+        session, bot_did, notifications, newest_at, dispatch, skip_read=True
+    )
+    older = []
+    if rest_cursor is not None:
+        # 今回も遡りきれなかった。続きはこのカーソルから遡り直す
+        # (前回の続きの分も、この先を遡るうちに含まれる)
+        backlog_cursor = rest_cursor
+    elif backlog_cursor is not None:
+        drained = drain_notifications(session, last_processed_at, backlog_cursor)
+        if drained is not None:
+            older, backlog_cursor = drained
+            EVENTS.inc("notification", "fetched", amount=len(older))
+            processed_count += handle_notifications(
+                session, bot_did, older, last_processed_at, dispatch, skip_read=False
             )
-            settings = util.get_user_settings(connection, did)
+    # 取得したページをまとめて、その時点のカーソルと一緒に残す
+    journal.record(
+        "notifications",
+        {
+            "last_processed_at": last_processed_at.isoformat(),
+            "notifications": notifications + older,
+            "cursor": backlog_cursor,
+        },
+    )
 
-            # Notificationでは既に自分への言及確認済みなので、util.has_mentionは不要
-            if "占って" in text or "占い" in text or "fortune" in text:
-                fortune(connection, session, prompt, name, settings, eline)
-            elif "描いて" in text or "draw" in text:
-                answer, image_path = draw(
-                    connection, prompt, name, did, settings, eline
-                )
-                if len(answer) > 0:
-                    reply_to(session, answer, eline, image_path=image_path)
-            elif "status" in text:
-                print(fake_line)
-                answer = status(
-                    connection_atp, connection, session, name, settings, eline
-                )
+    if notifications:
+        # 先頭が最も新しい
+        newest_at = max(newest_at, events.parse_time(notifications[0]["indexedAt"]))
+    if backlog_cursor is None:
+        # 遡りきったので、ここまではすべて処理済み
+        processed_at = newest_at
+        newest_at = None
+    else:
+        processed_at = last_processed_at
+    # 処理完了後、変わっていれば処理済みの時刻とカーソルをDBに保存
+    if (
+        processed_at > last_processed_at
+        or backlog_cursor != saved_cursor
+        or (backlog_cursor is not None and newest_at > saved_newest_at)
+    ):
+        update_last_processed_notification_time(processed_at, backlog_cursor, newest_at)
+    if notifications:
+        # 既読は取得ごとにまとめて1回だけ更新する
+        update_seen(session, notifications[0]["indexedAt"])
+
+    return processed_count, backlog_cursor is not None
+
+
+def handle_timeline_post(session, eline, post_datetime):
+    """friendモードのユーザーの投稿にランダムで反応する"""
+    did = eline.post.author.did.replace("did:plc:", "")
+    text = eline.post.record.text
+    name = (
+        eline.post.author.display_name
+        if eline.post.author.display_name is not None
+        else eline.post.author.handle.split(".", 1)[0]
+    )
+    settings = util.get_user_settings(connection, did)
+
+    # ランダム反応のみ実行（friendモードのユーザーに対して）
+    if settings["mode"] > 0:
+        if reply_state.is_idle(post_datetime):
+            bonus = 100
+        else:
+            bonus = 0
+        percent = random.uniform(0, 100)
+        print(percent, bonus)
+        if percent <= (1 + bonus):
+            FRIEND_REPLIES.inc("timeline", "hit")
+            print("atari - random timeline reaction")
+            counts = util.get_fortune_counts(connection, eline.post.author.did)
+            past = get_past_text(counts, settings)
+
+            chat_prompt = prompt + f"\n相手の名前は{name}様で、{past}"
+            messages = context.build_dialogs(connection, did, chat_prompt, text)
+            print(f"messages:{len(messages)}")
+            # 応答待ちの間に次のランダム返信が重ならないよう先に記録する
+            reply_state.mark_answered(datetime.now(pytz.utc), eline.post.author.did)
+
+            def on_answer(answer):
                 print(answer)
+                if answer is None:
+                    return
+                settings = util.get_user_settings(connection, did)
+                settings["points"] += 1
+                settings["all_points"] += 1
+                answer = f"{answer}\n\nBP:{settings['points']}(+1)"
                 reply_to(session, answer, eline)
-            elif "friend" in text:
-                answer = friend(connection, did, name)
-                reply_to(session, answer, eline)
-            elif "silent" in text:
-                answer = silent(connection, did, name)
-                reply_to(session, answer, eline)
-            else:
-                print(fake_line)
-                bonus = 0
-                friend_talk = False
-                # Notificationでは既に自分への言及確認済み
-                if settings["mode"] > 0:
-                    if settings["points"] > 0:
-                        bonus = 100
-                        friend_talk = True
-                else:
-                    bonus = 5
-                if settings["mode"] > 0:
-                    if answered is None or (notif_datetime - answered) >= timedelta(
-                        minutes=60
-                    ):
-                        bonus = 100
-                    percent = random.uniform(0, 100)
-                    print(percent, bonus)
-                    if percent <= (1 + bonus):
-                        print("atari")
-                        counts = util.get_fortune_counts(
-                            connection, eline.post.author.did
-                        )
-                        max_count = max(counts, settings["all_points"])
-                        past = "初めての会話相手です。"
-                        if max_count == 0:
-                            past = "まだ会話して間もない相手です。"
-                        elif max_count >= 5:
-                            past = "何度も会話して慣れてきている相手です。"
-                        elif max_count >= 10:
-                            past = "何度も会話してかなり慣れてきている相手です。"
-                        elif max_count >= 30:
-                            past = "親密な友達です。"
-                        elif max_count >= 100:
-                            past = "長い付き合いのある親友なので、かしこまらずに素の自分を出せます。"
-
-                        messages = util.get_recent_dialogs(connection, did)
-                        print(f"messages:{messages}")
-                        answer = gpt.get_answer(
-                            prompt + f"\n相手の名前は{name}様で、{past}",
-                            text,
-                            messages,
-                        )
-                        print(answer)
-                        if friend_talk:
-                            pass
-                        else:
-                            settings["points"] += 1
-                            settings["all_points"] += 1
-                            answer = f"{answer}\n\nBP:{settings['points']}(+1)"
-                        reply_to(session, answer, eline)
-                        util.update_user_settings(connection, did, settings)
-                        answered = notif_datetime
-                        previous_reply_did = eline.post.author.did
-                    else:
-                        print("hazure")
-
-            now = notif_datetime
-            processed_count += 1
-
-            # 処理した最新の時刻を記録
-            if notif_datetime > latest_processed_time:
-                latest_processed_time = notif_datetime
+                util.update_user_settings(connection, did, settings)
+
+            ask(
+                eline.post.author.did,
+                gpt.get_answer,
+                (chat_prompt, text, messages),
+                on_answer,
+                uri=eline.post.uri,
+            )
+        else:
+            FRIEND_REPLIES.inc("timeline", "miss")
+            print("hazure")
 
-            # 一度に処理しすぎないよう制限
-            if processed_count >= 5:
-                break
 
-        except Exception as e:
-            print(f"Error processing notification: {e}")
-            traceback.print_exc()
+TIMELINE_PAGE_SIZE = 50
 
-    # 処理完了後、最新の処理時刻をDBに保存
-    if latest_processed_time > last_processed_at:
-        update_last_processed_notification_time(latest_processed_time)
 
-    return now, answered, previous_reply_did
+def fetch_timeline(session):
+    """タイムラインを取得して古い順に並べる。取得できなければNone"""
+    headers = {"Authorization": "Bearer " + session.ATP_AUTH_TOKEN}
+    skyline = xrpc.client.get(
+        session.ATP_HOST + "/xrpc/app.bsky.feed.getTimeline",
+        params={"limit": TIMELINE_PAGE_SIZE},
+        headers=headers,
+    )
+    feed = skyline.json().get("feed")
+    if feed is None:
+        return None
+    return sorted(feed, key=lambda x: events.parse_time(x["post"]["indexedAt"]))
 
 
-def process_timeline(session, bot_did, now, answered, sorted_feed, previous_reply_did):
-    feed_len = len(sorted_feed)
-    for i in range(feed_len):
-        line = sorted_feed[i]
-        eline = EasyDict(line)
-        if eline.post.author.handle == username:
+@metrics.timed(STAGE_SECONDS)
+def process_timeline(session, bot_did, now, sorted_feed, dispatch=dispatch_inline):
+    """
+    now より新しいタイムラインの投稿のうち反応しうるものを dispatch に渡す
+    最後に見た投稿の時刻を返す
+    """
+    journal.record("timeline", {"now": now.isoformat(), "feed": sorted_feed})
+    EVENTS.inc("timeline", "fetched", amount=len(sorted_feed))
+    # 時刻・フォロワーかどうか・他の人へのメンションなどの判定は JSON のまま行い、
+    # 反応しうる投稿だけ Event にする
+    candidates = []
+    for line in sorted_feed:
+        post = line["post"]
+        author = post["author"]
+        if author.get("handle") == username:
             # 自分自身には反応しない
             continue
-        # print(eline.post.indexedAt)
         try:
-            postDatetime = parse(eline.post.indexedAt)
-            if now < postDatetime:
-                # print(eline)
-                can_reply = False
-                if (
-                    not eline.post.author.viewer.muted
-                    and not eline.post.author.viewer.blockedBy
-                    and "followedBy" in eline.post.author.viewer
-                    and eline.post.author.did in eline.post.author.viewer.followedBy
+            postDatetime = events.parse_time(post["indexedAt"])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"[timeline] invalid indexedAt: {e}")
+            continue
+        if not now < postDatetime:
+            continue
+        now = postDatetime
+        # フォロワのみ反応する。リポストには反応しない
+        if "reason" in line or not events.can_reply(author):
+            continue
+        record = post.get("record", {})
+        if "facets" in record:
+            if events.mentions_others(record, bot_did):
+                # 他の人にメンションしている場合はスルー
+                continue
+        elif "reply" in line:
+            parent = line["reply"].get("parent") or {}
+            if (parent.get("author") or {}).get("handle") != username:
+                # 他の人へのリプライの場合はスルー
+                continue
+        candidates.append((line, postDatetime))
+
+    # 反応しうる投稿の作者の設定は1回のSELECTでまとめて読んでおく
+    util.prefetch_user_settings(
+        connection,
+        [
+            line["post"]["author"]["did"].replace("did:plc:", "")
+            for line, _ in candidates
+        ],
+    )
+    for line, postDatetime in candidates:
+        try:
+            eline = events.Event(line, postDatetime)
+            print(line)
+
+            text = eline.post.record.text
+            # タイムライン処理では名前を呼ばれても反応しない
+            # （Notification処理で対応するため）
+
+            # コマンドが含まれている場合はスキップ（二重返信防止）
+            if util.has_mention(bot_names, eline):
+                if any(
+                    cmd in text
+                    for cmd in [
+                        "占って",
+                        "占い",
+                        "fortune",
+                        "描いて",
+                        "draw",
+                        "status",
+                        "friend",
+                        "silent",
+                    ]
                 ):
-                    can_reply = True
-                if can_reply:
-                    # フォロワのみ反応する
-                    if "reason" not in eline:
-                        detect_other_mention = False
-                        if "facets" in eline.post.record:
-                            for facet in eline.post.record.facets:
-                                if "features" in facet:
-                                    for feature in facet.features:
-                                        if "did" in feature:
-                                            if bot_did != feature["did"]:
-                                                detect_other_mention = True
-                                                break
-                        elif "reply" in eline:
-                            if eline.reply.parent.author.handle != username:
-                                detect_other_mention = True
-                        if detect_other_mention:
-                            # 他の人にメンション、リプライの場合はスルー
-                            now = postDatetime
-                            continue
-                        print(line)
-
-                        did = eline.post.author.did.replace("did:plc:", "")
-                        text = eline.post.record.text
-                        name = (
-                            eline.post.author.displayName
-                            if "displayName" in eline.post.author
-                            else eline.post.author.handle.split(".", 1)[0]
-                        )
-                        settings = util.get_user_settings(connection, did)
-                        # タイムライン処理では名前を呼ばれても反応しない
-                        # （Notification処理で対応するため）
-
-                        # コマンドが含まれている場合はスキップ（二重返信防止）
-                        if util.has_mention(bot_names, eline):
-                            if any(
-                                cmd in text
-                                for cmd in [
-                                    "占って",
-                                    "占い",
-                                    "fortune",
-                                    "描いて",
-                                    "draw",
-                                    "status",
-                                    "friend",
-                                    "silent",
-                                ]
-                            ):
-                                print(
-                                    f"→ SKIPPED: Command detected in timeline, will be handled by notification processing"
-                                )
-                                now = postDatetime
-                                continue
-
-                        # ランダム反応のみ実行（friendモードのユーザーに対して）
-                        if settings["mode"] > 0:
-                            if answered is None or (now - answered) >= timedelta(
-                                minutes=60
-                            ):
-                                bonus = 100
-                            else:
-                                bonus = 0
-                            percent = random.uniform(0, 100)
-                            print(percent, bonus)
-                            if percent <= (1 + bonus):
-                                print("atari - random timeline reaction")
-                                counts = util.get_fortune_counts(
-                                    connection, eline.post.author.did
-                                )
-                                max_count = max(counts, settings["all_points"])
-                                past = "初めての会話相手です。"
-                                if max_count == 0:
-                                    past = "まだ会話して間もない相手です。"
-                                elif max_count >= 5:
-                                    past = "何度も会話して慣れてきている相手です。"
-                                elif max_count >= 10:
-                                    past = (
-                                        "何度も会話してかなり慣れてきている相手です。"
-                                    )
-                                elif max_count >= 30:
-                                    past = "親密な友達です。"
-                                elif max_count >= 100:
-                                    past = "長い付き合いのある親友なので、かしこまらずに素の自分を出せます。"
-
-                                messages = util.get_recent_dialogs(connection, did)
-                                print(f"messages:{messages}")
-                                answer = gpt.get_answer(
-                                    prompt + f"\n相手の名前は{name}様で、{past}",
-                                    text,
-                                    messages,
-                                )
-                                print(answer)
-                                settings["points"] += 1
-                                settings["all_points"] += 1
-                                answer = f"{answer}\n\nBP:{settings['points']}(+1)"
-                                reply_to(session, answer, eline)
-                                util.update_user_settings(connection, did, settings)
-                                answered = datetime.now(pytz.utc)
-                                previous_reply_did = eline.post.author.did
-                            else:
-                                print("hazure")
-                now = postDatetime
+                    print(
+                        f"→ SKIPPED: Command detected in timeline, will be handled by notification processing"
+                    )
+                    continue
+
+            dispatch_reply(
+                dispatch,
+                "timeline",
+                handle_timeline_post,
+                session,
+                eline,
+                postDatetime,
+            )
         except Exception as e:
-            print(eline)
+            print(line)
             traceback.print_exc()
             print(repr(e))
             print(str(e))
 
-    return now, answered, previous_reply_did
-
-
-import threading
-
+    return now
 
-def aggregate_and_count(session):
-    if not hasattr(aggregate_and_count, "prev_count"):
-        aggregate_and_count.prev_count = 0
-    # スレッド内で新たにDBコネクションを作成
-    local_connection_atp = sqlite3.connect("atp.db")
-    local_connection_atp.row_factory = sqlite3.Row
-    # bluesky_bot.dbとは別にcount_post専用DBを用意
-    local_count_post_connection = sqlite3.connect("count_post.db")
-    local_count_post_connection.row_factory = sqlite3.Row
 
-    # サブスレッド開始時にcount_postテーブルがなければ作成
-    cur_count_post = local_count_post_connection.cursor()
+def create_count_post_table(count_post_connection):
+    cur_count_post = count_post_connection.cursor()
     cur_count_post.execute(
         """
     CREATE TABLE IF NOT EXISTS count_post
@@ -1110,169 +2003,423 @@ def aggregate_and_count(session):
        )
     """
     )
-    local_count_post_connection.commit()
+    count_post_connection.commit()
 
-    try:
-        while True:
-            try:
-                Path("./alive").touch()
-                util.aggregate_users(local_connection_atp)
-                posted_count = util.get_posted_user_count(local_count_post_connection)
-                stats = util.get_stats()
-                jaz_count = stats["total_users"]
-                if aggregate_and_count.prev_count != jaz_count:
-                    print("user count:", jaz_count)
-                base_low = (jaz_count // 1000000) * 1000000
-                base_high = (jaz_count // 10000000 + 1) * 10000000
-                if base_low < jaz_count < base_high:
-                    if (
-                        jaz_count % 100000 == 0
-                        or ((posted_count // 100000) * 100000 + 100000) <= jaz_count
-                    ):
-                        prompt = f"これはあなたの人格です。'{personality}'\nこの人格を演じて次の文章に対して80文字以内で返信してください。"
-                        text = f"ユーザー数が{base_high}人になるまで100000人ずつカウントアップしています。SNSのBlueskyのユーザーが{jaz_count}人になり{base_high}人にもう少しであることをBlueskyのユーザーに向けて伝える投稿をしてください。人数は正確に書いてください。"
-                        answer = gpt.get_answer5_nano(prompt, text)
-                        post(session, answer)
-                        util.store_posted_user_count(
-                            local_count_post_connection, jaz_count
-                        )
-                elif jaz_count >= base_high:
-                    prompt = f"これはあなたの人格です。'{personality}'\nこの人格を演じて次の文章に対して80文字以内で返信してください。"
-                    text = f"SNSのBlueskyのユーザーが{jaz_count}人になりました。大変な偉業です。Blueskyの開発チームの人達とBlueskyのユーザーに向けて感謝の言葉を伝える投稿をしてください。"
-                    answer = gpt.get_answer5_nano(prompt, text)
-                    post(session, answer)
-                    util.store_posted_user_count(local_count_post_connection, jaz_count)
-                elif (
-                    jaz_count % 50000 == 0
-                    or ((posted_count // 50000) * 50000 + 50000) <= jaz_count
-                ):
-                    if posted_count < jaz_count:
-                        if jaz_count >= 100000 == 0:
-                            post(
-                                session,
-                                f"お兄さま、見てくださいまし！！Blueskyのユーザーがついに{jaz_count}人になりましたわよ。感無量ですわ🎀",
-                            )
-                        elif jaz_count % 100000 == 0:
-                            post(
-                                session,
-                                f"お兄さま、見てくださいまし！Blueskyのユーザーがついに{jaz_count}人になりましたわよ。素晴らしいですわ！皆様のご協力のお陰ですわね！",
-                            )
-                    elif jaz_count % 50000 == 0:
-                        post(
-                            session,
-                            f"うふふ、お兄さま、Blueskyのユーザーが{jaz_count}人になりましたわね。",
-                        )
-                    else:
-                        post(
-                            session,
-                            f"ふふ、お兄さま、Blueskyのユーザーが{jaz_count}人になりましたわよ。",
-                        )
 
-                    util.store_posted_user_count(local_count_post_connection, jaz_count)
+@metrics.timed(STAGE_SECONDS)
+def aggregate_and_count(session):
+    """PLCの取り込みとユーザー数の記念投稿を1回分行う"""
+    if not hasattr(aggregate_and_count, "prev_count"):
+        aggregate_and_count.prev_count = 0
+    # db.connect はスレッドごとに別の接続を使う
+    local_connection_atp = db.connect("atp.db")
+    # bluesky_bot.dbとは別にcount_post専用DBを用意
+    local_count_post_connection = db.connect("count_post.db")
+
+    def post_answer(answer):
+        if answer is not None:
+            post(session, answer)
+
+    Path("./alive").touch()
+    util.aggregate_users(local_connection_atp)
+    posted_count = util.get_posted_user_count(local_count_post_connection)
+    stats = util.get_stats()
+    jaz_count = stats["total_users"]
+    if aggregate_and_count.prev_count != jaz_count:
+        print("user count:", jaz_count)
+    base_low = (jaz_count // 1000000) * 1000000
+    base_high = (jaz_count // 10000000 + 1) * 10000000
+    if base_low < jaz_count < base_high:
+        if (
+            jaz_count % 100000 == 0
+            or ((posted_count // 100000) * 100000 + 100000) <= jaz_count
+        ):
+            prompt = f"これはあなたの人格です。'{personality}'\nこの人格を演じて次の文章に対して80文字以内で返信してください。"
+            text = f"ユーザー数が{base_high}人になるまで100000人ずつカウントアップしています。SNSのBlueskyのユーザーが{jaz_count}人になり{base_high}人にもう少しであることをBlueskyのユーザーに向けて伝える投稿をしてください。人数は正確に書いてください。"
+            ask("count_post", gpt.get_answer5_nano, (prompt, text), post_answer)
+            util.store_posted_user_count(local_count_post_connection, jaz_count)
+    elif jaz_count >= base_high:
+        prompt = f"これはあなたの人格です。'{personality}'\nこの人格を演じて次の文章に対して80文字以内で返信してください。"
+        text = f"SNSのBlueskyのユーザーが{jaz_count}人になりました。大変な偉業です。Blueskyの開発チームの人達とBlueskyのユーザーに向けて感謝の言葉を伝える投稿をしてください。"
+        ask("count_post", gpt.get_answer5_nano, (prompt, text), post_answer)
+        util.store_posted_user_count(local_count_post_connection, jaz_count)
+    elif (
+        jaz_count % 50000 == 0
+        or ((posted_count // 50000) * 50000 + 50000) <= jaz_count
+    ):
+        if posted_count < jaz_count:
+            if jaz_count >= 100000 == 0:
+                post(
+                    session,
+                    f"お兄さま、見てくださいまし！！Blueskyのユーザーがついに{jaz_count}人になりましたわよ。感無量ですわ🎀",
+                )
+            elif jaz_count % 100000 == 0:
+                post(
+                    session,
+                    f"お兄さま、見てくださいまし！Blueskyのユーザーがついに{jaz_count}人になりましたわよ。素晴らしいですわ！皆様のご協力のお陰ですわね！",
+                )
+        elif jaz_count % 50000 == 0:
+            post(
+                session,
+                f"うふふ、お兄さま、Blueskyのユーザーが{jaz_count}人になりましたわね。",
+            )
+        else:
+            post(
+                session,
+                f"ふふ、お兄さま、Blueskyのユーザーが{jaz_count}人になりましたわよ。",
+            )
+
+        util.store_posted_user_count(local_count_post_connection, jaz_count)
+
+    aggregate_and_count.prev_count = jaz_count
+
 
-                aggregate_and_count.prev_count = jaz_count
-                time.sleep(60)
+AGGREGATE_INTERVAL = 60
+# 同時に処理するメンション・投稿の数
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", 4))
+# 処理待ちにできるハンドラの数。溢れたらポーリング側が空くまで待つ
+WORK_QUEUE_SIZE = int(os.getenv("WORK_QUEUE_SIZE", HANDLER_CONCURRENCY * 8))
+# poll: getTimeline を定期的に取得 / stream: イベントストリームを購読
+TIMELINE_SOURCE = os.getenv("TIMELINE_SOURCE", "poll")
+FOLLOWERS_REFRESH_INTERVAL = 10 * 60
+# フォロー・フォロワーの全件を取り直して突き合わせる間隔(普段は通知で追加する)
+FOLLOW_SYNC_INTERVAL = int(os.getenv("FOLLOW_SYNC_INTERVAL", 6 * 60 * 60))
+# 起動時にタイムラインを遡る時間。反応済みの投稿は台帳で除く
+TIMELINE_LOOKBACK = timedelta(minutes=int(os.getenv("TIMELINE_LOOKBACK_MINUTES", 10)))
+# ポイントなどの変更をDBに書き出す間隔(秒)
+SETTINGS_FLUSH_INTERVAL = 5
+# logs.db に1行ずつ残す期間。過ぎたものは日ごとの件数(log_rollups)にまとめる
+LOG_RETENTION = timedelta(days=int(os.getenv("LOG_RETENTION_DAYS", 90)))
 
+
+class Runtime:
+    """
+    Notification・タイムラインのポーリング、各投稿への反応、集計を
+    asyncio のタスクとして独立に動かす。
+    requests や sqlite3、cairosvg などのブロックする処理はスレッドプールで実行する
+    """
+
+    def __init__(self, session, bot_did):
+        self.session = session
+        self.bot_did = bot_did
+        self.login_time = datetime.now(pytz.utc)
+        self.now = self.login_time - TIMELINE_LOOKBACK
+        self.loop = None
+        self.handler_semaphore = None
+        # 同じユーザーの投稿は届いた順に1件ずつ処理する
+        self.key_locks = {}
+        self.handler_tasks = set()
+        self.work_slots = threading.BoundedSemaphore(WORK_QUEUE_SIZE)
+        self.handler_executor = ThreadPoolExecutor(
+            HANDLER_CONCURRENCY, thread_name_prefix="handler"
+        )
+        # ポーリングのスレッドは処理待ちがあふれると dispatch で待つので、
+        # 設定の書き出しや古い行の削除、フォローの同期は別のスレッドで行う
+        self.poll_executor = ThreadPoolExecutor(2, thread_name_prefix="poll")
+        self.maintenance_executor = ThreadPoolExecutor(
+            2, thread_name_prefix="maintenance"
+        )
+        # 集計は専用スレッドで動かし、atp.db の接続を使い回す
+        self.aggregate_executor = ThreadPoolExecutor(1, thread_name_prefix="aggregate")
+        # ストリームの絞り込みに使うフォロワーのDID
+        self.followers = set()
+        self.followers_ready = None
+
+    def dispatch(self, key, handler, *args):
+        """
+        ポーリングのスレッドから呼ばれ、ハンドラをタスクとして登録する
+        処理待ちが WORK_QUEUE_SIZE を超える場合は空きができるまでブロックする
+        """
+        self.work_slots.acquire()
+        self.loop.call_soon_threadsafe(self._spawn_handler, key, handler, args)
+
+    def _spawn_handler(self, key, handler, args):
+        task = self.loop.create_task(self._run_handler(key, handler, args))
+        self.handler_tasks.add(task)
+        task.add_done_callback(self.handler_tasks.discard)
+
+    async def _run_handler(self, key, handler, args):
+        entry = self.key_locks.get(key)
+        if entry is None:
+            entry = self.key_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.handler_semaphore:
+                    await self.loop.run_in_executor(
+                        self.handler_executor, run_handler, handler, *args
+                    )
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.key_locks[key]
+            self.work_slots.release()
+
+    async def run_periodically(self, name, func, interval):
+        """
+        func を interval 秒ごとに実行する。ネットワークエラー時は指数バックオフ
+        interval が PollInterval なら、func が返す (新しい件数, 取り残しがあるか)
+        から次の間隔を決める
+        """
+        retry_count = 0
+        max_retries = 5
+        base_delay = 5
+        adaptive = isinstance(interval, scheduler.PollInterval)
+        while True:
+            try:
+                result = await func()
+                # 成功した場合はリトライカウントをリセット
+                retry_count = 0
+                delay = interval.observe(*result) if adaptive else interval
             except (
                 requests.exceptions.ConnectionError,
                 requests.exceptions.Timeout,
                 requests.exceptions.HTTPError,
             ) as e:
-                print(f"Network error in aggregate_and_count: {e}")
-                print("Retrying in 60 seconds...")
-                time.sleep(60)
-                continue
-
+                retry_count += 1
+                if retry_count > max_retries:
+                    print(
+                        f"[{name}] Max retries ({max_retries}) exceeded. Resetting retry count and continuing..."
+                    )
+                    retry_count = 0
+                    delay = base_delay * 6  # より長い待機時間
+                else:
+                    # 指数バックオフ: 5, 10, 20, 40, 80秒
+                    delay = base_delay * (2 ** (retry_count - 1))
+                print(f"[{name}] Network error occurred (attempt {retry_count}): {e}")
+                print(f"Retrying in {delay} seconds...")
             except Exception as e:
-                print(f"Error in aggregate_and_count loop: {e}")
+                print(f"[{name}] Unexpected error occurred: {e}")
                 traceback.print_exc()
-                print("Retrying in 60 seconds...")
-                time.sleep(60)
-                continue
-    except Exception as e:
-        traceback.print_exc()
-        print(repr(e))
-        print(str(e))
+                delay = max(interval.minimum if adaptive else interval, 5)
+            await asyncio.sleep(delay)
+
+    async def poll_notifications(self):
+        return await self.loop.run_in_executor(
+            self.poll_executor,
+            process_notifications,
+            self.session,
+            self.bot_did,
+            self.dispatch,
+        )
 
-    finally:
-        local_connection_atp.close()
-        local_count_post_connection.close()
+    async def poll_timeline(self):
+        sorted_feed = await self.loop.run_in_executor(
+            self.poll_executor, fetch_timeline, self.session
+        )
+        if sorted_feed is None:
+            print("Warning: feed is None, skipping this iteration")
+            return 0, False
+        now = self.now
+        new = sum(
+            1
+            for line in sorted_feed
+            if events.parse_time(line["post"]["indexedAt"]) > now
+        )
+        self.now = await self.loop.run_in_executor(
+            self.poll_executor,
+            process_timeline,
+            self.session,
+            self.bot_did,
+            self.now,
+            sorted_feed,
+            self.dispatch,
+        )
+        # 1ページすべてが新しければ、取りこぼしがあるかもしれない
+        return new, new > 0 and new == TIMELINE_PAGE_SIZE
 
+    def poll_interval(self, source):
+        return scheduler.PollInterval(
+            source, budget=lambda: xrpc.client.budget(self.session.ATP_HOST)
+        )
 
-def main():
-    session = login(username, password)
-    bot_did = get_did(session, username)
+    async def aggregate(self):
+        await self.loop.run_in_executor(
+            self.aggregate_executor, aggregate_and_count, self.session
+        )
 
-    login_time = now = datetime.now(pytz.utc)
-    answered = None
-    previous_reply_did = None
+    def is_wanted_event(self, event):
+        return stream.is_wanted(event, self.followers, self.bot_did, bot_names)
+
+    def process_stream_batch(self, events):
+        sorted_feed = build_stream_feed(self.session, events)
+        # 重複はストリーム側で除いているので時刻での絞り込みはしない
+        process_timeline(
+            self.session,
+            self.bot_did,
+            datetime.min.replace(tzinfo=pytz.utc),
+            sorted_feed,
+            self.dispatch,
+        )
 
-    # 集計スレッドを常駐で起動
-    aggregate_thread = threading.Thread(
-        target=aggregate_and_count, args=(session,), daemon=True
-    )
-    aggregate_thread.start()
+    async def sync_follows(self):
+        synced = await self.loop.run_in_executor(
+            self.maintenance_executor, update_follow, self.session, username
+        )
+        if not synced:
+            # run_periodically のバックオフで取り直す
+            raise requests.exceptions.HTTPError("failed to get follows/followers")
+        await self.refresh_followers()
+        self.followers_ready.set()
+
+    async def refresh_followers(self):
+        """通知で追加された分も含め、DBのフォロワー一覧を読み直す"""
+        self.followers = await self.loop.run_in_executor(
+            self.maintenance_executor, util.get_follow_graph, connection, "follower"
+        )
+        print(f"[stream] followers:{len(self.followers)}")
+
+    async def consume_stream(self):
+        # フォロワー一覧がないと投稿を絞り込めないので取得を待つ
+        await self.followers_ready.wait()
+        consumer = stream.StreamConsumer(
+            self.is_wanted_event,
+            self.process_stream_batch,
+            cursor=await self.loop.run_in_executor(
+                self.poll_executor, get_stream_cursor
+            ),
+            save_cursor=update_stream_cursor,
+            executor=self.poll_executor,
+        )
+        await consumer.run()
 
-    retry_count = 0
-    max_retries = 5
-    base_delay = 5
+    async def prune_replies(self):
+        before = (datetime.utcnow() - REPLY_LEDGER_RETENTION).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        await self.loop.run_in_executor(
+            self.maintenance_executor, util.delete_old_replies, connection, before
+        )
 
-    while True:
-        try:
-            if (datetime.now(pytz.utc) - login_time) > timedelta(minutes=60):
-                session = login(username, password)
-                login_time = datetime.now(pytz.utc)
+    async def prune_images(self):
+        removed, total = await self.loop.run_in_executor(
+            self.maintenance_executor, archive.prune_images
+        )
+        if removed:
+            print(f"[images] removed {removed} files, {total} bytes left")
 
-            # Notificationを優先的に処理
-            now, answered, previous_reply_did = process_notifications(
-                session, bot_did, now, answered, previous_reply_did
-            )
+    async def prune_logs(self):
+        before = (datetime.utcnow() - LOG_RETENTION).strftime("%Y-%m-%d %H:%M:%S")
+        removed = await self.loop.run_in_executor(
+            self.maintenance_executor, util.rollup_logs, util.connection_logs, before
+        )
+        if removed:
+            print(f"[logs] rolled up {removed} rows older than {before}")
 
-            # 既存のタイムライン処理も継続（フォロワー以外のフォード投稿なども含む）
-            skyline = session.getSkyline(50)
-            feed = skyline.json().get("feed")
-            if feed is None:
-                print("Warning: feed is None, skipping this iteration")
-                time.sleep(3)
-                continue
-            sorted_feed = sorted(feed, key=lambda x: parse(x["post"]["indexedAt"]))
-            now, answered, previous_reply_did = process_timeline(
-                session, bot_did, now, answered, sorted_feed, previous_reply_did
+    async def flush_settings(self):
+        await self.loop.run_in_executor(
+            self.maintenance_executor, util.flush_user_settings, connection
+        )
+
+    async def migrate(self):
+        """
+        起動時に当てなかった時間のかかる変更(大きな表の索引づくり)を当てる
+        atp.db は取り込みと同じスレッドで行い、書き込み同士が待ち合わないようにする
+        logs.db のログは書き込み用のスレッドが溜めてまとめて書くので、待たせてよい
+        その間も WAL なので読み込みは止まらない
+        """
+        try:
+            await asyncio.gather(
+                self.loop.run_in_executor(
+                    self.aggregate_executor,
+                    migrations.migrate,
+                    db.connect("atp.db"),
+                    "atp.db",
+                    True,
+                ),
+                self.loop.run_in_executor(
+                    None,
+                    migrations.migrate,
+                    db.connect("bluesky_bot.db"),
+                    "bluesky_bot.db",
+                    True,
+                ),
+                self.loop.run_in_executor(
+                    None,
+                    migrations.migrate,
+                    db.connect("logs.db"),
+                    "logs.db",
+                    True,
+                ),
             )
+        except Exception as e:
+            # 索引がなくても動くので、次の起動でやり直す
+            print(f"[migrate] failed: {e}")
+            traceback.print_exc()
 
-            # 成功した場合はリトライカウントをリセット
-            retry_count = 0
-
-            # 1回の実行後に3秒スリープ
-            time.sleep(3)
-
-        except (
-            requests.exceptions.ConnectionError,
-            requests.exceptions.Timeout,
-            requests.exceptions.HTTPError,
-        ) as e:
-            retry_count += 1
-            if retry_count > max_retries:
-                print(
-                    f"Max retries ({max_retries}) exceeded. Resetting retry count and continuing..."
+    async def refresh_session(self):
+        # 使われていない間も期限の前にトークンを更新しておく
+        await self.loop.run_in_executor(None, self.session.ensure_fresh)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        WORK_QUEUE_DEPTH.set_function(lambda: len(self.handler_tasks))
+        self.handler_semaphore = asyncio.Semaphore(HANDLER_CONCURRENCY)
+        await self.loop.run_in_executor(
+            self.aggregate_executor,
+            create_count_post_table,
+            db.connect("count_post.db"),
+        )
+        # 前回落ちる前に処理しかけていた反応をやり直す
+        await self.loop.run_in_executor(
+            self.poll_executor, resume_replies, self.session, self.dispatch
+        )
+        tasks = [
+            self.migrate(),
+            self.run_periodically("session", self.refresh_session, 60),
+            self.run_periodically(
+                "notifications",
+                self.poll_notifications,
+                self.poll_interval("notifications"),
+            ),
+            self.run_periodically("aggregate", self.aggregate, AGGREGATE_INTERVAL),
+            self.run_periodically("ledger", self.prune_replies, 60 * 60),
+            self.run_periodically("images", self.prune_images, 60 * 60),
+            self.run_periodically("logs", self.prune_logs, 60 * 60),
+            self.run_periodically(
+                "settings", self.flush_settings, SETTINGS_FLUSH_INTERVAL
+            ),
+        ]
+        self.followers_ready = asyncio.Event()
+        # フォロー・フォロワーの一覧を使うのは、フォローし返すときと
+        # stream でフォロワーの投稿を選ぶときだけ(全件の取得は重いので他では取らない)
+        if FOLLOW_BACK or TIMELINE_SOURCE == "stream":
+            tasks.append(
+                self.run_periodically(
+                    "follows", self.sync_follows, FOLLOW_SYNC_INTERVAL
                 )
-                retry_count = 0
-                delay = base_delay * 6  # より長い待機時間
-            else:
-                # 指数バックオフ: 5, 10, 20, 40, 80秒
-                delay = base_delay * (2 ** (retry_count - 1))
+            )
+        if TIMELINE_SOURCE == "stream":
+            tasks.append(
+                self.run_periodically(
+                    "followers", self.refresh_followers, FOLLOWERS_REFRESH_INTERVAL
+                )
+            )
+            tasks.append(self.consume_stream())
+        else:
+            tasks.append(
+                self.run_periodically(
+                    "timeline", self.poll_timeline, self.poll_interval("timeline")
+                )
+            )
+        await asyncio.gather(*tasks)
 
-            print(f"Network error occurred (attempt {retry_count}): {e}")
-            print(f"Retrying in {delay} seconds...")
-            time.sleep(delay)
-            continue
 
-        except Exception as e:
-            print(f"Unexpected error occurred: {e}")
-            print("Retrying in 5 seconds...")
-            time.sleep(5)
-            continue
+def main():
+    metrics.start_server()
+    session = login(username, password)
+    bot_did = get_did(session, username)
+    journal.record("start", {"handle": username, "did": bot_did, "run_id": RUN_ID})
+    try:
+        asyncio.run(Runtime(session, bot_did).run())
+    finally:
+        # 書き出していないポイントなどの変更とログを残す
+        util.flush_user_settings(connection)
+        util.log_sink.close()
+        journal.journal.close()
 
 
 if __name__ == "__main__":
+    # 画像の変換プロセスがこのファイルを読み込み直して DB を開いてしまう
+    print("[WARN] start the bot with main.py so render workers do not import bot.py")
     main()
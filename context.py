@@ -0,0 +1,130 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+
+import util
+
+# 会話ログ・人格のプロンプト・相手の発言を合わせた見積もりトークン数の上限
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# 1人あたり保持する会話ログの件数(get_recent_dialogs の件数)
+DIALOG_LIMIT = 30
+# 会話ログを保持しておくユーザー数
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", 1000))
+# role などメッセージ1件ごとに掛かる分
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text):
+    """
+    トークン数の見積もり。英数字は4文字で1トークン、日本語などは1文字1トークンとみなす
+    実際のトークナイザより少し多めに出る
+    """
+    ascii_count = sum(1 for c in text if ord(c) < 128)
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count) + MESSAGE_OVERHEAD
+
+
+class DialogLoad:
+    """DBから読み込み中のDIDと、読み込みの間に追加された会話"""
+
+    __slots__ = ("loaders", "appended")
+
+    def __init__(self):
+        self.loaders = 0
+        self.appended = []
+
+
+class DialogCache:
+    """
+    DIDごとの直近の会話ログを (role, content, tokens, id) で保持する
+    DBから読むのは最初の1回だけで、以降はコミットした会話を append で追加する
+    id は dialogs の行の id で、読み込みと追加の両方に入った会話を見分ける
+    """
+
+    def __init__(self, size=CONTEXT_CACHE_SIZE, limit=DIALOG_LIMIT):
+        self.size = size
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.dialogs = OrderedDict()
+        self.loading = {}
+
+    def get(self, connection, did):
+        """古い順の (role, content, tokens, id) のタプルを返す"""
+        with self.lock:
+            dialogs = self.dialogs.get(did)
+            if dialogs is not None:
+                self.dialogs.move_to_end(did)
+                return tuple(dialogs)
+            load = self.loading.get(did)
+            if load is None:
+                load = self.loading[did] = DialogLoad()
+            load.loaders += 1
+
+        try:
+            rows = util.get_recent_dialogs(connection, did, self.limit)
+        finally:
+            with self.lock:
+                load.loaders -= 1
+                if load.loaders == 0:
+                    del self.loading[did]
+        entries = [
+            (row["role"], row["content"], estimate_tokens(row["content"]), row["id"])
+            for row in rows
+        ]
+        with self.lock:
+            dialogs = self.dialogs.get(did)
+            if dialogs is None:
+                # 読んでいる間にコミットされた会話は、読み込んだ結果に入っていなければ足す
+                loaded = {entry[3] for entry in entries}
+                entries += [entry for entry in load.appended if entry[3] not in loaded]
+                entries.sort(key=lambda entry: entry[3])
+                dialogs = deque(entries, maxlen=self.limit)
+                self.dialogs[did] = dialogs
+            # 読んでいる間に他のスレッドが読み込んでいればそちらを使う
+            self.dialogs.move_to_end(did)
+            while len(self.dialogs) > self.size:
+                self.dialogs.popitem(last=False)
+            return tuple(dialogs)
+
+    def append(self, did, role, message, dialog_id):
+        """
+        コミットした会話を追加する。読み込み中のDIDなら読み込んだ後で足し、
+        まだ読み込んでいないDIDなら何もしない(次に読むときにDBから読む)
+        """
+        formatted_date = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        content = f"[{formatted_date}] {message}"
+        entry = (role, content, estimate_tokens(content), dialog_id)
+        with self.lock:
+            dialogs = self.dialogs.get(did)
+            if dialogs is not None:
+                # コミットしてから追加するまでの間に読み込んでいれば、もう入っている
+                if all(cached[3] != dialog_id for cached in dialogs):
+                    dialogs.append(entry)
+                return
+            load = self.loading.get(did)
+            if load is not None:
+                load.appended.append(entry)
+
+
+dialog_cache = DialogCache()
+
+
+def build_dialogs(connection, did, prompt, text, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    プロンプトと相手の発言を入れたうえで budget に収まる分だけ、
+    新しいものから会話ログを選んで古い順のリストで返す(呼び出しごとに新しいリスト)
+    """
+    remaining = budget - estimate_tokens(prompt) - estimate_tokens(text)
+    selected = []
+    for role, content, tokens, _ in reversed(dialog_cache.get(connection, did)):
+        remaining -= tokens
+        if remaining < 0:
+            break
+        selected.append({"role": role, "content": content})
+    selected.reverse()
+    return selected
+
+
+def append_dialog(did, role, message, dialog_id):
+    """コミットしてから呼ぶ"""
+    dialog_cache.append(did, role, message, dialog_id)
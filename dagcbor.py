@@ -0,0 +1,145 @@
+import base64
+import hashlib
+import struct
+import threading
+import time
+
+# DAG-CBOR(codec 0x71)と sha2-256 で作る CIDv1
+CID_VERSION = 1
+DAG_CBOR = 0x71
+SHA2_256 = 0x12
+# CIDへのリンクを表す CBOR のタグ
+CID_TAG = 42
+# TID(レコードキー)に使う base32-sortable のアルファベット
+TID_ALPHABET = "234567abcdefghijklmnopqrstuvwxyz"
+
+
+def varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_head(major, n):
+    """CBOR の型と長さ(値)を最短の形で書く"""
+    if n < 24:
+        return bytes([major << 5 | n])
+    if n < 0x100:
+        return bytes([major << 5 | 24, n])
+    if n < 0x10000:
+        return bytes([major << 5 | 25]) + struct.pack(">H", n)
+    if n < 0x100000000:
+        return bytes([major << 5 | 26]) + struct.pack(">I", n)
+    return bytes([major << 5 | 27]) + struct.pack(">Q", n)
+
+
+def cid_to_bytes(cid):
+    """"bafy..."(multibase base32)の CID をバイト列にする"""
+    if not cid.startswith("b"):
+        raise ValueError(f"unsupported multibase: {cid}")
+    body = cid[1:].upper()
+    return base64.b32decode(body + "=" * (-len(body) % 8))
+
+
+def cid_to_string(cid_bytes):
+    return "b" + base64.b32encode(cid_bytes).decode().lower().rstrip("=")
+
+
+def encode_value(value, out):
+    if value is None:
+        out.append(0xF6)
+    elif value is True:
+        out.append(0xF5)
+    elif value is False:
+        out.append(0xF4)
+    elif isinstance(value, int):
+        if value >= 0:
+            out += encode_head(0, value)
+        else:
+            out += encode_head(1, -1 - value)
+    elif isinstance(value, float):
+        # atproto のレコードには浮動小数点数を入れられない
+        raise ValueError(f"floats are not allowed in records: {value}")
+    elif isinstance(value, bytes):
+        out += encode_head(2, len(value))
+        out += value
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        out += encode_head(3, len(data))
+        out += data
+    elif isinstance(value, (list, tuple)):
+        out += encode_head(4, len(value))
+        for item in value:
+            encode_value(item, out)
+    elif isinstance(value, dict):
+        # JSON 表現の {"$link": cid} と {"$bytes": base64} を CBOR の型に戻す
+        if len(value) == 1 and "$link" in value:
+            link = b"\x00" + cid_to_bytes(value["$link"])
+            out += encode_head(6, CID_TAG)
+            out += encode_head(2, len(link))
+            out += link
+            return
+        if len(value) == 1 and "$bytes" in value:
+            data = value["$bytes"]
+            encode_value(base64.b64decode(data + "=" * (-len(data) % 4)), out)
+            return
+        # キーはUTF-8のバイト列の長さ順、同じ長さならバイト順
+        items = sorted(
+            ((key.encode("utf-8"), item) for key, item in value.items()),
+            key=lambda kv: (len(kv[0]), kv[0]),
+        )
+        out += encode_head(5, len(items))
+        for key, item in items:
+            out += encode_head(3, len(key))
+            out += key
+            encode_value(item, out)
+    else:
+        raise TypeError(f"cannot encode {type(value).__name__} as DAG-CBOR")
+
+
+def encode(value):
+    """JSON 表現のレコードを DAG-CBOR のバイト列にする"""
+    out = bytearray()
+    encode_value(value, out)
+    return bytes(out)
+
+
+def cid_for(value):
+    """レコードの CID(PDS が applyWrites/createRecord で返すのと同じ値)"""
+    digest = hashlib.sha256(encode(value)).digest()
+    cid = (
+        varint(CID_VERSION)
+        + varint(DAG_CBOR)
+        + varint(SHA2_256)
+        + varint(len(digest))
+        + digest
+    )
+    return cid_to_string(cid)
+
+
+_tid_lock = threading.Lock()
+_last_tid = 0
+_clock_id = int.from_bytes(hashlib.sha256(str(time.time_ns()).encode()).digest()[:2])
+
+
+def make_tid():
+    """
+    レコードキーに使う TID。マイクロ秒の時刻(53bit)と clock id(10bit)を
+    base32-sortable で13文字にする。同じプロセスの中では必ず増えていく
+    """
+    global _last_tid
+    with _tid_lock:
+        micros = time.time_ns() // 1000
+        _last_tid = max(micros, _last_tid + 1)
+        n = (_last_tid << 10) | (_clock_id & 0x3FF)
+    chars = []
+    for _ in range(13):
+        chars.append(TID_ALPHABET[n & 0x1F])
+        n >>= 5
+    return "".join(reversed(chars))
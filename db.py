@@ -0,0 +1,199 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# WAL にしておくと読み込みが書き込みを待たなくなる。
+# synchronous=NORMAL は WAL ではチェックポイント時のみ fsync する
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+)
+
+# スレッドごと・接続ごとに保持するプリペアドステートメントの数
+CACHED_STATEMENTS = 256
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class Connection(sqlite3.Connection):
+    """unit_of_work() の中では commit() を外側の終了時までまとめる"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.work_depth = 0
+        self.savepoint_depth = 0
+        # コミットできたら呼ぶ関数(after_commit)
+        self.committed_callbacks = []
+
+    def commit(self):
+        if self.work_depth > 0:
+            return
+        super().commit()
+        self.run_committed_callbacks()
+
+    def rollback(self):
+        super().rollback()
+        self.committed_callbacks = []
+
+    def after_commit(self, callback):
+        """
+        今のトランザクションがコミットできたら callback() を呼ぶ
+        (取り消されたら呼ばない)。トランザクションの外ならすぐに呼ぶ
+        """
+        if not self.in_transaction:
+            callback()
+            return
+        self.committed_callbacks.append(callback)
+
+    def run_committed_callbacks(self):
+        callbacks, self.committed_callbacks = self.committed_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    # unit_of_work() の中の with connection: もコミットせず、セーブポイントにする
+    # (ブロック内の例外ではそのブロックの書き込みだけを取り消す)
+    def __enter__(self):
+        if self.work_depth == 0:
+            return super().__enter__()
+        if not self.in_transaction:
+            # トランザクションの外で SAVEPOINT を始めると RELEASE がコミットになる
+            self.execute("BEGIN")
+        self.execute("SAVEPOINT unit_of_work")
+        self.savepoint_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.work_depth == 0:
+            # sqlite3 の __exit__ は commit() / rollback() を経由しない
+            result = super().__exit__(exc_type, exc_value, traceback)
+            if exc_type is None:
+                self.run_committed_callbacks()
+            else:
+                self.committed_callbacks = []
+            return result
+        self.savepoint_depth -= 1
+        if exc_type is not None:
+            self.execute("ROLLBACK TO unit_of_work")
+        self.execute("RELEASE unit_of_work")
+        return False
+
+    def commit_pending(self):
+        """
+        unit_of_work() の中でも、それまでの書き込みをコミットして書き込みのロックを放す
+        with connection: の途中(セーブポイントの中)では何もしない
+        """
+        if self.in_transaction and self.savepoint_depth == 0:
+            super().commit()
+            self.run_committed_callbacks()
+
+
+class Database:
+    """
+    ファイルごとに1つ作り、スレッドごとに別の接続を使う
+    sqlite3.Connection と同じように cursor() / commit() などを呼べる
+    """
+
+    def __init__(self, path, row_factory=sqlite3.Row):
+        self.path = path
+        self.row_factory = row_factory
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=30,
+                factory=Connection,
+                cached_statements=CACHED_STATEMENTS,
+            )
+            connection.row_factory = self.row_factory
+            for pragma in PRAGMAS:
+                connection.execute(pragma)
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        """このスレッドの接続を閉じる"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.connection.__exit__(*exc_info)
+
+
+def connect(path, row_factory=sqlite3.Row):
+    """同じファイルには同じ Database を返す"""
+    with _databases_lock:
+        database = _databases.get(path)
+        if database is None:
+            database = Database(path, row_factory)
+            _databases[path] = database
+        return database
+
+
+def commit_pending(*databases):
+    """
+    このスレッドの書き込みをすぐにコミットする。ネットワークを待つ前に呼び、
+    unit_of_work() の中でも書き込みのロックを持ったまま待たないようにする
+    (その後の書き込みは次のトランザクションにまとまる)
+    """
+    for database in databases:
+        database.connection.commit_pending()
+
+
+def after_commit(database, callback):
+    """このスレッドの書き込みがコミットされてから callback() を呼ぶ"""
+    database.connection.after_commit(callback)
+
+
+@contextmanager
+def snapshot(database):
+    """
+    ブロック内の読み込みを1つのトランザクションにまとめ、同じ時点の内容を読む(WAL)
+    間に別の接続がコミットしても、ブロックの中からは見えない
+    """
+    connection = getattr(database, "connection", database)
+    if connection.in_transaction:
+        # すでにトランザクションの中なら、その中で読む
+        yield
+        return
+    connection.execute("BEGIN")
+    try:
+        yield
+    finally:
+        if connection.in_transaction:
+            connection.execute("COMMIT")
+
+
+@contextmanager
+def unit_of_work(*databases):
+    """
+    ブロック内の commit() をまとめて最後に1回だけコミットする
+    ただし commit_pending() を呼んだところ(ネットワークを待つ前)ではコミットする
+    例外で抜けた場合もそこまでの書き込みはコミットする(都度コミットしていた頃と同じ結果)
+    """
+    connections = [database.connection for database in databases]
+    for connection in connections:
+        connection.work_depth += 1
+    try:
+        yield
+    finally:
+        for connection in connections:
+            connection.work_depth -= 1
+            if connection.work_depth == 0:
+                connection.commit()
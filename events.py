@@ -0,0 +1,116 @@
+from datetime import datetime
+from dateutil.parser import parse
+
+
+def parse_time(value):
+    """
+    indexedAt などの日時を datetime にする
+    atproto の日時は ISO 8601 の決まった形なので fromisoformat で読み、
+    読めない形のときだけ dateutil に回す(dateutil は数十倍遅い)
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parse(value)
+
+
+def can_reply(author):
+    """ミュート・ブロックされておらず、フォローされている相手か(JSONのまま判定する)"""
+    viewer = author.get("viewer") or {}
+    if viewer.get("muted") or viewer.get("blockedBy"):
+        return False
+    followed_by = viewer.get("followedBy")
+    return followed_by is not None and author.get("did") in followed_by
+
+
+def mentions_others(record, bot_did):
+    """本文で自分以外にメンションしているか"""
+    for facet in record.get("facets") or ():
+        for feature in facet.get("features") or ():
+            if "did" in feature and feature["did"] != bot_did:
+                return True
+    return False
+
+
+class Author:
+    __slots__ = ("did", "handle", "display_name")
+
+    def __init__(self, author):
+        self.did = author["did"]
+        self.handle = author["handle"]
+        # displayName がない場合は None(空文字とは区別する)
+        self.display_name = author.get("displayName")
+
+
+class Record:
+    __slots__ = ("text", "facets")
+
+    def __init__(self, record):
+        self.text = record.get("text", "")
+        self.facets = record.get("facets")
+
+
+class Ref:
+    """リプライの root / parent。タイムラインでは投稿、通知では uri と cid だけ"""
+
+    __slots__ = ("uri", "cid", "handle")
+
+    def __init__(self, ref):
+        self.uri = ref.get("uri")
+        self.cid = ref.get("cid")
+        self.handle = (ref.get("author") or {}).get("handle")
+
+
+class Reply:
+    __slots__ = ("root", "parent")
+
+    def __init__(self, reply):
+        self.root = Ref(reply.get("root") or {})
+        self.parent = Ref(reply.get("parent") or {})
+
+
+class Post:
+    __slots__ = ("uri", "cid", "author", "record", "indexed_at")
+
+    def __init__(self, post):
+        self.uri = post["uri"]
+        self.cid = post["cid"]
+        self.author = Author(post["author"])
+        self.record = Record(post["record"])
+        self.indexed_at = post["indexedAt"]
+
+
+class Event:
+    """
+    反応する投稿1件。タイムライン(getTimeline の1行)と通知のどちらも同じ形にする
+    raw は元の1行(台帳にはこれを JSON で保存し、Event(json.loads(...)) で戻す)
+    """
+
+    __slots__ = ("raw", "post", "reply", "at")
+
+    def __init__(self, line, at=None):
+        self.raw = line
+        self.post = Post(line["post"])
+        reply = line.get("reply")
+        self.reply = Reply(reply) if reply else None
+        self.at = at if at is not None else parse_time(self.post.indexed_at)
+
+    def __repr__(self):
+        return f"Event({self.raw!r})"
+
+    @classmethod
+    def from_notification(cls, notification, at=None):
+        """通知をタイムラインの1行と同じ形にして作る"""
+        line = {
+            "post": {
+                "author": notification["author"],
+                "record": notification["record"],
+                "cid": notification.get("cid"),
+                "uri": notification.get("uri"),
+                "indexedAt": notification.get("indexedAt"),
+            }
+        }
+        # リプライの場合はreply情報を追加
+        if "reply" in notification["record"]:
+            line["reply"] = notification["record"]["reply"]
+        return cls(line, at)
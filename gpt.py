@@ -3,113 +3,264 @@ from dotenv import load_dotenv
 import os
 import traceback
 import time
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import journal
 
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path)
 
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+# OpenAI 互換のサーバー(stand_in/llm.py など)を使う場合は .env で指定する
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+client = OpenAI(api_key=os.environ["OPENAI_API_KEY"], base_url=OPENAI_BASE_URL)
 
+# 同時に投げるリクエスト数の上限(複数のスレッドから呼ばれる)
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", 4))
+gpt_semaphore = threading.BoundedSemaphore(GPT_CONCURRENCY)
+# キューに積んだ問い合わせの期限(秒)。リトライもこの時間内で打ち切る
+ANSWER_DEADLINE = float(os.getenv("ANSWER_DEADLINE", 180))
 
-def get_answer(prompt, text, massages=[]):
+
+GPT_SECONDS = metrics.histogram(
+    "bot_gpt_request_seconds", "OpenAI API call latency", ("model",)
+)
+GPT_REQUESTS = metrics.counter(
+    "bot_gpt_requests_total", "OpenAI API calls by result", ("model", "result")
+)
+GPT_TOKENS = metrics.counter(
+    "bot_gpt_tokens_total", "Tokens used by OpenAI API calls", ("model", "kind")
+)
+
+
+def record_response(tag, model, response):
+    """応答の件数とトークン数を記録する(応答全体は出力しない)"""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        GPT_TOKENS.inc(model, "prompt", amount=usage.prompt_tokens or 0)
+        GPT_TOKENS.inc(model, "completion", amount=usage.completion_tokens or 0)
+    print(f"[{tag}] Response received: model={model} usage={usage}")
+
+
+def time_left(deadline, timeout):
+    """deadline(time.monotonic() 基準)までの残り秒数で timeout を切り詰める"""
+    if deadline is None:
+        return timeout
+    return max(min(timeout, deadline - time.monotonic()), 0)
+
+
+def journaled(func):
+    """問い合わせの本文と答え、かかった時間をジャーナルに残す(プロンプトは長さだけ)"""
+
+    @functools.wraps(func)
+    def wrapper(prompt, text, *args, **kwargs):
+        if not journal.journal.enabled:
+            return func(prompt, text, *args, **kwargs)
+        start = time.monotonic()
+        answer = func(prompt, text, *args, **kwargs)
+        journal.record(
+            "gpt",
+            {
+                "func": func.__name__,
+                "prompt_chars": len(prompt),
+                "text": text,
+                "answer": answer,
+                "seconds": round(time.monotonic() - start, 3),
+            },
+        )
+        return answer
+
+    return wrapper
+
+
+@journaled
+def get_answer(prompt, text, massages=None, deadline=None):
     answer = None
     error_count = 0
-    massages.extend(
-        [
-            {"role": "system", "content": f"{prompt}"},
-            {"role": "user", "content": f"{text}"},
-        ]
-    )
+    # 呼び出し元のリストは変更しない
+    massages = [
+        *(massages or []),
+        {"role": "system", "content": f"{prompt}"},
+        {"role": "user", "content": f"{text}"},
+    ]
     while answer is None and error_count < 5:
+        timeout = time_left(deadline, 30)
+        if timeout <= 0:
+            print("[GPT] Deadline exceeded")
+            break
         try:
             print(f"[GPT] Calling gpt-5-mini with {len(massages)} messages")
-            response = client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=massages,
-                timeout=30,
-            )
-            print(f"[GPT] Response received: {response}")
+            with gpt_semaphore, GPT_SECONDS.time("gpt-5-mini"):
+                response = client.chat.completions.create(
+                    model="gpt-5-mini",
+                    messages=massages,
+                    timeout=timeout,
+                )
+            record_response("GPT", "gpt-5-mini", response)
             if response.choices and len(response.choices) > 0:
+                GPT_REQUESTS.inc("gpt-5-mini", "ok")
                 answer = response.choices[0].message.content
                 print(f"[GPT] Answer extracted: {answer[:100]}...")
             else:
+                GPT_REQUESTS.inc("gpt-5-mini", "empty")
                 print("[GPT] No choices in response")
                 error_count += 1
-                time.sleep(10)
+                time.sleep(time_left(deadline, 10))
 
         except Exception as e:
+            GPT_REQUESTS.inc("gpt-5-mini", "error")
             print(f"[GPT] Exception occurred: {type(e).__name__}: {e}")
             trace = traceback.format_exc()
             print(trace)
             error_count += 1
-            time.sleep(10)
+            time.sleep(time_left(deadline, 10))
 
     print(f"[GPT] Final answer: {answer}")
     return answer
 
 
-def get_answer5_nano(prompt, text):
+@journaled
+def get_answer5_nano(prompt, text, deadline=None):
     answer = None
     error_count = 0
     while answer is None and error_count < 5:
+        timeout = time_left(deadline, 120)
+        if timeout <= 0:
+            print("[GPT5] Deadline exceeded")
+            break
         try:
             print(f"[GPT5] Calling gpt-5-nano with prompt length: {len(prompt)}")
-            response = client.chat.completions.create(
-                model="gpt-5-nano",
-                messages=[
-                    {"role": "system", "content": f"{prompt}"},
-                    {"role": "user", "content": f"{text}"},
-                ],
-                timeout=120,
-            )
-            print(f"[GPT5] Response received: {response}")
+            with gpt_semaphore, GPT_SECONDS.time("gpt-5-nano"):
+                response = client.chat.completions.create(
+                    model="gpt-5-nano",
+                    messages=[
+                        {"role": "system", "content": f"{prompt}"},
+                        {"role": "user", "content": f"{text}"},
+                    ],
+                    timeout=timeout,
+                )
+            record_response("GPT5", "gpt-5-nano", response)
             if response.choices and len(response.choices) > 0:
+                GPT_REQUESTS.inc("gpt-5-nano", "ok")
                 answer = response.choices[0].message.content
                 print(f"[GPT5] Answer extracted: {answer[:100]}...")
             else:
+                GPT_REQUESTS.inc("gpt-5-nano", "empty")
                 print("[GPT5] No choices in response")
                 error_count += 1
-                time.sleep(10)
+                time.sleep(time_left(deadline, 10))
 
         except Exception as e:
+            GPT_REQUESTS.inc("gpt-5-nano", "error")
             print(f"[GPT5] Exception occurred: {type(e).__name__}: {e}")
             trace = traceback.format_exc()
             print(trace)
             error_count += 1
-            time.sleep(10)
+            time.sleep(time_left(deadline, 10))
 
     print(f"[GPT5] Final answer: {answer}")
     return answer
 
 
-def get_answer5(prompt, text):
+@journaled
+def get_answer5(prompt, text, deadline=None):
     answer = None
     error_count = 0
     while answer is None and error_count < 5:
+        timeout = time_left(deadline, 120)
+        if timeout <= 0:
+            print("[GPT5] Deadline exceeded")
+            break
         try:
             print(f"[GPT5] Calling gpt-5 with prompt length: {len(prompt)}")
-            response = client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=[
-                    {"role": "system", "content": f"{prompt}"},
-                    {"role": "user", "content": f"{text}"},
-                ],
-                timeout=120,
-            )
-            print(f"[GPT5] Response received: {response}")
+            with gpt_semaphore, GPT_SECONDS.time("gpt-5-mini"):
+                response = client.chat.completions.create(
+                    model="gpt-5-mini",
+                    messages=[
+                        {"role": "system", "content": f"{prompt}"},
+                        {"role": "user", "content": f"{text}"},
+                    ],
+                    timeout=timeout,
+                )
+            record_response("GPT5", "gpt-5-mini", response)
             if response.choices and len(response.choices) > 0:
+                GPT_REQUESTS.inc("gpt-5-mini", "ok")
                 answer = response.choices[0].message.content
                 print(f"[GPT5] Answer extracted: {answer[:100]}...")
             else:
+                GPT_REQUESTS.inc("gpt-5-mini", "empty")
                 print("[GPT5] No choices in response")
                 error_count += 1
-                time.sleep(10)
+                time.sleep(time_left(deadline, 10))
 
         except Exception as e:
+            GPT_REQUESTS.inc("gpt-5-mini", "error")
             print(f"[GPT5] Exception occurred: {type(e).__name__}: {e}")
             trace = traceback.format_exc()
             print(trace)
             error_count += 1
-            time.sleep(10)
+            time.sleep(time_left(deadline, 10))
 
     print(f"[GPT5] Final answer: {answer}")
     return answer
+
+
+class AnswerQueue:
+    """
+    問い合わせをワーカースレッドで実行するジョブキュー
+    同じ key のジョブは積んだ順に1件ずつ、別の key のジョブは並列に実行する
+    終わったら callback(answer) を呼ぶ。期限切れや失敗の場合 answer は None
+    """
+
+    def __init__(self, concurrency=GPT_CONCURRENCY, deadline=ANSWER_DEADLINE):
+        self.executor = ThreadPoolExecutor(concurrency, thread_name_prefix="gpt")
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        # key ごとの順番待ち。key があれば同じ key のジョブが実行中
+        self.waiting = {}
+
+    def submit(self, key, func, args, callback, deadline=None):
+        """func(*args, deadline=...) を実行するジョブを積む"""
+        if deadline is None:
+            deadline = self.deadline
+        job = (func, args, callback, time.monotonic() + deadline)
+        with self.lock:
+            waiting = self.waiting.get(key)
+            if waiting is not None:
+                waiting.append(job)
+                return
+            self.waiting[key] = deque()
+        self.executor.submit(self._run, key, job)
+
+    def backlog(self):
+        """実行中と順番待ちのジョブの数"""
+        with self.lock:
+            return sum(len(waiting) + 1 for waiting in self.waiting.values())
+
+    def _run(self, key, job):
+        func, args, callback, deadline = job
+        answer = None
+        try:
+            if time.monotonic() < deadline:
+                answer = func(*args, deadline=deadline)
+            else:
+                print(f"[GPT] Job for {key} expired before start")
+        except Exception as e:
+            print(f"[GPT] Exception occurred: {type(e).__name__}: {e}")
+            traceback.print_exc()
+        try:
+            callback(answer)
+        except Exception as e:
+            print(f"[GPT] Exception in callback: {type(e).__name__}: {e}")
+            traceback.print_exc()
+
+        # 同じ key の次のジョブを実行する
+        with self.lock:
+            waiting = self.waiting[key]
+            if not waiting:
+                del self.waiting[key]
+                return
+            job = waiting.popleft()
+        self.executor.submit(self._run, key, job)
@@ -0,0 +1,163 @@
+import atexit
+import glob
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import zlib
+from datetime import datetime
+from dotenv import load_dotenv
+import metrics
+
+# gpt.py より先に import されるので、ここでも .env を読む
+dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
+load_dotenv(dotenv_path)
+
+# 取得した通知・タイムライン、GPTの問い合わせ、投稿を記録するディレクトリ
+# 空なら記録しない。記録は benchmarks/replay.py で流し直せる
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "")
+# 1ファイル(gzip の JSONL)に書く件数。超えたら次のファイルに移る
+JOURNAL_SEGMENT_RECORDS = int(os.getenv("JOURNAL_SEGMENT_RECORDS", 10000))
+JOURNAL_QUEUE_SIZE = 10000
+SEGMENT_SUFFIX = ".jsonl.gz"
+
+JOURNAL_DROPPED = metrics.counter(
+    "bot_journal_dropped_total", "Journal records dropped because the queue was full"
+)
+
+
+class Journal:
+    """
+    1行1件の JSON を gzip のファイルに追記する。書くのは専用のスレッドで、
+    呼び出し側は JSON にしてキューに積むだけ。キューがあふれたら捨てて数える
+    ファイルはまとめて書くたびに flush するので、途中で止まってもそこまでは読める
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_records=JOURNAL_SEGMENT_RECORDS,
+        queue_size=JOURNAL_QUEUE_SIZE,
+    ):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def record(self, kind, data):
+        if not self.directory:
+            return
+        # 呼び出し元があとで中身を変えても記録が変わらないよう、ここで文字列にする
+        line = json.dumps(
+            {"t": time.time(), "kind": kind, "data": data},
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=str,
+        )
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            JOURNAL_DROPPED.inc()
+            return
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.thread = threading.Thread(
+                target=self.run, name="journal-writer", daemon=True
+            )
+            self.thread.start()
+        atexit.register(self.close)
+
+    def open_segment(self, index):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.directory, f"{stamp}-{index:04d}{SEGMENT_SUFFIX}")
+        # 同じ名前のファイルがあっても消さずに後ろに足す(gzip は続けて読める)
+        return gzip.open(path, "at", encoding="utf-8")
+
+    def run(self):
+        index = 0
+        file = None
+        written = 0
+        stop = False
+        while not stop:
+            line = self.queue.get()
+            batch = []
+            while line is not None:
+                batch.append(line)
+                try:
+                    line = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+            try:
+                for line in batch:
+                    if file is None or written >= self.segment_records:
+                        if file is not None:
+                            file.close()
+                        file = self.open_segment(index)
+                        index += 1
+                        written = 0
+                    file.write(line + "\n")
+                    written += 1
+                if file is not None:
+                    if stop:
+                        file.close()
+                    else:
+                        file.flush()
+            except Exception:
+                traceback.print_exc()
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+
+    def flush(self):
+        """積んだ記録が書き終わるまで待つ"""
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """残りを書いてファイルを閉じる"""
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(None)
+        thread.join(timeout=10)
+
+
+def segments(path):
+    """path(ディレクトリかファイル)の記録ファイルを古い順に返す"""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*" + SEGMENT_SUFFIX)))
+    return [path]
+
+
+def read(path):
+    """記録を (時刻, 種類, 中身) で古い順に返す。書きかけのファイルは読めたところまで"""
+    for segment in segments(path):
+        try:
+            with gzip.open(segment, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.endswith("\n"):
+                        entry = json.loads(line)
+                        yield entry["t"], entry["kind"], entry["data"]
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            # 止まったときに書きかけだったファイル
+            print(f"[journal] {segment} is truncated")
+
+
+journal = Journal(JOURNAL_DIR)
+record = journal.record
@@ -0,0 +1,10 @@
+# ボットの起動用(python -u main.py)
+# 画像の変換プロセス(render.RenderPool)は起動したファイルを __mp_main__ として
+# 読み込み直す。bot.py を直接起動すると、変換プロセスごとに DB を開いて
+# マイグレーションを当てるなど bot.py の副作用がすべて走るので、ここでは何も import
+# せず、起動したときだけ bot を読み込む
+
+if __name__ == "__main__":
+    import bot
+
+    bot.main()
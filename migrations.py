@@ -0,0 +1,171 @@
+import argparse
+import os
+import sqlite3
+import time
+
+# 各データベースのスキーマのバージョンはファイルの PRAGMA user_version に記録する
+# 起動時に、まだ当てていない変更をバージョンの順に当てる。どの変更も何度当てても
+# 同じ結果になるように書く(IF NOT EXISTS や列の有無の確認)
+
+
+class Migration:
+    """
+    version に上げる変更1つ。steps は SQL の文字列か、接続を受け取る関数
+    background=True は大きな表の索引づくりなど時間のかかるもので、起動時には当てず
+    Runtime が起動後に別のスレッドで当てる
+    """
+
+    __slots__ = ("version", "description", "steps", "background")
+
+    def __init__(self, version, description, steps, background=False):
+        self.version = version
+        self.description = description
+        self.steps = steps
+        self.background = background
+
+
+def add_log_level(connection):
+    # level は後から追加した列なので、古い logs.db には足す
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(logs)")]
+    if "level" not in columns:
+        connection.execute(
+            "ALTER TABLE logs ADD COLUMN level INTEGER NOT NULL DEFAULT 20"
+        )
+
+
+MIGRATIONS = {
+    "atp.db": [
+        # get_last_created_at の MAX(created_at) を索引の端を読むだけにする
+        # endpoint も含めておくと get_user_count も表より小さいこの索引だけを読む
+        Migration(
+            1,
+            "index users by created_at (covering endpoint)",
+            [
+                "CREATE INDEX IF NOT EXISTS users_created_at"
+                " ON users (created_at, endpoint)",
+            ],
+            background=True,
+        ),
+    ],
+    "bluesky_bot.db": [
+        # get_recent_dialogs(did ごとの新しい順)、get_fortune_counts と
+        # get_latest_record_by_did(占いの回数と間隔)
+        Migration(
+            1,
+            "index dialogs and reactions by did and created_at",
+            [
+                "CREATE INDEX IF NOT EXISTS dialogs_did_created_at"
+                " ON dialogs (did, created_at)",
+                "CREATE INDEX IF NOT EXISTS reactions_did_created_at"
+                " ON reactions (did, created_at)",
+            ],
+            background=True,
+        ),
+    ],
+    "logs.db": [
+        Migration(1, "add logs.level", [add_log_level]),
+        # 種類・ユーザー(param1)ごとにログを引く索引と、古いログをまとめる
+        # rollup_logs の索引。logs は大きいので起動後に作る
+        Migration(
+            2,
+            "index logs by kind, param1 and created_at",
+            [
+                "CREATE INDEX IF NOT EXISTS logs_kind_param1_created_at"
+                " ON logs (kind, param1, created_at)",
+                "CREATE INDEX IF NOT EXISTS logs_created_at ON logs (created_at)",
+            ],
+            background=True,
+        ),
+    ],
+}
+
+
+def get_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply(connection, name, migration):
+    """
+    1つの変更とバージョンの更新を同じトランザクションで行う。当てたらTrue
+    別のプロセスが先に当てていれば何もしない
+    """
+    started = time.perf_counter()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        if get_version(connection) >= migration.version:
+            connection.rollback()
+            return False
+        for step in migration.steps:
+            if callable(step):
+                step(connection)
+            else:
+                connection.execute(step)
+        connection.execute(f"PRAGMA user_version = {int(migration.version)}")
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    seconds = time.perf_counter() - started
+    print(
+        f"[migrate] {name} v{migration.version}: {migration.description}"
+        f" ({seconds:.1f}s)"
+    )
+    return True
+
+
+def migrate(connection, name, background=False):
+    """
+    name(db.connect に渡すファイル名)の変更のうち、まだ当てていないものを順に当てる
+    background=False なら時間のかかる変更の手前で止める(後の変更も順番を守って待つ)
+    当てた数を返す
+    """
+    applied = 0
+    version = get_version(connection)
+    for migration in MIGRATIONS.get(name, ()):
+        if migration.version <= version:
+            continue
+        if migration.background and not background:
+            break
+        if apply(connection, name, migration):
+            applied += 1
+    return applied
+
+
+def pending(connection, name):
+    """まだ当てていない変更"""
+    version = get_version(connection)
+    return [m for m in MIGRATIONS.get(name, ()) if m.version > version]
+
+
+def main():
+    """ボットを止めている間にまとめて当てる場合に使う"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths", nargs="*", default=list(MIGRATIONS), help="既定はカレントの全ファイル"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="当てていない変更を表示するだけ"
+    )
+    args = parser.parse_args()
+    for path in args.paths:
+        name = os.path.basename(path)
+        if name not in MIGRATIONS:
+            print(f"{path}: no migrations for {name}")
+            continue
+        if not os.path.exists(path):
+            # 表はボットの起動時に作るので、まだないファイルには当てない
+            print(f"{path}: not found")
+            continue
+        connection = sqlite3.connect(path, timeout=30)
+        try:
+            if args.dry_run:
+                for migration in pending(connection, name):
+                    print(f"{path} v{migration.version}: {migration.description}")
+            else:
+                migrate(connection, name, background=True)
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
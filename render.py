@@ -0,0 +1,264 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# 同時に変換するプロセス数
+RENDER_CONCURRENCY = int(os.getenv("RENDER_CONCURRENCY", 1))
+# 1枚あたりのCPU時間(秒)と、変換プロセスのメモリ上限(バイト)
+RENDER_CPU_SECONDS = int(os.getenv("RENDER_CPU_SECONDS", 10))
+RENDER_MEMORY_BYTES = int(os.getenv("RENDER_MEMORY_BYTES", 512 * 1024 * 1024))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 20))
+# 受け付けるSVGの大きさと、出力するPNGの画素数・バイト数の上限
+MAX_SVG_BYTES = 512 * 1024
+MAX_PIXELS = 2048 * 2048
+# Blueskyの画像の上限(1,000,000バイト)に合わせる
+MAX_PNG_BYTES = 1000000
+RENDER_CACHE_SIZE = 32
+# PNGを減色するときの色数(0なら減色せず、可逆の圧縮だけ行う)
+PNG_PALETTE_COLORS = int(os.getenv("PNG_PALETTE_COLORS", 256))
+
+
+class RenderError(Exception):
+    pass
+
+
+def normalize_svg(svg):
+    """キャッシュのキー用に、改行や要素の間の空白の違いをならす"""
+    svg = svg.replace("\r\n", "\n").strip()
+    return re.sub(r">\s+<", "><", svg)
+
+
+def svg_key(svg):
+    return hashlib.sha256(normalize_svg(svg).encode()).hexdigest()
+
+
+def parse_length(value):
+    match = re.match(r"\s*([0-9.]+)", value or "")
+    return float(match.group(1)) if match else None
+
+
+def get_scale(svg):
+    """width/height(なければ viewBox)から、MAX_PIXELS に収まる拡大率を求める"""
+    try:
+        root = ElementTree.fromstring(svg)
+    except ElementTree.ParseError as e:
+        raise RenderError(f"invalid svg: {e}")
+    width = parse_length(root.get("width"))
+    height = parse_length(root.get("height"))
+    if not (width and height) and root.get("viewBox"):
+        parts = root.get("viewBox").replace(",", " ").split()
+        if len(parts) == 4:
+            width, height = parse_length(parts[2]), parse_length(parts[3])
+    if not (width and height) or width * height <= MAX_PIXELS:
+        return 1
+    return (MAX_PIXELS / (width * height)) ** 0.5
+
+
+def _no_fetch(url, resource_type=None):
+    """SVGの中の外部ファイル・URLは読みに行かない"""
+    raise ValueError(f"external resource is not allowed: {url}")
+
+
+def optimize_png(png, colors=PNG_PALETTE_COLORS):
+    """
+    アップロードするPNGを小さくする。colors 色以下に減色(パレット化)し、
+    最大の圧縮レベルで書き直す。元より大きくなれば元のまま返す
+    """
+    from io import BytesIO
+
+    from PIL import Image
+
+    image = Image.open(BytesIO(png))
+    image.load()
+    if colors and image.mode != "P":
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        # FASTOCTREE は透過(RGBA)のまま減色できる
+        image = image.quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", optimize=True, compress_level=9)
+    optimized = buffer.getvalue()
+    return optimized if len(optimized) < len(png) else png
+
+
+def _init_worker(memory_bytes):
+    import resource
+
+    resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def _run_job(timeout, func, *args):
+    """
+    変換プロセスで実行する。経過時間の上限はこのジョブの開始時点から数え、
+    超えると SIGALRM でプロセスごと終わる(cairosvg の処理の途中でも止まる)
+    """
+    import signal
+
+    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _render(svg, scale, cpu_seconds):
+    """変換プロセスで実行する。CPU時間の上限はこのジョブの開始時点から数える"""
+    import resource
+
+    import cairosvg
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime)
+    # 超えると SIGXCPU でプロセスごと終わる
+    # (ハード上限は一度下げると戻せないので、ソフト上限だけをジョブごとに付け直す)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, hard))
+    try:
+        png = cairosvg.svg2png(
+            bytestring=svg.encode(), scale=scale, url_fetcher=_no_fetch
+        )
+        return optimize_png(png)
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+
+class RenderPool:
+    """
+    SVGからPNGへの変換を別プロセスで行う。同じSVGの結果は LRU で使い回す
+    変換プロセスは1つずつ別の ProcessPoolExecutor にして、1回に1つのジョブだけを
+    渡す。上限を超えて落ちたときに道連れになるジョブがなく、落ちたものだけを作り直す
+    """
+
+    def __init__(
+        self,
+        workers=RENDER_CONCURRENCY,
+        cpu_seconds=RENDER_CPU_SECONDS,
+        memory_bytes=RENDER_MEMORY_BYTES,
+        timeout=RENDER_TIMEOUT,
+        cache_size=RENDER_CACHE_SIZE,
+    ):
+        self.workers = workers
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        # 空いている変換プロセスの数と、作ってあって空いているもの
+        self.available = threading.Semaphore(workers)
+        self.idle = []
+        self.counts = {"renders": 0, "cache_hits": 0, "failures": 0}
+
+    def new_executor(self):
+        # スレッドを持つ親プロセスを fork しないよう、render だけを読み込んだ
+        # forkserver から fork する。子プロセスは起動したファイルを
+        # __mp_main__ として読み込み直すので、ボットは main.py から起動する
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["render"])
+        return ProcessPoolExecutor(
+            1,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.memory_bytes,),
+        )
+
+    def acquire(self):
+        """空いている変換プロセスを借りる。すべて使用中なら空くまで待つ"""
+        self.available.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.new_executor()
+
+    def release(self, executor, broken=False):
+        if broken:
+            # プロセスはもう終わっているので待たない
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            with self.lock:
+                self.idle.append(executor)
+        self.available.release()
+
+    def call(self, func, *args):
+        """
+        func(*args) を変換プロセスで実行する。経過時間の上限(timeout)は
+        プロセスが空くのを待つ間ではなく、ジョブが始まってから数える
+        """
+        executor = self.acquire()
+        future = None
+        try:
+            future = executor.submit(_run_job, self.timeout, func, *args)
+            # 上限を超えたプロセスは自分で終わる。ここでの待ち時間の上限は、
+            # それでも返ってこないときのための保険
+            return future.result(timeout=self.timeout + 10)
+        finally:
+            # 落ちたプロセスと、返ってこないままのプロセスは使い回さない
+            broken = (
+                future is None
+                or not future.done()
+                or isinstance(future.exception(), BrokenProcessPool)
+            )
+            self.release(executor, broken)
+
+    def shutdown(self):
+        """空いている変換プロセスを止める(呼んだ後も、次の変換で作り直す)"""
+        with self.lock:
+            executors, self.idle = self.idle, []
+        for executor in executors:
+            executor.shutdown()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def svg_to_png(self, svg):
+        """減色・圧縮したPNGのバイト列を返す。変換できなければ RenderError"""
+        if len(svg.encode()) > MAX_SVG_BYTES:
+            raise RenderError(f"svg too large: {len(svg.encode())} bytes")
+        key = svg_key(svg)
+        with self.lock:
+            png = self.cache.get(key)
+            if png is not None:
+                self.cache.move_to_end(key)
+                self.counts["cache_hits"] += 1
+                return png
+
+        scale = get_scale(svg)
+        try:
+            png = self.call(_render, svg, scale, self.cpu_seconds)
+        except FutureTimeoutError:
+            self.count("failures")
+            raise RenderError(f"render timed out after {self.timeout}s")
+        except BrokenProcessPool:
+            # 経過時間・CPU時間・メモリのどれかの上限を超えて、プロセスが終わった
+            self.count("failures")
+            raise RenderError("render process died (time, cpu or memory limit)")
+        except Exception as e:
+            self.count("failures")
+            raise RenderError(f"render failed: {type(e).__name__}: {e}")
+        if len(png) > MAX_PNG_BYTES:
+            self.count("failures")
+            raise RenderError(f"png too large: {len(png)} bytes")
+
+        self.count("renders")
+        with self.lock:
+            self.cache[key] = png
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return png
+
+
+render_pool = RenderPool()
+
+
+def svg_to_png(svg):
+    return render_pool.svg_to_png(svg)
@@ -0,0 +1,100 @@
+import os
+import time
+from dotenv import load_dotenv
+import metrics
+
+# 単独で import されても .env の設定を読む
+dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
+load_dotenv(dotenv_path)
+
+# ポーリングの最短・最長の間隔(秒)
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", 3))
+POLL_INTERVAL_MAX = float(os.getenv("POLL_INTERVAL_MAX", 30))
+# 1回の取得でこのくらいの件数が取れる間隔にする(小さいほど返信が早い)
+POLL_TARGET_EVENTS = float(os.getenv("POLL_TARGET_EVENTS", 1))
+# 到着の速さの指数移動平均の重み(大きいほど直近の取得を重く見る)
+RATE_SMOOTHING = 0.3
+# 何も来なかったときに間隔を延ばす倍率
+IDLE_GROWTH = 1.5
+# レート制限の残りがこれを切っている間は、新しいものがあっても間隔を縮めない
+LOW_BUDGET = 0.5
+
+POLL_INTERVAL_SECONDS = metrics.gauge(
+    "bot_poll_interval_seconds", "Current polling interval", ("source",)
+)
+POLL_EVENT_RATE = metrics.gauge(
+    "bot_poll_event_rate", "Estimated new events per second", ("source",)
+)
+RATE_LIMIT_BUDGET = metrics.gauge(
+    "bot_poll_ratelimit_budget",
+    "Rate-limit budget (1 = on pace for the window) when the interval was chosen",
+    ("source",),
+)
+
+
+class PollInterval:
+    """
+    取得ごとの新しい件数から到着の速さ(件/秒)を見積もり、次に取得するまでの間隔を決める
+    - 取り残しがあれば最短の間隔ですぐ取り直す
+    - 新しいものがあれば、1回で target 件ほど取れる間隔に縮める
+    - 何もなければ IDLE_GROWTH 倍ずつ最長の間隔まで延ばす(深夜はほとんど取りに行かない)
+    - budget(レート制限の残りの割合を返す関数)が1を切っていれば、その分だけ延ばす
+    """
+
+    __slots__ = (
+        "source",
+        "minimum",
+        "maximum",
+        "target",
+        "budget",
+        "interval",
+        "rate",
+        "last",
+    )
+
+    def __init__(
+        self,
+        source,
+        minimum=POLL_INTERVAL,
+        maximum=POLL_INTERVAL_MAX,
+        target=POLL_TARGET_EVENTS,
+        budget=None,
+    ):
+        self.source = source
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.target = target
+        self.budget = budget
+        self.interval = minimum
+        self.rate = 0.0
+        self.last = None
+        POLL_INTERVAL_SECONDS.set(self.interval, source)
+
+    def observe(self, count, backlog=False):
+        """取得した新しい件数と取り残しの有無から、次の取得までの秒数を返す"""
+        now = time.monotonic()
+        elapsed = now - self.last if self.last is not None else self.interval
+        self.last = now
+        rate = count / max(elapsed, 0.001)
+        self.rate += RATE_SMOOTHING * (rate - self.rate)
+
+        if backlog:
+            interval = self.minimum
+        elif count:
+            interval = self.target / max(self.rate, rate)
+        else:
+            wanted = self.target / self.rate if self.rate > 0 else self.maximum
+            interval = min(self.interval * IDLE_GROWTH, wanted)
+
+        budget = self.budget() if self.budget is not None else 1.0
+        if budget < 1:
+            # 残りが半分なら2倍、尽きかけなら最長の間隔
+            interval /= max(budget, self.minimum / self.maximum)
+            if budget < LOW_BUDGET:
+                interval = max(interval, self.interval)
+        self.interval = min(max(interval, self.minimum), self.maximum)
+
+        POLL_INTERVAL_SECONDS.set(self.interval, self.source)
+        POLL_EVENT_RATE.set(round(self.rate, 4), self.source)
+        RATE_LIMIT_BUDGET.set(round(budget, 4), self.source)
+        return self.interval
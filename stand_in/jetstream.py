@@ -0,0 +1,194 @@
+"""
+Jetstream 互換のイベントストリームのローカル代替
+
+記録したイベント(1行1イベントのJSONL)を websocket で再生する。
+    python stand_in/jetstream.py serve events.jsonl --port 6008 --speed 10
+
+本物の Jetstream から記録する
+    python stand_in/jetstream.py record events.jsonl --seconds 60
+
+オフライン用にそれらしいイベントを生成する
+    python stand_in/jetstream.py generate events.jsonl --count 100000
+
+bot.py 側は .env で次のように指定する
+    TIMELINE_SOURCE=stream
+    JETSTREAM_URL=ws://localhost:6008/subscribe
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import parse_qs, urlparse
+
+import websockets
+
+DEFAULT_SOURCE = "wss://jetstream2.us-east.bsky.network/subscribe"
+
+
+def load_events(path):
+    events = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                event = json.loads(line)
+                collection = event.get("commit", {}).get("collection")
+                events.append((event.get("time_us", 0), collection, line.decode()))
+    return events
+
+
+async def serve(path, host, port, speed, drop_after, ready=None):
+    events = load_events(path)
+    print(f"loaded {len(events)} events")
+
+    async def handler(websocket):
+        query = parse_qs(urlparse(websocket.request.path).query)
+        cursor = int(query.get("cursor", ["0"])[0])
+        collections = set(query.get("wantedCollections", []))
+        print(f"client connected cursor:{cursor} collections:{collections}")
+        sent = 0
+        prev_time_us = None
+        started = time.monotonic()
+        for time_us, collection, message in events:
+            if time_us < cursor:
+                continue
+            if collections and collection and collection not in collections:
+                continue
+            if speed > 0 and prev_time_us is not None:
+                wait = (time_us - prev_time_us) / 1000000 / speed
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            prev_time_us = time_us
+            await websocket.send(message)
+            sent += 1
+            if drop_after and sent >= drop_after:
+                # 再接続とカーソルでの再開を試すために切断する
+                print(f"dropping client after {sent} events")
+                return
+        elapsed = time.monotonic() - started
+        print(f"replayed {sent} events in {elapsed:.2f}s")
+        # 本物と同じく接続は維持する
+        await websocket.wait_closed()
+
+    async with websockets.serve(handler, host, port, max_size=2**22):
+        print(f"listening on ws://{host}:{port}/subscribe")
+        if ready is not None:
+            ready.set()
+        await asyncio.Future()
+
+
+async def record(path, url, seconds):
+    deadline = time.monotonic() + seconds
+    count = 0
+    async with websockets.connect(url, max_size=2**22) as websocket:
+        with open(path, "w") as f:
+            while time.monotonic() < deadline:
+                message = await websocket.recv()
+                f.write(message.strip() + "\n")
+                count += 1
+    print(f"recorded {count} events")
+
+
+def generate(path, count, authors, start_time_us, rate):
+    """投稿の作成を中心に、いいねや削除も混ぜたイベントを作る"""
+    rnd = random.Random(0)
+    dids = [f"did:plc:gen{i:020d}" for i in range(authors)]
+    time_us = start_time_us
+    texts = [
+        "おはようございます",
+        "今日はいい天気",
+        "Blueskyちゃん占って",
+        "ランチなににしよう",
+        "眠い",
+        "hello bluesky",
+    ]
+    with open(path, "w") as f:
+        for i in range(count):
+            time_us += int(rnd.expovariate(rate) * 1000000) + 1
+            did = rnd.choice(dids)
+            kind = rnd.random()
+            rkey = f"3k{i:011d}"
+            if kind < 0.6:
+                record = {
+                    "$type": "app.bsky.feed.post",
+                    "createdAt": time.strftime(
+                        "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(time_us / 1000000)
+                    ),
+                    "langs": ["ja"],
+                    "text": rnd.choice(texts),
+                }
+                commit = {
+                    "rev": rkey,
+                    "operation": "create",
+                    "collection": "app.bsky.feed.post",
+                    "rkey": rkey,
+                    "record": record,
+                    "cid": f"bafyreigen{i:040d}",
+                }
+            elif kind < 0.95:
+                commit = {
+                    "rev": rkey,
+                    "operation": "create",
+                    "collection": "app.bsky.feed.like",
+                    "rkey": rkey,
+                    "record": {
+                        "$type": "app.bsky.feed.like",
+                        "subject": {
+                            "uri": f"at://{rnd.choice(dids)}/app.bsky.feed.post/3k0",
+                            "cid": "bafyreigen",
+                        },
+                    },
+                    "cid": f"bafyreigen{i:040d}",
+                }
+            else:
+                commit = {
+                    "rev": rkey,
+                    "operation": "delete",
+                    "collection": "app.bsky.feed.post",
+                    "rkey": f"3k{max(i - 10, 0):011d}",
+                }
+            event = {"did": did, "time_us": time_us, "kind": "commit", "commit": commit}
+            f.write(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("serve")
+    p.add_argument("path")
+    p.add_argument("--host", default="localhost")
+    p.add_argument("--port", type=int, default=6008)
+    p.add_argument(
+        "--speed", type=float, default=1.0, help="再生速度の倍率。0で待たずに送る"
+    )
+    p.add_argument("--drop-after", type=int, default=0)
+
+    p = sub.add_parser("record")
+    p.add_argument("path")
+    p.add_argument(
+        "--url",
+        default=DEFAULT_SOURCE + "?wantedCollections=app.bsky.feed.post",
+    )
+    p.add_argument("--seconds", type=float, default=60)
+
+    p = sub.add_parser("generate")
+    p.add_argument("path")
+    p.add_argument("--count", type=int, default=100000)
+    p.add_argument("--authors", type=int, default=5000)
+    p.add_argument("--rate", type=float, default=300, help="1秒あたりのイベント数")
+    p.add_argument("--start-time-us", type=int, default=int(time.time() * 1000000))
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        asyncio.run(serve(args.path, args.host, args.port, args.speed, args.drop_after))
+    elif args.command == "record":
+        asyncio.run(record(args.path, args.url, args.seconds))
+    else:
+        generate(args.path, args.count, args.authors, args.start_time_us, args.rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+OpenAI 互換の chat/completions のローカル代替
+
+決まった文面(お絵描きの依頼には SVG)を、指定した遅延で返す。
+一定の割合で 429(レート制限)・500・応答しないままの待ちを起こせる。
+    python stand_in/llm.py --port 8000 --latency 2 --jitter 1 --rate-limit 0.05
+
+bot.py 側は .env で次のように指定する
+    OPENAI_BASE_URL=http://localhost:8000/v1
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = "ごきげんよう。わたくし、今日もとびきり元気ですわ。あなたも良い一日を。"
+FORTUNE = "今日の運勢は★★★★☆ですわ。ラッキーアイテムは紅茶、ラッキーカラーは桜色。"
+SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="200" height="200">'
+    '<circle cx="100" cy="100" r="80" fill="#f8c"/>'
+    '<circle cx="70" cy="85" r="10" fill="#333"/>'
+    '<circle cx="130" cy="85" r="10" fill="#333"/>'
+    '<path d="M70 130 Q100 155 130 130" stroke="#333" fill="none" stroke-width="5"/>'
+    "</svg>\n"
+    "丸くてかわいい顔に仕上げましたわ。線の曲がり具合に苦労しましたの。"
+)
+
+
+class Behavior:
+    """遅延と失敗の起こし方。数を数えて定期的に表示する"""
+
+    def __init__(self, latency, jitter, error_rate, rate_limit, hang_rate, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.hang_rate = hang_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, result):
+        with self.lock:
+            self.counts[result] = self.counts.get(result, 0) + 1
+
+    def draw(self):
+        """(結果, 待つ秒数)"""
+        with self.lock:
+            roll = self.random.random()
+            delay = max(self.latency + self.random.uniform(-1, 1) * self.jitter, 0)
+        if roll < self.rate_limit:
+            return "rate_limit", 0
+        roll -= self.rate_limit
+        if roll < self.error_rate:
+            return "error", delay
+        roll -= self.error_rate
+        if roll < self.hang_rate:
+            # クライアントのタイムアウトより長く待たせる
+            return "hang", 600
+        return "ok", delay
+
+
+def answer_for(messages):
+    text = "".join(str(message.get("content", "")) for message in messages)
+    if "svg" in text:
+        return SVG
+    if "占" in text:
+        return FORTUNE
+    return ANSWER
+
+
+def completion(model, messages, content):
+    prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content),
+            "total_tokens": prompt_tokens + len(content),
+        },
+    }
+
+
+def make_handler(behavior):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, data, headers=None):
+            body = json.dumps(data, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def error(self, status, kind, message, headers=None):
+            data = {"error": {"message": message, "type": kind, "code": None}}
+            self.reply(status, data, headers)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length) if length else b""
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self.error(404, "invalid_request_error", f"unknown {self.path}")
+            try:
+                body = json.loads(data)
+                model = body["model"]
+                messages = body["messages"]
+            except (KeyError, ValueError) as e:
+                return self.error(400, "invalid_request_error", repr(e))
+
+            result, delay = behavior.draw()
+            behavior.count(result)
+            time.sleep(delay)
+            if result == "rate_limit":
+                return self.error(
+                    429,
+                    "rate_limit_exceeded",
+                    "Rate limit reached (stand-in)",
+                    {"Retry-After": "1"},
+                )
+            if result == "error":
+                return self.error(500, "server_error", "injected failure (stand-in)")
+            self.reply(200, completion(model, messages, answer_for(messages)))
+
+    return Handler
+
+
+def serve(host, port, behavior):
+    """サーバーを起動して server を返す。止めるのは server.shutdown()"""
+    server = ThreadingHTTPServer((host, port), make_handler(behavior))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=1.0, help="平均の応答秒数")
+    parser.add_argument("--jitter", type=float, default=0.5, help="遅延のばらつき(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500 を返す割合")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="429 を返す割合")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="応答しない割合")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    behavior = Behavior(
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.rate_limit,
+        args.hang_rate,
+        args.seed,
+    )
+    server = serve(args.host, args.port, behavior)
+    print(f"stand-in OpenAI listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(60)
+            print(behavior.counts)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,672 @@
+"""
+PDS(com.atproto.*)と AppView(app.bsky.*)、plc.directory/export、
+ユーザー数の統計(/stats)のローカル代替
+
+ログインと、投稿・画像のアップロード・applyWrites を受け付けてメモリ上に保存する。
+レコードのCIDは受け取ったJSONから計算し直して返すので、bot.py が手元で
+計算したCIDと食い違えば分かる。返信の reply.parent / reply.root が
+このPDSにあるレコードを指していて、CIDが一致しなければ 400 を返す。
+
+--users 人の架空のユーザー(全員がボットのフォロワー、半分をボットがフォロー)を作り、
+1分あたり --mentions-per-minute 件のメンションと --posts-per-minute 件の
+タイムラインの投稿を生成する。メンションから返信までの時間を定期的に表示する。
+    python stand_in/pds.py --port 2583 --users 10000 --mentions-per-minute 10000
+--rate-limit を指定すると、--rate-window 秒あたりその回数を超えたリクエストに
+429 を返す(すべての応答に ratelimit-* ヘッダーを付ける)。
+
+bot.py 側は .env で次のように指定する
+    ATP_HOST=http://localhost:2583
+    PLC_EXPORT_URL=http://localhost:2583/export
+    USER_STATS_URL=http://localhost:2583/stats
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dagcbor  # noqa: E402
+
+# uploadBlob で返す CID の codec(raw)
+RAW = 0x55
+ACCESS_TTL = 2 * 60 * 60
+REFRESH_TTL = 60 * 24 * 60 * 60
+# 生成したメンションとタイムラインの投稿を残しておく件数
+KEEP_EVENTS = 100000
+# 生成のスレッドが起きる間隔(秒)
+GENERATE_TICK = 0.1
+# メンションの文面と重み(雑談がほとんどで、たまにコマンド)
+MENTION_TEXTS = (
+    ("こんにちは、今日はいい天気ですわね", 80),
+    ("占って", 8),
+    ("status", 5),
+    ("猫を描いて", 2),
+    ("今日のお昼ごはんは何がいいかしら", 5),
+)
+TIMELINE_TEXTS = (
+    "今日のお昼ごはんはカレーでしたわ",
+    "眠いですわ……",
+    "新しいゲームを買いましたの",
+    "雨が降ってきましたわね",
+)
+# 架空のユーザーがPLCに登録された時刻(i 番目は i 秒後)
+PLC_START = datetime(2023, 2, 1)
+PLC_EXPORT_COUNT = 10
+PLC_EXPORT_MAX_COUNT = 1000
+# 認証なしで送れる plc.directory/export と /stats はレート制限に数えない
+UNLIMITED_PATHS = ("/export", "/stats")
+
+
+def make_jwt(did, scope, ttl):
+    """署名なしのJWT(bot.py は exp しか読まない)"""
+
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    header = part({"typ": "JWT", "alg": "none"})
+    payload = part({"sub": did, "scope": scope, "exp": int(time.time()) + ttl})
+    return f"{header}.{payload}.stand-in"
+
+
+def blob_cid(data):
+    digest = hashlib.sha256(data).digest()
+    return dagcbor.cid_to_string(
+        dagcbor.varint(1) + dagcbor.varint(RAW) + bytes([dagcbor.SHA2_256, 32]) + digest
+    )
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace(
+        "+00:00", "Z"
+    )
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class XrpcError(Exception):
+    def __init__(self, status, error, message):
+        super().__init__(message)
+        self.status = status
+        self.error = error
+
+
+class RateLimiter:
+    """
+    window 秒ごとに limit 回までの固定ウィンドウ。すべての応答に
+    ratelimit-limit / ratelimit-remaining / ratelimit-reset を付け、超えたら 429 を返す
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset_at = 0
+        self.used = 0
+        self.rejected = 0
+
+    def take(self):
+        """(通すか, 付けるヘッダー)"""
+        with self.lock:
+            now = time.time()
+            if now >= self.reset_at:
+                self.reset_at = int(now) + self.window
+                self.used = 0
+            allowed = self.used < self.limit
+            if allowed:
+                self.used += 1
+            else:
+                self.rejected += 1
+            headers = {
+                "ratelimit-limit": str(self.limit),
+                "ratelimit-remaining": str(self.limit - self.used),
+                "ratelimit-reset": str(self.reset_at),
+                "ratelimit-policy": f"{self.limit};w={self.window}",
+            }
+        return allowed, headers
+
+
+class Repo:
+    """1アカウント分のレコードとblob"""
+
+    def __init__(self, handle, password, did, world=None):
+        self.handle = handle
+        self.password = password
+        self.did = did
+        self.world = world
+        self.lock = threading.Lock()
+        self.records = {}
+        self.blobs = {}
+        self.counts = {}
+
+    def count(self, method):
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+
+    def check_ref(self, ref):
+        """このPDSのレコードへの参照なら、CIDが一致するか確かめる"""
+        with self.lock:
+            stored = self.records.get(ref.get("uri"))
+        if stored is not None and stored[0] != ref.get("cid"):
+            raise XrpcError(
+                400,
+                "InvalidRequest",
+                f"cid mismatch for {ref['uri']}: {ref.get('cid')} != {stored[0]}",
+            )
+
+    def create(self, collection, rkey, value, pending=None):
+        if value.get("$type") != collection:
+            raise XrpcError(400, "InvalidRequest", "record/$type mismatch")
+        reply = value.get("reply")
+        if reply:
+            for ref in (reply.get("root", {}), reply.get("parent", {})):
+                if pending is not None and ref.get("uri") in pending:
+                    if pending[ref["uri"]] != ref.get("cid"):
+                        raise XrpcError(
+                            400, "InvalidRequest", f"cid mismatch for {ref['uri']}"
+                        )
+                else:
+                    self.check_ref(ref)
+        rkey = rkey or dagcbor.make_tid()
+        uri = f"at://{self.did}/{collection}/{rkey}"
+        cid = dagcbor.cid_for(value)
+        return uri, cid
+
+    def create_record(self, body):
+        uri, cid = self.create(body["collection"], body.get("rkey"), body["record"])
+        with self.lock:
+            self.records[uri] = (cid, body["record"])
+        self.notify_replies([body["record"]])
+        return {"uri": uri, "cid": cid}
+
+    def notify_replies(self, values):
+        """返信を生成したメンションに結びつけて、返信までの時間を数える"""
+        if self.world is None:
+            return
+        for value in values:
+            reply = value.get("reply")
+            if reply:
+                self.world.replied(reply.get("parent", {}).get("uri"))
+
+    def apply_writes(self, body):
+        """書き込みを全部確かめてから、まとめて保存する"""
+        pending = {}
+        results = []
+        for write in body["writes"]:
+            if write.get("$type") != "com.atproto.repo.applyWrites#create":
+                raise XrpcError(400, "InvalidRequest", "only creates are supported")
+            uri, cid = self.create(
+                write["collection"], write.get("rkey"), write["value"], pending
+            )
+            if uri in pending or uri in self.records:
+                raise XrpcError(400, "InvalidRequest", f"record already exists: {uri}")
+            pending[uri] = cid
+            results.append(
+                {
+                    "$type": "com.atproto.repo.applyWrites#createResult",
+                    "uri": uri,
+                    "cid": cid,
+                    "validationStatus": "valid",
+                }
+            )
+        with self.lock:
+            for write, result in zip(body["writes"], results):
+                self.records[result["uri"]] = (result["cid"], write["value"])
+        self.notify_replies([write["value"] for write in body["writes"]])
+        return {"results": results}
+
+    def upload_blob(self, data, mime_type):
+        cid = blob_cid(data)
+        with self.lock:
+            self.blobs[cid] = data
+        return {
+            "blob": {
+                "$type": "blob",
+                "ref": {"$link": cid},
+                "mimeType": mime_type,
+                "size": len(data),
+            }
+        }
+
+    def get_record(self, params):
+        uri = f"at://{self.did}/{params['collection']}/{params['rkey']}"
+        with self.lock:
+            stored = self.records.get(uri)
+        if stored is None:
+            raise XrpcError(400, "RecordNotFound", f"Could not locate record: {uri}")
+        return {"uri": uri, "cid": stored[0], "value": stored[1]}
+
+
+class World:
+    """
+    ボット以外のアカウントと、その人たちの投稿(メンションとタイムライン)
+    listNotifications などの app.bsky.* はここから返す
+    """
+
+    def __init__(self, bot_did, bot_handle, users, endpoint, keep=KEEP_EVENTS):
+        self.bot_did = bot_did
+        self.bot_handle = bot_handle
+        self.endpoint = endpoint
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.users = [
+            (f"did:plc:standin{i:07d}", f"user{i}.standin.test") for i in range(users)
+        ]
+        self.dids = {did: i for i, (did, _) in enumerate(self.users)}
+        self.handles = {handle: did for did, handle in self.users}
+        self.handles[bot_handle] = bot_did
+        # ボットがフォローしているのは前半のユーザー
+        self.follows = self.users[: users // 2]
+        # (seq, notification) と timeline の投稿を古い順に
+        self.notifications = deque()
+        self.timeline = deque()
+        self.seq = 0
+        self.posts = {}
+        self.seen_at = ""
+        # 返信待ちのメンションの uri -> 生成した時刻
+        self.waiting = {}
+        self.mentions = 0
+        self.replies = 0
+        self.latencies = deque(maxlen=10000)
+        self.plc_created_at = [
+            (PLC_START + timedelta(seconds=i)).isoformat(timespec="milliseconds") + "Z"
+            for i in range(users)
+        ]
+
+    def author(self, i):
+        did, handle = self.users[i]
+        return {
+            "did": did,
+            "handle": handle,
+            "displayName": f"ユーザー{i}",
+            "viewer": {
+                "muted": False,
+                "blockedBy": False,
+                "followedBy": f"at://{did}/app.bsky.graph.follow/{i}",
+            },
+            "labels": [],
+        }
+
+    def make_post(self, i, text, facets=None):
+        did = self.users[i][0]
+        record = {
+            "$type": "app.bsky.feed.post",
+            "text": text,
+            "createdAt": now_iso(),
+            "langs": ["ja"],
+        }
+        if facets:
+            record["facets"] = facets
+        return {
+            "uri": f"at://{did}/app.bsky.feed.post/{dagcbor.make_tid()}",
+            "cid": dagcbor.cid_for(record),
+            "author": self.author(i),
+            "record": record,
+            "replyCount": 0,
+            "repostCount": 0,
+            "likeCount": 0,
+            "indexedAt": record["createdAt"],
+            "labels": [],
+        }
+
+    def add_mention(self, rnd):
+        texts, weights = zip(*MENTION_TEXTS)
+        mention = f"@{self.bot_handle}"
+        text = f"{mention} {rnd.choices(texts, weights)[0]}"
+        facet = {
+            "index": {"byteStart": 0, "byteEnd": len(mention.encode())},
+            "features": [
+                {"$type": "app.bsky.richtext.facet#mention", "did": self.bot_did}
+            ],
+        }
+        post = self.make_post(rnd.randrange(len(self.users)), text, [facet])
+        notification = {
+            "uri": post["uri"],
+            "cid": post["cid"],
+            "author": post["author"],
+            "reason": "mention",
+            "record": post["record"],
+            "isRead": False,
+            "indexedAt": post["indexedAt"],
+            "labels": [],
+        }
+        with self.lock:
+            self.seq += 1
+            self.notifications.append((self.seq, notification))
+            self.posts[post["uri"]] = post
+            self.waiting[post["uri"]] = time.monotonic()
+            self.mentions += 1
+            while len(self.notifications) > self.keep:
+                _, old = self.notifications.popleft()
+                self.posts.pop(old["uri"], None)
+                self.waiting.pop(old["uri"], None)
+
+    def add_post(self, rnd):
+        i = rnd.randrange(max(len(self.follows), 1))
+        post = self.make_post(i, rnd.choice(TIMELINE_TEXTS))
+        with self.lock:
+            self.timeline.append({"post": post})
+            self.posts[post["uri"]] = post
+            while len(self.timeline) > self.keep:
+                old = self.timeline.popleft()
+                self.posts.pop(old["post"]["uri"], None)
+
+    def replied(self, uri):
+        with self.lock:
+            started = self.waiting.pop(uri, None)
+            if started is not None:
+                self.replies += 1
+                self.latencies.append(time.monotonic() - started)
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            return (
+                f"mentions:{self.mentions} replies:{self.replies} "
+                f"waiting:{len(self.waiting)} "
+                f"reply p50:{percentile(latencies, 0.5):.2f}s "
+                f"p99:{percentile(latencies, 0.99):.2f}s"
+            )
+
+    def list_notifications(self, params):
+        """新しい順。cursor は次のページの先頭(より古い)の seq"""
+        limit = min(int(params.get("limit", 50)), 100)
+        with self.lock:
+            items = list(self.notifications)
+            seen_at = self.seen_at
+        end = len(items)
+        if params.get("cursor") and items:
+            end = max(min(int(params["cursor"]) - items[0][0] + 1, end), 0)
+        start = max(end - limit, 0)
+        page = [
+            dict(notification, isRead=notification["indexedAt"] <= seen_at)
+            for _, notification in reversed(items[start:end])
+        ]
+        data = {"notifications": page, "seenAt": seen_at or None}
+        if start > 0:
+            data["cursor"] = str(items[start - 1][0])
+        return data
+
+    def update_seen(self, body):
+        with self.lock:
+            self.seen_at = max(self.seen_at, body["seenAt"])
+        return {}
+
+    def get_timeline(self, params):
+        limit = min(int(params.get("limit", 50)), 100)
+        with self.lock:
+            feed = list(self.timeline)[-limit:]
+        return {"feed": list(reversed(feed))}
+
+    def get_posts(self, uris):
+        with self.lock:
+            return {"posts": [self.posts[uri] for uri in uris if uri in self.posts]}
+
+    def resolve_did(self, actor):
+        did = self.handles.get(actor, actor)
+        if did != self.bot_did and did not in self.dids:
+            raise XrpcError(400, "InvalidRequest", f"Profile not found: {actor}")
+        return did
+
+    def get_profile(self, params):
+        did = self.resolve_did(params["actor"])
+        if did == self.bot_did:
+            handle = self.bot_handle
+        else:
+            handle = self.users[self.dids[did]][1]
+        return {
+            "did": did,
+            "handle": handle,
+            "displayName": handle.split(".", 1)[0],
+            "followersCount": len(self.users) if did == self.bot_did else 1,
+            "followsCount": len(self.follows) if did == self.bot_did else 1,
+            "postsCount": 1234,
+        }
+
+    def page_of(self, users, params, key):
+        """getFollows / getFollowers。cursor は何件目からか"""
+        limit = min(int(params.get("limit", 50)), 100)
+        offset = int(params.get("cursor") or 0)
+        page = users[offset : offset + limit]
+        data = {
+            "subject": self.get_profile(params),
+            key: [{"did": did, "handle": handle} for did, handle in page],
+        }
+        if offset + limit < len(users):
+            data["cursor"] = str(offset + limit)
+        return data
+
+    def get_follows(self, params):
+        is_bot = self.resolve_did(params["actor"]) == self.bot_did
+        return self.page_of(self.follows if is_bot else [], params, "follows")
+
+    def get_followers(self, params):
+        is_bot = self.resolve_did(params["actor"]) == self.bot_did
+        return self.page_of(self.users if is_bot else [], params, "followers")
+
+    def resolve_handle(self, params):
+        did = self.handles.get(params.get("handle"))
+        if did is None:
+            raise XrpcError(400, "InvalidRequest", "Unable to resolve handle")
+        return {"did": did}
+
+    def plc_line(self, i):
+        did, handle = self.users[i]
+        key = "did:key:zQ3shstandin" + did[-7:]
+        operation = {
+            "sig": "standin",
+            "prev": None,
+            "type": "plc_operation",
+            "services": {
+                "atproto_pds": {
+                    "type": "AtprotoPersonalDataServer",
+                    "endpoint": self.endpoint,
+                }
+            },
+            "alsoKnownAs": [f"at://{handle}"],
+            "rotationKeys": [key],
+            "verificationMethods": {"atproto": key},
+        }
+        line = {
+            "did": did,
+            "operation": operation,
+            "cid": dagcbor.cid_for(operation),
+            "nullified": False,
+            "createdAt": self.plc_created_at[i],
+        }
+        return json.dumps(line, separators=(",", ":"))
+
+    def plc_export(self, params):
+        """plc.directory/export と同じく after より後の count 件を JSONL で返す"""
+        count = min(int(params.get("count", PLC_EXPORT_COUNT)), PLC_EXPORT_MAX_COUNT)
+        start = bisect_right(self.plc_created_at, params.get("after", ""))
+        end = min(start + count, len(self.users))
+        return "".join(self.plc_line(i) + "\n" for i in range(start, end))
+
+
+def generate(world, mentions_per_minute, posts_per_minute, stop, seed=0):
+    """1分あたりの件数に合わせて、メンションとタイムラインの投稿を足し続ける"""
+    rnd = random.Random(seed)
+    mention_credit = post_credit = 0.0
+    last = time.monotonic()
+    while not stop.wait(GENERATE_TICK):
+        now = time.monotonic()
+        mention_credit += mentions_per_minute * (now - last) / 60
+        post_credit += posts_per_minute * (now - last) / 60
+        last = now
+        while mention_credit >= 1:
+            world.add_mention(rnd)
+            mention_credit -= 1
+        while post_credit >= 1:
+            world.add_post(rnd)
+            post_credit -= 1
+
+
+def make_handler(repo, limiter=None):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, data, content_type="application/json"):
+            body = data.encode() if isinstance(data, str) else json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in self.rate_limit_headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length) if length else b""
+
+        def handle_xrpc(self, method):
+            url = urlparse(self.path)
+            # plc.directory/export と /stats は XRPC ではない
+            nsid = url.path.removeprefix("/xrpc/")
+            query = parse_qs(url.query)
+            params = {k: v[0] for k, v in query.items()}
+            repo.count(nsid)
+            data = self.read_body() if method == "POST" else b""
+            world = repo.world
+            self.rate_limit_headers = {}
+            if limiter is not None and nsid not in UNLIMITED_PATHS:
+                allowed, self.rate_limit_headers = limiter.take()
+                if not allowed:
+                    repo.count("429")
+                    return self.reply(
+                        429, {"error": "RateLimitExceeded", "message": "Rate Limit"}
+                    )
+            try:
+                if nsid == "com.atproto.server.createSession":
+                    body = json.loads(data)
+                    if body.get("identifier") not in (repo.handle, repo.did) or (
+                        body.get("password") != repo.password
+                    ):
+                        raise XrpcError(401, "AuthenticationRequired", "bad password")
+                    return self.reply(200, self.session())
+                if nsid == "com.atproto.server.refreshSession":
+                    return self.reply(200, self.session())
+                if nsid == "com.atproto.repo.createRecord":
+                    return self.reply(200, repo.create_record(json.loads(data)))
+                if nsid == "com.atproto.repo.applyWrites":
+                    return self.reply(200, repo.apply_writes(json.loads(data)))
+                if nsid == "com.atproto.repo.uploadBlob":
+                    content_type = self.headers.get("Content-Type", "")
+                    return self.reply(200, repo.upload_blob(data, content_type))
+                if nsid == "com.atproto.repo.getRecord":
+                    return self.reply(200, repo.get_record(params))
+                if world is None:
+                    raise XrpcError(501, "MethodNotImplemented", nsid)
+                if nsid == "/export":
+                    lines = world.plc_export(params)
+                    return self.reply(200, lines, "application/jsonlines")
+                if nsid == "/stats":
+                    return self.reply(200, {"total_users": len(world.users)})
+                if nsid == "app.bsky.notification.listNotifications":
+                    return self.reply(200, world.list_notifications(params))
+                if nsid == "app.bsky.notification.updateSeen":
+                    return self.reply(200, world.update_seen(json.loads(data)))
+                if nsid == "app.bsky.feed.getTimeline":
+                    return self.reply(200, world.get_timeline(params))
+                if nsid == "app.bsky.feed.getPosts":
+                    return self.reply(200, world.get_posts(query.get("uris", [])))
+                if nsid == "app.bsky.actor.getProfile":
+                    return self.reply(200, world.get_profile(params))
+                if nsid == "app.bsky.graph.getFollows":
+                    return self.reply(200, world.get_follows(params))
+                if nsid == "app.bsky.graph.getFollowers":
+                    return self.reply(200, world.get_followers(params))
+                if nsid == "com.atproto.identity.resolveHandle":
+                    return self.reply(200, world.resolve_handle(params))
+                raise XrpcError(501, "MethodNotImplemented", nsid)
+            except XrpcError as e:
+                self.reply(e.status, {"error": e.error, "message": str(e)})
+            except (KeyError, ValueError) as e:
+                self.reply(400, {"error": "InvalidRequest", "message": repr(e)})
+
+        def session(self):
+            return {
+                "did": repo.did,
+                "handle": repo.handle,
+                "accessJwt": make_jwt(repo.did, "com.atproto.access", ACCESS_TTL),
+                "refreshJwt": make_jwt(repo.did, "com.atproto.refresh", REFRESH_TTL),
+            }
+
+        def do_GET(self):
+            self.handle_xrpc("GET")
+
+        def do_POST(self):
+            self.handle_xrpc("POST")
+
+    return Handler
+
+
+def serve(host, port, handle, password, did, world=None, limiter=None):
+    """サーバーを起動して (server, repo) を返す。止めるのは server.shutdown()"""
+    repo = Repo(handle, password, did, world)
+    server = ThreadingHTTPServer((host, port), make_handler(repo, limiter))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, repo
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=2583)
+    parser.add_argument("--handle", default="bot.test")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--did", default="did:plc:standinbot")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--mentions-per-minute", type=float, default=0)
+    parser.add_argument("--posts-per-minute", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--rate-limit", type=int, default=0, help="--rate-window 秒あたりの回数"
+    )
+    parser.add_argument("--rate-window", type=int, default=300)
+    args = parser.parse_args()
+    endpoint = f"http://{args.host}:{args.port}"
+    world = World(args.did, args.handle, args.users, endpoint)
+    limiter = None
+    if args.rate_limit:
+        limiter = RateLimiter(args.rate_limit, args.rate_window)
+    server, repo = serve(
+        args.host, args.port, args.handle, args.password, args.did, world, limiter
+    )
+    print(f"stand-in PDS listening on http://{args.host}:{server.server_port}")
+    stop = threading.Event()
+    threading.Thread(
+        target=generate,
+        args=(world, args.mentions_per_minute, args.posts_per_minute, stop, args.seed),
+        daemon=True,
+    ).start()
+    try:
+        while True:
+            time.sleep(60)
+            print(f"records:{len(repo.records)} blobs:{len(repo.blobs)} {repo.counts}")
+            print(world.stats())
+    except KeyboardInterrupt:
+        stop.set()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from urllib.parse import urlencode
+
+import websockets
+
+# Jetstream 形式のイベントストリーム(ローカルでは stand_in/jetstream.py)
+JETSTREAM_URL = os.getenv(
+    "JETSTREAM_URL", "wss://jetstream2.us-east.bsky.network/subscribe"
+)
+POST_COLLECTION = "app.bsky.feed.post"
+
+# app.bsky.feed.getPosts に一度に渡せるURIの数
+BATCH_SIZE = 25
+BATCH_WAIT = 1.0
+# 再接続時は取りこぼしがないよう少し巻き戻して購読する
+CURSOR_REWIND_US = 5 * 1000 * 1000
+CURSOR_SAVE_INTERVAL = 10
+RECONNECT_DELAY = 5
+SEEN_URI_LIMIT = 10000
+
+
+def post_uri(event):
+    commit = event["commit"]
+    return f"at://{event['did']}/{commit['collection']}/{commit['rkey']}"
+
+
+def mentions_bot(record, bot_did, bot_names):
+    text = record.get("text", "")
+    for bot_name in bot_names:
+        if bot_name in text:
+            return True
+    for facet in record.get("facets", []):
+        for feature in facet.get("features", []):
+            if feature.get("did") == bot_did:
+                return True
+    return False
+
+
+def is_wanted(event, followers, bot_did, bot_names):
+    """投稿の作成イベントのうち、フォロワーの投稿かBotへの言及だけを残す"""
+    if event.get("kind") != "commit":
+        return False
+    commit = event.get("commit", {})
+    if commit.get("operation") != "create":
+        return False
+    if commit.get("collection") != POST_COLLECTION:
+        return False
+    if event.get("did") == bot_did:
+        return False
+    if event.get("did") in followers:
+        return True
+    return mentions_bot(commit.get("record", {}), bot_did, bot_names)
+
+
+class StreamConsumer:
+    """
+    イベントストリームを購読し、必要な投稿の作成イベントをまとめて on_batch に渡す
+    on_batch(events) はブロックする関数でよく、スレッドプールで実行される
+    カーソル(time_us)は save_cursor で保存し、再接続時はそこから再開する
+    """
+
+    def __init__(
+        self,
+        wanted,
+        on_batch,
+        cursor=None,
+        save_cursor=None,
+        url=JETSTREAM_URL,
+        executor=None,
+    ):
+        self.wanted = wanted
+        self.on_batch = on_batch
+        self.cursor = cursor
+        self.save_cursor = save_cursor
+        self.url = url
+        self.executor = executor
+        self.seen_uris = set()
+        self.seen_order = deque()
+        # まだ on_batch に渡していないイベント
+        self.batch = []
+        self.event_count = 0
+        self.wanted_count = 0
+
+    def subscribe_url(self):
+        params = [("wantedCollections", POST_COLLECTION)]
+        if self.cursor:
+            params.append(("cursor", max(self.cursor - CURSOR_REWIND_US, 0)))
+        return f"{self.url}?{urlencode(params)}"
+
+    def remember(self, uri):
+        """巻き戻しで同じ投稿が再送されたら False"""
+        if uri in self.seen_uris:
+            return False
+        self.seen_uris.add(uri)
+        self.seen_order.append(uri)
+        if len(self.seen_order) > SEEN_URI_LIMIT:
+            self.seen_uris.discard(self.seen_order.popleft())
+        return True
+
+    async def flush(self, batch, cursor):
+        loop = asyncio.get_running_loop()
+        if batch:
+            await loop.run_in_executor(self.executor, self.on_batch, batch)
+        if cursor and self.save_cursor:
+            await loop.run_in_executor(self.executor, self.save_cursor, cursor)
+
+    async def consume(self, websocket):
+        batch = self.batch = []
+        batch_started = None
+        last_saved = time.monotonic()
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(BATCH_WAIT - (time.monotonic() - batch_started), 0)
+            try:
+                message = await asyncio.wait_for(websocket.recv(), timeout)
+            except asyncio.TimeoutError:
+                message = None
+
+            if message is not None:
+                event = json.loads(message)
+                self.event_count += 1
+                if event.get("time_us"):
+                    self.cursor = event["time_us"]
+                if self.wanted(event) and self.remember(post_uri(event)):
+                    self.wanted_count += 1
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append(event)
+
+            batch_due = batch and (
+                len(batch) >= BATCH_SIZE
+                or time.monotonic() - batch_started >= BATCH_WAIT
+            )
+            cursor_due = time.monotonic() - last_saved >= CURSOR_SAVE_INTERVAL
+            if batch_due or cursor_due:
+                await self.flush(batch, self.cursor)
+                batch = self.batch = []
+                last_saved = time.monotonic()
+
+    async def run(self):
+        """切断されても指数バックオフで再接続し続ける"""
+        retry_count = 0
+        while True:
+            try:
+                async with websockets.connect(
+                    self.subscribe_url(), max_size=2**22
+                ) as websocket:
+                    print(f"[stream] connected cursor:{self.cursor}")
+                    retry_count = 0
+                    await self.consume(websocket)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 渡せなかったイベントは巻き戻した再送で受け取り直す
+                for event in self.batch:
+                    self.seen_uris.discard(post_uri(event))
+                self.batch = []
+                retry_count += 1
+                delay = min(RECONNECT_DELAY * (2 ** (retry_count - 1)), 300)
+                print(f"[stream] disconnected (attempt {retry_count}): {e}")
+                print(f"Reconnecting in {delay} seconds...")
+                await asyncio.sleep(delay)
@@ -1,11 +1,32 @@
 import requests
 import json
-import sqlite3
+import os
 import traceback
 import time
+import threading
+import atexit
+import queue
+import db
+import xrpc
+import metrics
+import migrations
+from collections import OrderedDict
 from datetime import datetime
 
+try:
+    import orjson
 
+    loads_json = orjson.loads
+except ImportError:
+    loads_json = json.loads
+
+# 関数(クエリ)ごとのDBの処理時間
+DB_SECONDS = metrics.histogram(
+    "bot_db_query_seconds", "Time spent in util DB functions", ("query",)
+)
+
+
+@metrics.timed(DB_SECONDS)
 def insert_user_dialog(connection, did, text):
     params = {
         "did": did,
@@ -19,8 +40,10 @@ def insert_user_dialog(connection, did, text):
     cur = connection.cursor()
     cur.execute(sql, params)
     connection.commit()
+    return cur.lastrowid
 
 
+@metrics.timed(DB_SECONDS)
 def insert_bot_dialog(connection, did, text):
     params = {
         "did": did,
@@ -34,15 +57,17 @@ def insert_bot_dialog(connection, did, text):
     cur = connection.cursor()
     cur.execute(sql, params)
     connection.commit()
+    return cur.lastrowid
 
 
+@metrics.timed(DB_SECONDS)
 def get_recent_dialogs(connection, did, limit=30):
     params = {
         "did": did,
         "limit": limit,
     }
     sql = """
-    SELECT role, message, created_at
+    SELECT role, message, created_at, id
     FROM dialogs
     WHERE did = :did
     ORDER BY created_at DESC
@@ -57,22 +82,20 @@ def get_recent_dialogs(connection, did, limit=30):
         formatted_date = timestamp.strftime("%Y-%m-%d %H:%M:%S")
         role = row[0]
         content = f"[{formatted_date}] {row[1]}"
-        dialogs.append({"role": role, "content": content})
+        dialogs.append({"role": role, "content": content, "id": row[3]})
 
     dialogs.reverse()
 
     return dialogs
 
 
+@metrics.timed(DB_SECONDS)
 def record_reaction(connection, eline):
-    displayName = (
-        eline.post.author.displayName if "displayName" in eline.post.author else ""
-    )
     params = {
         "did": eline.post.author.did,
         "handle": eline.post.author.handle,
-        "displayName": displayName,
-        "created_at": eline.post.indexedAt,
+        "displayName": eline.post.author.display_name or "",
+        "created_at": eline.post.indexed_at,
     }
     sql = """
     INSERT INTO reactions (did, handle, displayName, created_at)
@@ -83,6 +106,7 @@ def record_reaction(connection, eline):
     connection.commit()
 
 
+@metrics.timed(DB_SECONDS)
 def get_fortune_counts(connection, did):
     params = {"did": did}
     sql = """
@@ -96,6 +120,7 @@ def get_fortune_counts(connection, did):
     return counts
 
 
+@metrics.timed(DB_SECONDS)
 def create_user_settings(connection, did):
     sql = """
     INSERT INTO users (did, mode, analyze, points, all_points)
@@ -109,48 +134,438 @@ def create_user_settings(connection, did):
     connection.commit()
 
 
+# 設定をメモリに保持しておくユーザー数
+SETTINGS_CACHE_SIZE = 10000
+
+
+class UserSettings:
+    """users の1行分。dict と同じく settings["points"] のように読み書きする"""
+
+    __slots__ = ("did", "mode", "analyze", "points", "all_points")
+
+    def __init__(self, did, mode=0, analyze=0, points=0, all_points=0):
+        self.did = did
+        self.mode = mode
+        self.analyze = analyze
+        self.points = points
+        self.all_points = all_points
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return (
+            f"UserSettings(did={self.did!r}, mode={self.mode}, analyze={self.analyze}, "
+            f"points={self.points}, all_points={self.all_points})"
+        )
+
+
+class SettingsCache:
+    """
+    DIDごとの UserSettings を LRU で保持する。同じDIDには同じオブジェクトを返すので
+    別スレッドでの変更もすぐに見える
+    変更は dirty に溜めておき、flush でまとめてDBに書く(追い出されても書くまで残す)
+    """
+
+    def __init__(self, size=SETTINGS_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.settings = OrderedDict()
+        self.dirty = {}
+
+    def _put(self, settings):
+        self.settings[settings.did] = settings
+        self.settings.move_to_end(settings.did)
+        while len(self.settings) > self.size:
+            self.settings.popitem(last=False)
+
+    def _lookup(self, did):
+        settings = self.settings.get(did)
+        if settings is None:
+            settings = self.dirty.get(did)
+        if settings is not None:
+            self._put(settings)
+        return settings
+
+    def get_many(self, connection, dids, create=True):
+        """
+        {did: UserSettings} を返す。キャッシュにないものは1回のSELECTで読む
+        create=True ならDBにもないユーザーの行を作る
+        """
+        result = {}
+        with self.lock:
+            for did in dids:
+                settings = self._lookup(did)
+                if settings is not None:
+                    result[did] = settings
+        missing = [did for did in dict.fromkeys(dids) if did not in result]
+        if not missing:
+            return result
+
+        loaded = load_user_settings(connection, missing)
+        if create:
+            new_dids = [did for did in missing if did not in loaded]
+            if new_dids:
+                create_user_settings_many(connection, new_dids)
+                for did in new_dids:
+                    loaded[did] = UserSettings(did)
+        with self.lock:
+            for did, settings in loaded.items():
+                # 読んでいる間に他のスレッドが入れていればそちらを使う
+                result[did] = self._lookup(did) or settings
+                self._put(result[did])
+        return result
+
+    def mark_dirty(self, settings):
+        with self.lock:
+            self.dirty[settings.did] = settings
+            self._put(settings)
+
+    def flush(self, connection):
+        """溜まった変更を1回のトランザクションで書き、書いた件数を返す"""
+        with self.lock:
+            dirty = list(self.dirty.values())
+            self.dirty.clear()
+        if not dirty:
+            return 0
+        try:
+            write_user_settings(connection, dirty)
+        except Exception:
+            # 書けなかった分は次の flush で書き直す
+            with self.lock:
+                for settings in dirty:
+                    self.dirty.setdefault(settings.did, settings)
+            raise
+        return len(dirty)
+
+
+settings_cache = SettingsCache()
+
+
+@metrics.timed(DB_SECONDS)
+def load_user_settings(connection, dids):
+    cur = connection.cursor()
+    cur.execute(
+        f"""
+    SELECT did, mode, analyze, points, all_points FROM users
+    WHERE did IN ({",".join("?" * len(dids))})
+    """,
+        dids,
+    )
+    return {row["did"]: UserSettings(*row) for row in cur.fetchall()}
+
+
+@metrics.timed(DB_SECONDS)
+def create_user_settings_many(connection, dids):
+    with connection:
+        connection.executemany(
+            """
+        INSERT OR IGNORE INTO users (did, mode, analyze, points, all_points)
+                  VALUES (?, 0, 0, 0, 0)
+        """,
+            [(did,) for did in dids],
+        )
+
+
+@metrics.timed(DB_SECONDS)
+def write_user_settings(connection, settings_list):
+    with connection:
+        connection.executemany(
+            """
+        UPDATE users SET
+          mode = :mode,
+          analyze = :analyze,
+          points = :points,
+          all_points = :all_points
+          WHERE did = :did
+        """,
+            [
+                {
+                    "did": settings.did,
+                    "mode": settings.mode,
+                    "analyze": settings.analyze,
+                    "points": settings.points,
+                    "all_points": settings.all_points,
+                }
+                for settings in settings_list
+            ],
+        )
+
+
 def get_user_settings(connection, did):
-    sql = """
-    SELECT * FROM users WHERE did=:did
+    return settings_cache.get_many(connection, [did])[did]
+
+
+def prefetch_user_settings(connection, dids):
+    """タイムラインなどで使う設定を1回のSELECTでキャッシュに読み込んでおく"""
+    settings_cache.get_many(connection, dids, create=False)
+
+
+def update_user_settings(connection, did, settings):
+    """変更をキャッシュに記録する。DBへは flush_user_settings でまとめて書く"""
+    settings_cache.mark_dirty(settings)
+
+
+def flush_user_settings(connection):
+    return settings_cache.flush(connection)
+
+
+@metrics.timed(DB_SECONDS)
+def claim_reply(connection, uri, did, source, line, owner):
     """
-    params = {
-        "did": did,
-    }
+    投稿 uri への反応を台帳に登録する
+    反応してよければ状態("claimed" か、返信文はあるが未投稿の "generated")を返す
+    反応済み、またはこのプロセスで処理中なら None を返す
+    owner は起動ごとに変わる値で、別の owner の claimed は落ちる前の処理とみなす
+    """
+    with connection:
+        cur = connection.cursor()
+        cur.execute(
+            """
+        INSERT INTO reply_ledger (uri, did, source, state, owner, line)
+                  VALUES (?, ?, ?, 'claimed', ?, ?)
+        ON CONFLICT(uri) DO NOTHING
+        """,
+            (uri, did, source, owner, line),
+        )
+        if cur.rowcount == 1:
+            return "claimed"
+        cur.execute("SELECT state, owner FROM reply_ledger WHERE uri = ?", (uri,))
+        row = cur.fetchone()
+        if row["state"] not in ("claimed", "generated") or row["owner"] == owner:
+            return None
+        cur.execute(
+            """
+        UPDATE reply_ledger SET owner = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE uri = ? AND owner = ?
+        """,
+            (owner, uri, row["owner"]),
+        )
+        if cur.rowcount == 0:
+            return None
+        return row["state"]
+
+
+@metrics.timed(DB_SECONDS)
+def get_reply(connection, uri):
     cur = connection.cursor()
-    cur.execute(sql, params)
+    cur.execute("SELECT * FROM reply_ledger WHERE uri = ?", (uri,))
+    return cur.fetchone()
+
+
+@metrics.timed(DB_SECONDS)
+def get_unfinished_replies(connection, owner, since):
+    """別の owner が処理しかけたままの反応を古い順に返す"""
+    cur = connection.cursor()
+    cur.execute(
+        """
+    SELECT uri, source, state FROM reply_ledger
+    WHERE state IN ('claimed', 'generated') AND owner != ? AND updated_at >= ?
+    ORDER BY created_at
+    """,
+        (owner, since),
+    )
+    return cur.fetchall()
+
+
+@metrics.timed(DB_SECONDS)
+def get_reply_rkeys(connection, uri):
+    """投稿に使うレコードキーのリスト。保存していなければ None"""
+    cur = connection.cursor()
+    cur.execute("SELECT rkeys FROM reply_rkeys WHERE uri = ?", (uri,))
     row = cur.fetchone()
-    settings = {}
-    if row:
-        for key in row.keys():
-            settings[key] = row[key]
-    else:
-        create_user_settings(connection, did)
-        settings = get_user_settings(connection, did)
+    return json.loads(row["rkeys"]) if row else None
 
-    return settings
 
+@metrics.timed(DB_SECONDS)
+def mark_reply_generated(connection, uri, answer, image_path=None, rkeys=None):
+    """
+    投稿する前に返信文とレコードキーを保存しておき、落ちても再生成せずに、
+    同じキーで投稿し直せるようにする
+    """
+    with connection:
+        connection.execute(
+            """
+        UPDATE reply_ledger
+        SET state = 'generated', answer = ?, image_path = ?,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE uri = ? AND state IN ('claimed', 'generated')
+        """,
+            (answer, image_path, uri),
+        )
+        if rkeys is not None:
+            connection.execute(
+                "INSERT OR REPLACE INTO reply_rkeys (uri, rkeys) VALUES (?, ?)",
+                (uri, json.dumps(rkeys)),
+            )
 
-def update_user_settings(connection, did, settings):
-    sql = """
-    UPDATE users SET
-      mode = :mode,
-      analyze = :analyze,
-      points = :points,
-      all_points = :all_points
-      WHERE did = :did
+
+@metrics.timed(DB_SECONDS)
+def mark_reply_drawing(connection, uri, svg, answer):
     """
-    params = {
-        "did": did,
-        "mode": settings["mode"],
-        "analyze": settings["analyze"],
-        "points": settings["points"],
-        "all_points": settings["all_points"],
-    }
+    お絵描きのSVGとコメントを保存しておき、落ちても聞き直さずに描き直せるようにする
+    返信文はポイントの残りを入れて、描けてから作る
+    """
+    with connection:
+        connection.execute(
+            """
+        UPDATE reply_ledger
+        SET state = 'generated', answer = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE uri = ? AND state IN ('claimed', 'generated')
+        """,
+            (answer, uri),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO reply_drawings (uri, svg, answer) VALUES (?, ?, ?)",
+            (uri, svg, answer),
+        )
+
+
+@metrics.timed(DB_SECONDS)
+def get_reply_drawing(connection, uri):
     cur = connection.cursor()
-    cur.execute(sql, params)
-    connection.commit()
+    cur.execute("SELECT svg, answer FROM reply_drawings WHERE uri = ?", (uri,))
+    return cur.fetchone()
+
+
+@metrics.timed(DB_SECONDS)
+def delete_reply_drawing(connection, uri):
+    with connection:
+        connection.execute("DELETE FROM reply_drawings WHERE uri = ?", (uri,))
+
+
+@metrics.timed(DB_SECONDS)
+def mark_reply_posted(connection, uri):
+    with connection:
+        connection.execute(
+            """
+        UPDATE reply_ledger SET state = 'posted', updated_at = CURRENT_TIMESTAMP
+        WHERE uri = ?
+        """,
+            (uri,),
+        )
+        # 投稿できたら描き直すことはないので、SVGはすぐに消す
+        connection.execute("DELETE FROM reply_drawings WHERE uri = ?", (uri,))
+
 
+@metrics.timed(DB_SECONDS)
+def mark_reply_skipped(connection, uri):
+    """反応しないと決まったものを閉じる(返信済みのものはそのまま)"""
+    with connection:
+        connection.execute(
+            """
+        UPDATE reply_ledger SET state = 'skipped', updated_at = CURRENT_TIMESTAMP
+        WHERE uri = ? AND state = 'claimed'
+        """,
+            (uri,),
+        )
 
+
+@metrics.timed(DB_SECONDS)
+def delete_old_replies(connection, before):
+    with connection:
+        connection.execute(
+            """
+        DELETE FROM reply_rkeys WHERE uri IN (
+            SELECT uri FROM reply_ledger
+            WHERE state IN ('posted', 'skipped') AND updated_at < ?
+        )
+        """,
+            (before,),
+        )
+        connection.execute(
+            """
+        DELETE FROM reply_drawings WHERE uri IN (
+            SELECT uri FROM reply_ledger
+            WHERE state IN ('posted', 'skipped') AND updated_at < ?
+        )
+        """,
+            (before,),
+        )
+        connection.execute(
+            "DELETE FROM reply_ledger WHERE state IN ('posted', 'skipped') AND updated_at < ?",
+            (before,),
+        )
+
+
+@metrics.timed(DB_SECONDS)
+def get_follow_graph(connection, relation):
+    """relation("follow" か "follower")のDIDの集合を返す"""
+    cur = connection.cursor()
+    cur.execute("SELECT did FROM follow_graph WHERE relation = ?", (relation,))
+    return set(row[0] for row in cur.fetchall())
+
+
+FOLLOW_GRAPH_UPSERT = """
+INSERT INTO follow_graph (did, relation, handle) VALUES (?, ?, ?)
+ON CONFLICT(did, relation) DO UPDATE SET
+  handle = COALESCE(excluded.handle, handle),
+  updated_at = CURRENT_TIMESTAMP
+"""
+
+
+@metrics.timed(DB_SECONDS)
+def add_follow_graph(connection, relation, rows):
+    """rows は (did, handle) のリスト"""
+    with connection:
+        connection.executemany(
+            FOLLOW_GRAPH_UPSERT, [(did, relation, handle) for did, handle in rows]
+        )
+
+
+@metrics.timed(DB_SECONDS)
+def sync_follow_graph(connection, relation, rows, keep_after=None):
+    """
+    全件取得した rows ((did, handle) のリスト)とDBの差分だけを書く
+    keep_after 以降に書いた行は一覧への反映が遅れているだけかもしれないので消さない
+    (追加した件数, 削除した件数) を返す
+    """
+    current = get_follow_graph(connection, relation)
+    latest = dict(rows)
+    added = [(did, latest[did]) for did in latest.keys() - current]
+    removed = current - latest.keys()
+    if keep_after is not None and removed:
+        cur = connection.cursor()
+        cur.execute(
+            "SELECT did FROM follow_graph WHERE relation = ? AND updated_at >= ?",
+            (relation, keep_after),
+        )
+        removed -= set(row[0] for row in cur.fetchall())
+    with connection:
+        connection.executemany(
+            FOLLOW_GRAPH_UPSERT, [(did, relation, handle) for did, handle in added]
+        )
+        connection.executemany(
+            "DELETE FROM follow_graph WHERE did = ? AND relation = ?",
+            [(did, relation) for did in removed],
+        )
+    return len(added), len(removed)
+
+
+@metrics.timed(DB_SECONDS)
+def get_follow_backs(connection):
+    """フォローを返していないフォロワーのDID"""
+    cur = connection.cursor()
+    cur.execute(
+        """
+    SELECT did FROM follow_graph AS f
+    WHERE relation = 'follower'
+      AND NOT EXISTS (
+        SELECT 1 FROM follow_graph WHERE did = f.did AND relation = 'follow'
+      )
+    """
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+@metrics.timed(DB_SECONDS)
 def get_latest_record_by_did(connection, did):
     sql = """
     SELECT *
@@ -172,16 +587,21 @@ def has_mention(bot_names, eline):
         if bot_name in text:
             found = True
             break
-        if "reply" in eline:
-            if eline.reply.parent.author.handle == bot_name:
+        if eline.reply is not None:
+            if eline.reply.parent.handle == bot_name:
                 found = True
                 break
 
     return found
 
 
-def get_did_list(after=None):
-    url = "https://plc.directory/export"
+# PLC の export。ローカルの代替(stand_in/pds.py)で動かす場合は .env で変える
+PLC_EXPORT_URL = os.getenv("PLC_EXPORT_URL", "https://plc.directory/export")
+
+
+def iter_did_lines(after=None):
+    """plc.directory/export を1行ずつ(bytes)返す。ページ全体は保持しない"""
+    url = PLC_EXPORT_URL
     if after:
         url += f"?after={after}"
 
@@ -190,8 +610,11 @@ def get_did_list(after=None):
 
     for attempt in range(max_retries + 1):
         try:
-            response = requests.get(url, timeout=(15, 15))
-            return response.text
+            # やり直しはこの関数で行う
+            response = xrpc.client.get(
+                url, timeout=(15, 15), stream=True, policy=xrpc.NO_RETRY
+            )
+            break
         except (
             requests.exceptions.ConnectionError,
             requests.exceptions.Timeout,
@@ -199,16 +622,107 @@ def get_did_list(after=None):
         ) as e:
             if attempt == max_retries:
                 print(f"Failed to get DID list after {max_retries + 1} attempts: {e}")
-                return ""  # 空文字列を返して処理を継続
+                return  # 何も返さずに処理を継続
 
             delay = base_delay * (2**attempt)
-            print(f"Network error in get_did_list (attempt {attempt + 1}): {e}")
+            print(f"Network error in iter_did_lines (attempt {attempt + 1}): {e}")
             print(f"Retrying in {delay} seconds...")
             time.sleep(delay)
 
-    return ""  # フォールバック
+    with response:
+        try:
+            for line in response.iter_lines(chunk_size=65536):
+                if line:
+                    yield line
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ) as e:
+            # 途中で切れた場合はそこまでの行で打ち切り、次回続きから取得する
+            print(f"Network error while streaming DID list: {e}")
+
+
+# ユーザー作成(genesis)の操作だけが対象なので、それ以外はJSONを解析せずに捨てる
+DID_CREATE_MARKERS = (b'"prev":null', b'"prev": null')
+CREATED_AT_MARKER = b'"createdAt":"'
+
+
+def get_line_created_at(line):
+    """行末近くの createdAt をJSON解析なしで取り出す"""
+    start = line.rfind(CREATED_AT_MARKER)
+    if start < 0:
+        return loads_json(line)["createdAt"]
+    start += len(CREATED_AT_MARKER)
+    return line[start : line.index(b'"', start)].decode()
+
+
+def parse_did_line(line):
+    """export の1行から (did, handle, endpoint, created_at) を返す。対象外はNone"""
+    if not any(marker in line for marker in DID_CREATE_MARKERS):
+        return None
+
+    did_dict = loads_json(line)
+    operation = did_dict["operation"]
+    operation_type = operation["type"]
+    if operation_type == "create":
+        handle = operation["handle"]
+        endpoint = operation["service"]
+    elif operation_type == "plc_operation":
+        if operation["prev"] is not None:
+            return None
+        services = operation["services"]
+        if "atproto_pds" not in services or len(operation["alsoKnownAs"]) == 0:
+            return None
+        handle = operation["alsoKnownAs"][0].replace("at://", "")
+        endpoint = services["atproto_pds"]["endpoint"]
+    else:
+        return None
+
+    return (
+        did_dict["did"].replace("did:plc:", ""),
+        handle,
+        endpoint,
+        did_dict["createdAt"].replace("T", " ").replace("Z", ""),
+    )
+
+
+def iter_did_rows(lines, page):
+    """
+    行のイテレータから users に入れる行を順に返す
+    page["lines"] と page["after"] に読んだ行数と最後の createdAt を記録する
+    """
+    last_line = None
+    for line in lines:
+        page["lines"] += 1
+        last_line = line
+        try:
+            row = parse_did_line(line)
+        except Exception as e:
+            traceback.print_exc()
+            print(repr(e))
+            print("****************")
+            print(line)
+            print("****************")
+            continue
+        if row:
+            yield row
+    if last_line is not None:
+        page["after"] = get_line_created_at(last_line)
+
+
+def iter_batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
+@metrics.timed(DB_SECONDS)
 def insert_did_many(connection, did_list):
     cur = connection.cursor()
     cur.executemany(
@@ -222,26 +736,203 @@ def insert_did_many(connection, did_list):
     connection.commit()
 
 
+@metrics.timed(DB_SECONDS)
+def insert_did_batch(connection, did_list, after, batch_id):
+    """
+    1バッチを1つのトランザクションでまとめて書き込む
+    同じトランザクションで plc_sync_state のカーソルも進める
+    """
+    with connection:
+        connection.executemany(
+            """
+        INSERT OR IGNORE INTO users
+            (did, handle, endpoint, created_at)
+            VALUES (?, ?, ?, ?)
+        """,
+            did_list,
+        )
+        connection.execute(
+            """
+        INSERT INTO plc_sync_state (id, after, batch_id)
+            VALUES (1, :after, :batch_id)
+          ON CONFLICT(id) DO UPDATE SET
+            after = :after,
+            batch_id = :batch_id,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+            {"after": after, "batch_id": batch_id},
+        )
+
+
+@metrics.timed(DB_SECONDS)
+def get_plc_sync_state(connection):
+    cur = connection.cursor()
+    cur.execute("SELECT after, batch_id FROM plc_sync_state WHERE id = 1")
+    row = cur.fetchone()
+    if row:
+        return {"after": row[0], "batch_id": row[1]}
+    # チェックポイント導入前のDBは一度だけ users から求める
+    return {"after": get_last_created_at(connection), "batch_id": 0}
+
+
+@metrics.timed(DB_SECONDS)
 def get_last_created_at(connection):
     cur = connection.cursor()
     sql = """
-    SELECT *
+    SELECT MAX(created_at) AS created_at
     FROM users
-    ORDER BY created_at DESC
-    LIMIT 1
     """
-    cur = connection.cursor()
     cur.execute(sql)
     row = cur.fetchone()
-    return row[4]
+    return row[0]
+
+
+# get_user_info / get_user_count で共通に使うエンドポイントの除外条件
+ENDPOINT_FILTER_PARAMS = {
+    "endpoint": "https://%",
+    "except_endpoint1": "https://stems.social",
+    "except_endpoint2": "%localhost%",
+    "except_endpoint3": "%example.com",
+    "except_endpoint4": "https:///%",
+    "except_endpoint5": "file://%",
+    "except_endpoint6": "%;%",
+    "except_endpoint7": "%<%",
+    "except_endpoint8": "%>%",
+    "except_endpoint9": "%|%",
+    "except_endpoint10": "%534.bsky.social%",
+    "except_endpoint11": "%test.invalid",
+    "except_endpoint12": "%among.us.gov",
+    "except_endpoint13": "https://na",
+    "except_endpoint14": "https://test2",
+    "except_endpoint15": "https://boobee.blue",
+}
+
+ENDPOINT_FILTER_SQL = """
+            endpoint like :endpoint and
+            endpoint not like :except_endpoint1 and
+            endpoint not LIKE :except_endpoint2 and
+            endpoint not LIKE :except_endpoint3 and
+            endpoint not LIKE :except_endpoint4 and
+            endpoint not LIKE :except_endpoint5 and
+            endpoint not LIKE :except_endpoint6 and
+            endpoint not LIKE :except_endpoint7 and
+            endpoint not LIKE :except_endpoint8 and
+            endpoint not LIKE :except_endpoint9 and
+            endpoint not LIKE :except_endpoint10 and
+            endpoint not LIKE :except_endpoint11 and
+            endpoint not LIKE :except_endpoint12 and
+            endpoint not LIKE :except_endpoint13 and
+            endpoint not LIKE :except_endpoint14 and
+            endpoint not LIKE :except_endpoint15
+"""
+
+USER_RANK_WINDOW = 100000
+
+
+@metrics.timed(DB_SECONDS)
+def get_ranked_user_id(connection):
+    cur = connection.cursor()
+    cur.execute("SELECT last_user_id FROM user_rank_state WHERE id = 1")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+@metrics.timed(DB_SECONDS)
+def update_user_ranks(connection, window=USER_RANK_WINDOW):
+    """
+    user_ranks に created_at ごとの累積ユーザー数(順位)を反映する
+    users.id が last_user_id より大きい行だけを window 件ずつ処理する
+    """
+    cur = connection.cursor()
+    last_user_id = get_ranked_user_id(connection)
+    cur.execute("SELECT MAX(id) FROM users")
+    max_user_id = cur.fetchone()[0]
+    if max_user_id is None:
+        return
+
+    cur.execute("SELECT created_at, rank FROM user_ranks ORDER BY created_at DESC LIMIT 1")
+    top = cur.fetchone()
+
+    while last_user_id < max_user_id:
+        upper_user_id = min(last_user_id + window, max_user_id)
+        params = dict(ENDPOINT_FILTER_PARAMS)
+        params["last_user_id"] = last_user_id
+        params["upper_user_id"] = upper_user_id
+        cur.execute(
+            f"""
+        SELECT created_at, COUNT(*) FROM users
+          WHERE
+            id > :last_user_id and
+            id <= :upper_user_id and
+            created_at IS NOT NULL and
+            {ENDPOINT_FILTER_SQL}
+          GROUP BY created_at
+          ORDER BY created_at ASC
+        """,
+            params,
+        )
+        groups = cur.fetchall()
+        for created_at, count in groups:
+            if top is None or created_at > top[0]:
+                # 最新時刻への追記(通常はこちら)
+                rank = (top[1] if top else 0) + count
+                cur.execute(
+                    "INSERT INTO user_ranks (created_at, rank) VALUES (?, ?)",
+                    (created_at, rank),
+                )
+                top = (created_at, rank)
+            else:
+                # 過去の時刻への割り込みは以降の順位をずらす
+                cur.execute(
+                    "UPDATE user_ranks SET rank = rank + ? WHERE created_at >= ?",
+                    (count, created_at),
+                )
+                cur.execute(
+                    "SELECT 1 FROM user_ranks WHERE created_at = ?", (created_at,)
+                )
+                if cur.fetchone() is None:
+                    cur.execute(
+                        """
+                    SELECT rank FROM user_ranks
+                      WHERE created_at < ?
+                      ORDER BY created_at DESC
+                      LIMIT 1
+                    """,
+                        (created_at,),
+                    )
+                    row = cur.fetchone()
+                    base = row[0] if row else 0
+                    cur.execute(
+                        "INSERT INTO user_ranks (created_at, rank) VALUES (?, ?)",
+                        (created_at, base + count),
+                    )
+                top = (top[0], top[1] + count)
 
+        cur.execute(
+            """
+        INSERT INTO user_rank_state (id, last_user_id) VALUES (1, :last_user_id)
+          ON CONFLICT(id) DO UPDATE SET last_user_id = :last_user_id
+        """,
+            {"last_user_id": upper_user_id},
+        )
+        connection.commit()
+        last_user_id = upper_user_id
 
+
+@metrics.timed(DB_SECONDS)
 def get_user_info(connection, did):
+    print(did)
+    # 3回の読み込みの間に update_user_ranks がコミットすると、
+    # 反映済みの範囲を二重に数えたり数え漏らしたりするので、同じ時点の内容で読む
+    with db.snapshot(connection):
+        return read_user_info(connection, did)
+
+
+def read_user_info(connection, did):
     cur = connection.cursor()
     params = {
         "did": did,
     }
-    print(did)
 
     query = """
     SELECT created_at FROM users
@@ -251,52 +942,36 @@ def get_user_info(connection, did):
     row = cur.fetchone()
     if row:
         created_at = row[0]
-        params = {
-            "endpoint": "https://%",
-            "except_endpoint1": "https://stems.social",
-            "except_endpoint2": "%localhost%",
-            "except_endpoint3": "%example.com",
-            "except_endpoint4": "https://",
-            "except_endpoint4": "https:///%",
-            "except_endpoint5": "file://%",
-            "except_endpoint6": "%;%",
-            "except_endpoint7": "%<%",
-            "except_endpoint8": "%>%",
-            "except_endpoint9": "%|%",
-            "except_endpoint10": "%534.bsky.social%",
-            "except_endpoint11": "%test.invalid",
-            "except_endpoint12": "%among.us.gov",
-            "except_endpoint13": "https://na",
-            "except_endpoint14": "https://test2",
-            "except_endpoint15": "https://boobee.blue",
-            "created_at": created_at,
-        }
-
-        query = """
+        ranked_user_id = get_ranked_user_id(connection)
+
+        # user_ranks に反映済みの範囲は索引で引く
+        cur.execute(
+            """
+        SELECT rank FROM user_ranks
+          WHERE created_at <= :created_at
+          ORDER BY created_at DESC
+          LIMIT 1
+        """,
+            {"created_at": created_at},
+        )
+        rank_row = cur.fetchone()
+        order = rank_row[0] if rank_row else 0
+
+        # まだ反映されていない新しい行だけを数える
+        # (+created_at で users_created_at を使わせず、id の範囲で読む)
+        params = dict(ENDPOINT_FILTER_PARAMS)
+        params["ranked_user_id"] = ranked_user_id
+        params["created_at"] = created_at
+        query = f"""
           SELECT COUNT(*) FROM users
             WHERE
-              endpoint like :endpoint and
-              endpoint not like :except_endpoint1 and
-              endpoint not LIKE :except_endpoint2 and
-              endpoint not LIKE :except_endpoint3 and
-              endpoint not LIKE :except_endpoint4 and
-              endpoint not LIKE :except_endpoint5 and
-              endpoint not LIKE :except_endpoint6 and
-              endpoint not LIKE :except_endpoint7 and
-              endpoint not LIKE :except_endpoint8 and
-              endpoint not LIKE :except_endpoint9 and
-              endpoint not LIKE :except_endpoint10 and
-              endpoint not LIKE :except_endpoint11 and
-              endpoint not LIKE :except_endpoint12 and
-              endpoint not LIKE :except_endpoint13 and
-              endpoint not LIKE :except_endpoint14 and
-              endpoint not LIKE :except_endpoint15 and
-              created_at <= :created_at
-        ORDER BY created_at ASC
+              id > :ranked_user_id and
+              {ENDPOINT_FILTER_SQL} and
+              +created_at <= :created_at
         """
 
         cur.execute(query, params)
-        order = cur.fetchone()[0]
+        order += cur.fetchone()[0]
     else:
         order = None
         created_at = None
@@ -304,47 +979,15 @@ def get_user_info(connection, did):
     return {"order": order, "created_at": created_at}
 
 
+@metrics.timed(DB_SECONDS)
 def get_user_count(connection):
     cur = connection.cursor()
-    params = {
-        "endpoint": "https://%",
-        "except_endpoint1": "https://stems.social",
-        "except_endpoint2": "%localhost%",
-        "except_endpoint3": "%example.com",
-        "except_endpoint4": "https://",
-        "except_endpoint4": "https:///%",
-        "except_endpoint5": "file://%",
-        "except_endpoint6": "%;%",
-        "except_endpoint7": "%<%",
-        "except_endpoint8": "%>%",
-        "except_endpoint9": "%|%",
-        "except_endpoint10": "%534.bsky.social%",
-        "except_endpoint11": "%test.invalid",
-        "except_endpoint12": "%among.us.gov",
-        "except_endpoint13": "https://na",
-        "except_endpoint14": "https://test2",
-        "except_endpoint15": "https://boobee.blue",
-    }
+    params = ENDPOINT_FILTER_PARAMS
 
-    query = """
+    query = f"""
     SELECT COUNT(*) FROM users
-      WHERE 
-            endpoint like :endpoint and
-            endpoint not like :except_endpoint1 and
-            endpoint not LIKE :except_endpoint2 and
-            endpoint not LIKE :except_endpoint3 and
-            endpoint not LIKE :except_endpoint4 and
-            endpoint not LIKE :except_endpoint5 and
-            endpoint not LIKE :except_endpoint6 and
-            endpoint not LIKE :except_endpoint7 and
-            endpoint not LIKE :except_endpoint8 and
-            endpoint not LIKE :except_endpoint9 and
-            endpoint not LIKE :except_endpoint10 and
-            endpoint not LIKE :except_endpoint11 and
-            endpoint not LIKE :except_endpoint12 and
-            endpoint not LIKE :except_endpoint13 and
-            endpoint not LIKE :except_endpoint14 and
-            endpoint not LIKE :except_endpoint15
+      WHERE
+            {ENDPOINT_FILTER_SQL}
     """
     cur.execute(query, params)
     row = cur.fetchone()
@@ -352,6 +995,7 @@ def get_user_count(connection):
     return count
 
 
+@metrics.timed(DB_SECONDS)
 def store_posted_user_count(connection, count):
     cur = connection.cursor()
     sql = """
@@ -363,6 +1007,7 @@ def store_posted_user_count(connection, count):
     connection.commit()
 
 
+@metrics.timed(DB_SECONDS)
 def get_posted_user_count(connection):
     cur = connection.cursor()
     sql = """
@@ -377,79 +1022,48 @@ def get_posted_user_count(connection):
     return count
 
 
-def aggregate_users(connection, last_created_at=None):
+AGGREGATE_BATCH_SIZE = 10000
+
+
+@metrics.timed(DB_SECONDS)
+def aggregate_users(connection, last_created_at=None, batch_size=AGGREGATE_BATCH_SIZE):
+    state = get_plc_sync_state(connection)
     if last_created_at is None:
-        last_created_at = get_last_created_at(connection)
+        last_created_at = state["after"]
         # print(last_created_at)
-    did_list = []
+    batch_id = state["batch_id"]
     total = 0
     while True:
-        did_list_text = get_did_list(last_created_at)
-        did_json_list = did_list_text.split("\n")
-        last_created_at_prev = last_created_at
-        if len(did_list_text) > 0:
-            for i, did_json in enumerate(did_json_list):
-                # print(did_json)
-                did_dict = json.loads(did_json)
-                try:
-                    createdAt = did_dict["createdAt"].replace("T", " ").replace("Z", "")
-                    if did_dict["operation"]["type"] == "create":
-                        endpoint = did_dict["operation"]["service"]
-                        did_list.append(
-                            (
-                                did_dict["did"].replace("did:plc:", ""),
-                                did_dict["operation"]["handle"],
-                                endpoint,
-                                createdAt,
-                            )
-                        )
-                    elif did_dict["operation"]["type"] == "plc_operation":
-                        if (
-                            did_dict["operation"]["prev"] is None
-                            and "atproto_pds" in did_dict["operation"]["services"]
-                        ):
-                            if len(did_dict["operation"]["alsoKnownAs"]) > 0:
-                                handle = did_dict["operation"]["alsoKnownAs"][
-                                    0
-                                ].replace("at://", "")
-                                endpoint = did_dict["operation"]["services"][
-                                    "atproto_pds"
-                                ]["endpoint"]
-                                did_list.append(
-                                    (
-                                        did_dict["did"].replace("did:plc:", ""),
-                                        handle,
-                                        endpoint,
-                                        createdAt,
-                                    )
-                                )
-                except Exception as e:
-                    traceback.print_exc()
-                    print(repr(e))
-                    print(str(e))
-                    print("****************")
-                    print(did_dict)
-                    print("****************")
-                    print(did_list_text)
-                    exit(-1)
-            last_created_at = did_dict["createdAt"]
-            if len(did_list) > 10000:
-                insert_did_many(connection, did_list)
-                total += len(did_list)
-                did_list = []
-            print(last_created_at, total + len(did_list))
-
-            if last_created_at == last_created_at_prev:
-                break
-        else:
+        page = {"lines": 0, "after": last_created_at}
+        rows = iter_did_rows(iter_did_lines(last_created_at), page)
+        # ページ途中のバッチはページ開始時のカーソルで記録し、
+        # 最後のバッチだけ次のページのカーソルと一緒にコミットする。
+        # 途中で落ちてもページを取り直すだけで、INSERT OR IGNOREで重複もしない
+        pending = []
+        for did_list in iter_batches(rows, batch_size):
+            if pending:
+                batch_id += 1
+                insert_did_batch(connection, pending, last_created_at, batch_id)
+                total += len(pending)
+            pending = did_list
+        if page["lines"] == 0:
             break
-    if len(did_list) > 0:
-        insert_did_many(connection, did_list)
+        batch_id += 1
+        insert_did_batch(connection, pending, page["after"], batch_id)
+        total += len(pending)
+
+        if page["after"] == last_created_at:
+            break
+        last_created_at = page["after"]
+        print(last_created_at, total)
+
+    update_user_ranks(connection)
 
     # count = get_user_count(connection)
     # return count
 
 
+@metrics.timed(DB_SECONDS)
 def put_log(connection, kind, param1="", param2="", param3="", param4=""):
     params = {
         "kind": kind,
@@ -467,13 +1081,151 @@ def put_log(connection, kind, param1="", param2="", param3="", param4=""):
     connection.commit()
 
 
+@metrics.timed(DB_SECONDS)
+def insert_logs(connection, rows):
+    """(kind, level, param1, param2, param3, param4, created_at) をまとめて書く"""
+    with connection:
+        connection.executemany(
+            """
+            INSERT INTO logs (kind, level, param1, param2, param3, param4, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+
+
+@metrics.timed(DB_SECONDS)
+def rollup_logs(connection, before):
+    """
+    before より古いログを日・種類・レベル・param2・param3 ごとの件数にまとめて消す
+    消した件数を返す
+    """
+    with connection:
+        connection.execute(
+            """
+            INSERT INTO log_rollups (day, kind, level, param2, param3, count)
+            SELECT date(created_at), kind, level,
+                   COALESCE(param2, ''), COALESCE(param3, ''), COUNT(*)
+            FROM logs
+            WHERE created_at < ?
+            GROUP BY 1, 2, 3, 4, 5
+            ON CONFLICT (day, kind, level, param2, param3)
+            DO UPDATE SET count = count + excluded.count
+            """,
+            (before,),
+        )
+        cursor = connection.execute("DELETE FROM logs WHERE created_at < ?", (before,))
+    return cursor.rowcount
+
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+# これより低いレベルのログは書かない
+LOG_LEVEL = LOG_LEVELS.get(os.getenv("LOG_LEVEL", "INFO").upper(), 20)
+LOG_KIND_ERROR = 0
+LOG_KIND_COMMAND = 1
+# 書き込み待ちのログの上限。あふれた分は捨てる
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_DROPPED = metrics.counter("bot_log_dropped_total", "Log records dropped")
+
+
+class LogSink:
+    """
+    ログをキューに積み、書き込み用のスレッドがまとめて1回のトランザクションで書く
+    呼び出し側はDBの書き込みを待たない。キューがあふれたら捨てて数える
+    """
+
+    def __init__(
+        self,
+        connection,
+        level=LOG_LEVEL,
+        queue_size=LOG_QUEUE_SIZE,
+        batch_size=LOG_BATCH_SIZE,
+    ):
+        self.connection = connection
+        self.level = level
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, level, kind, param1="", param2="", param3="", param4=""):
+        if level < self.level:
+            return
+        # CURRENT_TIMESTAMP と同じ形式で、書いた時刻ではなく呼ばれた時刻を残す
+        created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            self.queue.put_nowait(
+                (kind, level, param1, param2, param3, param4, created_at)
+            )
+        except queue.Full:
+            LOG_DROPPED.inc()
+            return
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="log-writer", daemon=True
+            )
+            self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        stop = False
+        while not stop:
+            record = self.queue.get()
+            batch = []
+            # 書いている間に溜まった分もまとめて書く
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+            if batch:
+                try:
+                    insert_logs(self.connection, batch)
+                except Exception:
+                    traceback.print_exc()
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+
+    def flush(self):
+        """積んだログが書き終わるまで待つ"""
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """残りを書いて書き込み用のスレッドを止める"""
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(None)
+        thread.join(timeout=10)
+
+
 def put_command_log(did, command, param):
-    global connection_logs
-    put_log(connection_logs, kind=1, param1=did, param2=command, param3=param)
+    log_sink.put(
+        LOG_LEVELS["INFO"], LOG_KIND_COMMAND, param1=did, param2=command, param3=param
+    )
 
 
-connection_logs = sqlite3.connect("logs.db")
-connection_logs.row_factory = sqlite3.Row
+def put_error_log(source, message, detail=""):
+    log_sink.put(
+        LOG_LEVELS["ERROR"], LOG_KIND_ERROR, param1=source, param2=message, param3=detail
+    )
+
+
+connection_logs = db.connect("logs.db")
 cur_logs = connection_logs.cursor()
 
 cur_logs.execute(
@@ -485,13 +1237,39 @@ CREATE TABLE IF NOT EXISTS logs
    param2 TEXT,
    param3 TEXT,
    param4 TEXT,
-   created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+   created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   level INTEGER NOT NULL DEFAULT 20 /* LOG_LEVELS */
    )
 """
 )
+connection_logs.commit()
+# 古い logs.db に level 列を足すなど(索引は Runtime.migrate が起動後に作る)
+migrations.migrate(connection_logs, "logs.db")
+cur_logs.execute(
+    """
+CREATE TABLE IF NOT EXISTS log_rollups
+  (day TEXT NOT NULL,
+   kind INTEGER NOT NULL,
+   level INTEGER NOT NULL,
+   param2 TEXT NOT NULL,
+   param3 TEXT NOT NULL,
+   count INTEGER NOT NULL,
+   PRIMARY KEY (day, kind, level, param2, param3)
+   ) WITHOUT ROWID
+"""
+)
+connection_logs.commit()
+
+log_sink = LogSink(connection_logs)
+metrics.gauge("bot_log_queue_depth", "Log records waiting to be written").set_function(
+    log_sink.queue.qsize
+)
+
+
+# ユーザー数の統計。ローカルの代替で動かす場合は .env で変える
+USER_STATS_URL = os.getenv("USER_STATS_URL", "https://bsky-search.jazco.io/stats")
 
 
 def get_stats():
-    url = "https://bsky-search.jazco.io/stats"
-    response = requests.get(url, timeout=(15, 15))
+    response = xrpc.client.get(USER_STATS_URL)
     return response.json()
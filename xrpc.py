@@ -0,0 +1,352 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+
+# 既定の (接続, 読み込み) タイムアウト(秒)
+DEFAULT_TIMEOUT = (10, 30)
+# ホストごとに保持する接続数(ハンドラ・ポーリング・GPTのスレッドから同時に使う)
+POOL_MAXSIZE = 16
+# 接続プールを保持するホスト数
+POOL_CONNECTIONS = 20
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRY_AFTER = 30
+# 読み込みは残りのリクエスト数がこの割合を切ったら待ち、返信などの書き込みに残しておく
+READ_RESERVE = 0.1
+# 残りが尽きたときに待つ最長の秒数(回復の時刻が分からないときもこれだけ待つ)
+MAX_RATE_LIMIT_WAIT = 300
+
+RATE_LIMIT_REMAINING = metrics.gauge(
+    "bot_ratelimit_remaining",
+    "Requests left in the current rate-limit window (local estimate)",
+    ("host",),
+)
+RATE_LIMIT_LIMIT = metrics.gauge(
+    "bot_ratelimit_limit", "Requests allowed per rate-limit window", ("host",)
+)
+HTTP_REQUESTS = metrics.counter(
+    "bot_http_requests_total",
+    "HTTP requests sent, including retries",
+    ("host", "endpoint"),
+)
+HTTP_RETRIES = metrics.counter(
+    "bot_http_retries_total", "HTTP requests retried", ("host", "endpoint")
+)
+HTTP_ERRORS = metrics.counter(
+    "bot_http_errors_total",
+    "HTTP requests that failed without a response",
+    ("host", "endpoint"),
+)
+# 0から増えていくだけだが、urllib3 の数をそのまま入れるので gauge にする
+HTTP_CONNECTIONS = metrics.gauge(
+    "bot_http_connections_opened",
+    "Connections opened (TCP/TLS handshakes); requests minus this were reused",
+    ("host",),
+)
+RATE_LIMIT_WAIT = metrics.counter(
+    "bot_ratelimit_wait_seconds_total",
+    "Time spent waiting for the rate-limit window to reset",
+    ("host", "kind"),
+)
+
+
+def is_unsent(error):
+    """接続できずに失敗したなど、リクエストが相手に届いていないと分かる失敗か"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RetryPolicy:
+    """
+    attempts 回まで試す。待ち時間は backoff * 2^(n-1) 秒(429 は Retry-After を優先)
+    unsent_only=True なら、リクエストが相手に届いていないと分かる失敗だけやり直す
+    (書き込みを二重に行わないため)
+    """
+
+    def __init__(
+        self, attempts=3, backoff=1.0, statuses=RETRY_STATUSES, unsent_only=False
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.statuses = statuses
+        self.unsent_only = unsent_only
+
+    def should_retry(self, error):
+        if self.unsent_only:
+            return is_unsent(error)
+        return isinstance(
+            error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        )
+
+    def delay(self, attempt, response=None):
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return min(float(response.headers["Retry-After"]), MAX_RETRY_AFTER)
+            except ValueError:
+                pass
+        if response is not None and response.status_code == 429:
+            # Retry-After がない 429 は ratelimit-reset まで待つ
+            reset = parse_reset(response.headers.get("ratelimit-reset"))
+            if reset is not None:
+                return min(max(reset - time.time(), 0), MAX_RETRY_AFTER)
+        return self.backoff * (2 ** (attempt - 1))
+
+
+READ = RetryPolicy()
+# 書き込みは届いていないと分かる場合と、処理されていない 429/503 だけやり直す
+WRITE = RetryPolicy(attempts=3, statuses=(429, 503), unsent_only=True)
+# ポーリングは次の周期で取り直すのでやり直さない
+POLL = RetryPolicy(attempts=1)
+NO_RETRY = RetryPolicy(attempts=1)
+
+ENDPOINT_POLICIES = {
+    "app.bsky.notification.listNotifications": POLL,
+    "app.bsky.feed.getTimeline": POLL,
+    "com.atproto.repo.createRecord": WRITE,
+    "com.atproto.repo.applyWrites": WRITE,
+    "com.atproto.repo.uploadBlob": WRITE,
+    "app.bsky.notification.updateSeen": WRITE,
+}
+
+
+def parse_reset(value):
+    """ratelimit-reset(UNIXTIME の秒。小さい値は残り秒数とみなす)を UNIXTIME にする"""
+    if value is None:
+        return None
+    try:
+        reset = float(value)
+    except ValueError:
+        return None
+    if reset < 10**9:
+        reset += time.time()
+    return reset
+
+
+class RateLimit:
+    """
+    ホストごとのトークンバケット。PDS が返す ratelimit-limit / ratelimit-remaining /
+    ratelimit-reset を応答のたびに読み、送るたびに手元で1つ減らす
+    読み込み(通知・タイムラインの取得など)と書き込み(投稿・画像・フォロー)で
+    同じバケットを使い、読み込みは READ_RESERVE の分を書き込みに残して待つ
+    ヘッダーを一度も見ていないホストは制限しない
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self.window = None
+
+    def update(self, headers):
+        remaining = headers.get("ratelimit-remaining")
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+            limit = int(headers.get("ratelimit-limit", remaining))
+        except ValueError:
+            return
+        reset_at = parse_reset(headers.get("ratelimit-reset"))
+        # ratelimit-policy は "3000;w=300"(300秒あたり3000回)
+        window = None
+        for part in headers.get("ratelimit-policy", "").split(";")[1:]:
+            key, _, value = part.strip().partition("=")
+            if key == "w" and value.isdigit():
+                window = int(value)
+        with self.lock:
+            if window:
+                self.window = window
+            self.limit = max(limit, 1)
+            # 並行して送った分が後から返ってくることがあるので、少ない方を信じる
+            if self.remaining is None or (
+                reset_at is not None and reset_at > self.reset_at + 1
+            ):
+                self.remaining = remaining
+            else:
+                self.remaining = min(remaining, self.remaining)
+            if reset_at is not None:
+                self.reset_at = reset_at
+        RATE_LIMIT_LIMIT.set(self.limit, self.host)
+        RATE_LIMIT_REMAINING.set(self.remaining, self.host)
+
+    def refill(self, now):
+        """回復の時刻を過ぎていれば満タンに戻す(ロックを取ってから呼ぶ)"""
+        if self.remaining is not None and now >= self.reset_at:
+            self.remaining = self.limit
+
+    def take(self, write):
+        """1つ使えたら0を、使えなければ回復するまでの秒数を返す"""
+        with self.lock:
+            if self.remaining is None:
+                return 0
+            now = time.time()
+            self.refill(now)
+            reserve = 0 if write else int(self.limit * READ_RESERVE)
+            if self.remaining > reserve:
+                self.remaining -= 1
+                remaining = self.remaining
+                wait = 0
+            else:
+                remaining = None
+                wait = self.reset_at - now if self.reset_at > now else 1
+        if remaining is not None:
+            RATE_LIMIT_REMAINING.set(remaining, self.host)
+        return min(wait, MAX_RATE_LIMIT_WAIT)
+
+    def budget(self):
+        """
+        残りの割合(0〜1)。ウィンドウの長さが分かれば、回復までの残り時間に
+        均等に使った場合の残りと比べる(使いすぎていれば1未満)
+        ヘッダーを見ていなければ1
+        """
+        with self.lock:
+            if self.remaining is None:
+                return 1.0
+            now = time.time()
+            self.refill(now)
+            expected = self.limit
+            if self.window and self.reset_at > now:
+                expected *= min((self.reset_at - now) / self.window, 1)
+            return min(self.remaining / max(expected, 1), 1.0)
+
+
+def endpoint_of(url):
+    """/xrpc/<NSID> の NSID(XRPC でなければパス)"""
+    path = urlparse(url).path
+    if path.startswith("/xrpc/"):
+        return path[len("/xrpc/") :]
+    return path
+
+
+class Client:
+    """
+    すべての HTTP リクエストを1つの requests.Session(keep-alive の接続プール)で送る
+    タイムアウトの既定値とエンドポイントごとのリトライを揃え、リクエスト数と
+    接続の再利用をホスト・エンドポイントごとに metrics に記録する
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.lock = threading.Lock()
+        self.rate_limits = {}
+
+    def count_connections(self, url, host):
+        """url のホストの接続プールで今までに張った接続の数を記録する"""
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            # TLS の設定ごとに別のプールになるので、同じホストの分を足す
+            if pool is not None and (pool.host, pool.port) == (parsed.hostname, port):
+                connections += pool.num_connections
+        HTTP_CONNECTIONS.set(connections, host)
+
+    def rate_limit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            rate_limit = self.rate_limits.get(host)
+            if rate_limit is None:
+                rate_limit = self.rate_limits[host] = RateLimit(host)
+        return rate_limit
+
+    def budget(self, url):
+        """url のホストで使えるリクエストの残りの割合(0〜1)"""
+        return self.rate_limit(url).budget()
+
+    def wait_for_budget(self, rate_limit, write):
+        """残りがなければ回復するまで待つ"""
+        while True:
+            wait = rate_limit.take(write)
+            if not wait:
+                return
+            kind = "write" if write else "read"
+            print(f"[http] {rate_limit.host} rate limit reached, waiting {wait:.1f}s")
+            RATE_LIMIT_WAIT.inc(rate_limit.host, kind, amount=wait)
+            time.sleep(wait)
+
+    def request(self, method, url, policy=None, **kwargs):
+        """
+        失敗したら policy に従ってやり直す。最後の応答をそのまま返し、
+        やり直しても通信できなければ最後の例外を投げる
+        ホストのレート制限の残りがなければ、送る前に回復するまで待つ
+        """
+        endpoint = endpoint_of(url)
+        if policy is None:
+            policy = ENDPOINT_POLICIES.get(endpoint)
+        if policy is None:
+            policy = READ if method == "GET" else WRITE
+        kwargs.setdefault("timeout", self.timeout)
+        rate_limit = self.rate_limit(url)
+        host = rate_limit.host
+        write = method != "GET"
+        attempt = 0
+        while True:
+            attempt += 1
+            self.wait_for_budget(rate_limit, write)
+            HTTP_REQUESTS.inc(host, endpoint)
+            try:
+                response = self.session.request(method, url, **kwargs)
+                rate_limit.update(response.headers)
+                self.count_connections(url, host)
+            except requests.exceptions.RequestException as e:
+                HTTP_ERRORS.inc(host, endpoint)
+                if attempt >= policy.attempts or not policy.should_retry(e):
+                    raise
+                delay = policy.delay(attempt)
+                print(f"[http] {endpoint} failed ({e}), retrying in {delay}s")
+            else:
+                if attempt >= policy.attempts or (
+                    response.status_code not in policy.statuses
+                ):
+                    return response
+                delay = policy.delay(attempt, response)
+                print(
+                    f"[http] {endpoint} returned {response.status_code}, retrying in {delay}s"
+                )
+                response.close()
+            HTTP_RETRIES.inc(host, endpoint)
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """
+        全ホストの合計のリクエスト数と新しく張った接続(TCP/TLS ハンドシェイク)の数
+        reused がリクエスト数に近いほど接続を使い回せている
+        ホスト・エンドポイントごとの数は /metrics の bot_http_* で見る
+        """
+        stats = {}
+        for key, metric in (
+            ("requests", HTTP_REQUESTS),
+            ("retries", HTTP_RETRIES),
+            ("errors", HTTP_ERRORS),
+            ("connections", HTTP_CONNECTIONS),
+        ):
+            with metric.lock:
+                stats[key] = sum(metric.values.values())
+        stats["reused"] = stats["requests"] - stats["connections"]
+        return stats
+
+
+client = Client()